@@ -62,18 +62,32 @@ net_arg.add_argument('--fully_conv', type=str2bool, default=False)
 net_arg.add_argument('--vort_loss', type=str2bool, default=False)
 net_arg.add_argument('--load_ae', type=str2bool, default=True)
 net_arg.add_argument('--load_pred', type=str2bool, default=True)
+net_arg.add_argument('--mixed_precision', type=str, default='float32', choices=['float32', 'float16']) # float16: layers in float16, losses and master weights in float32
+net_arg.add_argument('--loss_scale', type=float, default=0.0) # static loss scale of float16 training; 0 uses dynamic loss scaling
+net_arg.add_argument('--gradient_checkpointing', type=str2bool, default=False) # recompute encoder/decoder blocks and rollout steps in the backward pass to save memory
 
 # Data
 data_arg = add_argument_group('Data')
 data_arg.add_argument('--dataset', type=str, default='smoke_mov200_f400')
 data_arg.add_argument('--batch_size', type=int, default=8)
-data_arg.add_argument('--num_worker', type=int, default=1)
+data_arg.add_argument('--validation_batch_size', type=int, default=0) # batch size of the validation pass over all validation windows; 0 uses batch_size
+data_arg.add_argument('--num_worker', type=int, default=1) # > 1 assembles training batches in that many processes (PrefetchLoader)
+data_arg.add_argument('--loader_queue_depth', type=int, default=4) # prefetched batches per loader process
+data_arg.add_argument('--max_queue_size', type=int, default=10) # batches fit_generator prefetches from a generator; the generators reuse max_queue_size + 2 batch buffers
+data_arg.add_argument('--data_backend', type=str, default='python', choices=['python', 'tfdata']) # tfdata: build the input batches with a tf.data pipeline (keras_data_tf.py)
+data_arg.add_argument('--tfdata_parallel_calls', type=int, default=4)
+data_arg.add_argument('--tfdata_cache', type=str, default='') # '' no cache, 'memory' keeps the raw frames in the --frame_cache_mb frame cache, or a file prefix for the decoded validation windows
 data_arg.add_argument('--data_type', type=str, nargs='+', default=['velocity'], 
                       choices=['velocity', 'pressure', 'density', 'levelset', 'inflow'])
 data_arg.add_argument('--tiles_per_sample', type=int, default=4)
 data_arg.add_argument('--tiles_use_global', type=str2bool, default=False)
 data_arg.add_argument('--tile_scale', type=int, default=1)
 data_arg.add_argument('--tile_multitile_border', type=int, default=0)
+data_arg.add_argument('--tile_overlap', type=int, default=0) # overlap of neighboring tiles for tiled inference, blended linearly
+data_arg.add_argument('--frame_cache_mb', type=int, default=0) # memory budget of the preprocessed frame cache, split over the --num_worker loader processes; 0 disables it
+data_arg.add_argument('--use_packed', type=str2bool, default=False) # read the memory-mapped store written by pack_dataset.py instead of the npz files
+data_arg.add_argument('--packed_dtype', type=str, default='float32', choices=['float32', 'float16']) # storage type used by pack_dataset.py
+data_arg.add_argument('--shared_cache_dir', type=str, default='') # e.g. /dev/shm/lsp_cache: node-local packed copy of the dataset, built once and shared by all runs
 
 
 # Training / test parameters
@@ -112,6 +126,8 @@ misc_arg.add_argument('--test_batch_size', type=int, default=900)
 misc_arg.add_argument('--test_intv', type=int, default=16)
 misc_arg.add_argument('--random_seed', type=int, default=123)
 misc_arg.add_argument('--gpu_id', type=str, default='0')
+misc_arg.add_argument('--worker_hosts', type=str, default='') # host:port,host:port,... data parallel training over several processes/nodes; '' trains in this process
+misc_arg.add_argument('--task_index', type=int, default=0) # index of this process in --worker_hosts; task 0 is the chief that runs the training
 
 def get_config():
     config, unparsed = parser.parse_known_args()
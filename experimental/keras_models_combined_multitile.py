@@ -219,13 +219,11 @@ class RecursivePrediction_Multitile(Network):
         print("Input shape: {}".format(inputs))
 
         def global_concat(x, t):
-            # first concat x axis for individual rows
-            c0 = K.concatenate([x[:, t, 0], x[:, t, 1], x[:, t, 2]], axis=2)
-            c1 = K.concatenate([x[:, t, 3], x[:, t, 4], x[:, t, 5]], axis=2)
-            c2 = K.concatenate([x[:, t, 6], x[:, t, 7], x[:, t, 8]], axis=2)
-            # then concat y axis
-            ct = K.concatenate([c0,c1,c2], axis=1)
-            return ct
+            # same as TileConfig.merge_grid: (b, 9, y, x, c) -> (b, 3, 3, y, x, c) -> (b, 3, y, 3, x, c) -> (b, 3y, 3x, c)
+            tile_shape = K.int_shape(x)[3:]
+            ct = K.reshape(x[:, t], (-1, 3, 3) + tile_shape)
+            ct = K.permute_dimensions(ct, (0, 1, 3, 2, 4, 5))
+            return K.reshape(ct, (-1, 3 * tile_shape[0], 3 * tile_shape[1], tile_shape[2]))
 
         # global concat
         global_t1 = Lambda(global_concat, arguments={'t': 1})(inputs)
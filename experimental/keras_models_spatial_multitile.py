@@ -678,7 +678,7 @@ class Autoencoder(Network):
 
 from config import get_config
 from utils import prepare_dirs_and_logger
-from keras_data import BatchManager, copy_dataset_info
+from keras_data import BatchManager, TiledInference, copy_dataset_info
 import os
 from utils import save_image
 from LatentSpacePhysics.src.util.requirements import init_packages
@@ -856,39 +856,16 @@ if __name__ == "__main__":
         print("test_data shape: {}".format(test_data.shape))
 
         full_res_image = np.zeros_like(test_data, dtype=np.float32)
-        print("full_res_image shape: {}".format(full_res_image.shape))
-
-        plot_callback = PlotAEFields(ae.predict, None, save_img_to_disk, "./test/", keras_batch_manager)
-
-        from skimage import measure
 
         if keras_batch_manager.tile_generator is not None:
-            while keras_batch_manager.tile_generator.getNextTile():
-                keras_batch_manager.tile_generator.print()
-                tile = keras_batch_manager.tile_generator.cut_tile_2d(test_data)
-                print("tile shape: {}".format(tile.shape))
-                if tiles_use_global:
-                    x_mult = int(keras_batch_manager.tile_generator.data_dim[0] / keras_batch_manager.tile_generator.tile_size[0])
-                    y_mult = int(keras_batch_manager.tile_generator.data_dim[1] / keras_batch_manager.tile_generator.tile_size[1])
-                    z_mult = int(keras_batch_manager.tile_generator.data_dim[2] / keras_batch_manager.tile_generator.tile_size[2])
-                    tile_flag_shape = list(test_data.shape)
-                    tile_flag_shape[-1] = 1
-                    tile_flag = np.zeros(tile_flag_shape)
-                    tile_flag[keras_batch_manager.tile_generator.y_start:keras_batch_manager.tile_generator.y_end, keras_batch_manager.tile_generator.x_start:keras_batch_manager.tile_generator.x_end, :] = 1
-                    # 2:3 -> capture only density part
-                    x_downscale = measure.block_reduce(test_data[...,2:3], (1, y_mult, x_mult, 1), np.mean)
-                    tile_flag_downscale = measure.block_reduce(tile_flag, (1, y_mult, x_mult, 1), np.mean)
-                    tile = np.append(tile, x_downscale, axis=-1)
-                    tile = np.append(tile, tile_flag_downscale, axis=-1)
-                plot_callback._x = tile
-                plot_callback.on_epoch_end(0,0)
-                full_res_image[...,keras_batch_manager.tile_generator.y_start:keras_batch_manager.tile_generator.y_end,
-                keras_batch_manager.tile_generator.x_start:keras_batch_manager.tile_generator.x_end, :] = plot_callback._y
-            # if x[0].ndim == 4:
-            #     x_tile = x[self.tile_generator.z_start:self.tile_generator.z_end, self.tile_generator.y_start:self.tile_generator.y_end, self.tile_generator.x_start:self.tile_generator.x_end, :]
-            # else:
-            #     x_tile = x[self.tile_generator.y_start:self.tile_generator.y_end, self.tile_generator.x_start:self.tile_generator.x_end, :]
-            # x = x_tile
+            try:
+                tile_overlap = config.tile_overlap
+            except AttributeError:
+                tile_overlap = 0
+            # all tiles of the field in one batch and one predict call
+            tiled_inference = TiledInference(ae.predict, keras_batch_manager.tile_generator.tile_size, keras_batch_manager.is_3d, overlap=tile_overlap, use_global=tiles_use_global)
+            full_res_image = tiled_inference.predict(test_data[0])[np.newaxis]
+            print("predicted {} tiles".format(len(tiled_inference.positions)))
         print("full_res_image shape: {}".format(full_res_image.shape))
         save_img_to_disk(full_res_image, 0, "./test/", keras_batch_manager, "EncDec")
         save_img_to_disk(test_data, 0, "./test/", keras_batch_manager, "GT")
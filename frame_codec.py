@@ -0,0 +1,133 @@
+import json
+import zlib
+import struct
+
+import numpy as np
+
+# frame files keep their .npz names for every codec:
+#   none      -> np.savez
+#   zlib      -> np.savez_compressed
+#   zlib:<l>, lz4[:<l>], zstd[:<l>] -> container MAGIC | header length | json header | compressed arrays
+# load() detects the format from the first bytes. lz4 and zstd fall back to zlib if their module is not installed.
+MAGIC = b'LSSF'
+_fallback_warned = set()
+
+#------------------------------------------------------------------------------------------------
+class FrameFile(object):
+    """ container file opened by load(); usable like the NpzFile returned by np.load, every array is only read and decompressed on its first access """
+    def __init__(self, f, codec, entries, offset):
+        self._file = f
+        self._decompress = _decompressor(codec)
+        self._entries = {}
+        for entry in entries:
+            self._entries[entry['key']] = (offset, entry)
+            offset += entry['size']
+        self._arrays = {}
+        self.files = [entry['key'] for entry in entries]
+    def __getitem__(self, key):
+        if key not in self._arrays:
+            offset, entry = self._entries[key]
+            self._file.seek(offset)
+            data = self._decompress(self._file.read(entry['size']))
+            # bytearray -> writable array, the loaders normalize in place
+            self._arrays[key] = np.frombuffer(bytearray(data), dtype=np.dtype(entry['dtype'])).reshape(entry['shape'])
+        return self._arrays[key]
+    def __contains__(self, key):
+        return key in self._entries
+    def __iter__(self):
+        return iter(self.files)
+    def __len__(self):
+        return len(self.files)
+    def keys(self):
+        return list(self.files)
+    def __enter__(self):
+        return self
+    def __exit__(self, *args):
+        self.close()
+    def close(self):
+        self._arrays.clear()
+        self._file.close()
+
+#------------------------------------------------------------------------------------------------
+def parse_codec(codec):
+    """ 'zstd:3' -> ('zstd', 3), 'lz4' -> ('lz4', None) """
+    name, _, level = codec.partition(':')
+    assert name in ['none', 'zlib', 'lz4', 'zstd'], ("Unknown frame codec {}".format(codec))
+    return name, int(level) if level else None
+
+#------------------------------------------------------------------------------------------------
+def _compressor(name, level):
+    """ returns the name of the codec actually used and its compress function """
+    if name == 'lz4':
+        try:
+            import lz4.frame
+            return name, lambda data: lz4.frame.compress(data, compression_level=level or 0)
+        except ImportError:
+            pass
+    elif name == 'zstd':
+        try:
+            import zstandard
+            return name, zstandard.ZstdCompressor(level=level or 3).compress
+        except ImportError:
+            pass
+    if name != 'zlib':
+        if name not in _fallback_warned:
+            print("WARNING: module for frame codec {} is not installed, frames are stored with zlib".format(name))
+            _fallback_warned.add(name)
+        level = None
+    return 'zlib', lambda data: zlib.compress(data, 6 if level is None else level)
+
+#------------------------------------------------------------------------------------------------
+def _decompressor(name):
+    if name == 'lz4':
+        import lz4.frame
+        return lz4.frame.decompress
+    elif name == 'zstd':
+        import zstandard
+        return zstandard.ZstdDecompressor().decompress
+    return zlib.decompress
+
+#------------------------------------------------------------------------------------------------
+def save(file_path, codec='zlib', **arrays):
+    name, level = parse_codec(codec)
+    if name == 'none':
+        np.savez(file_path, **arrays)
+        return
+    if name == 'zlib' and level is None:
+        np.savez_compressed(file_path, **arrays)
+        return
+
+    if not file_path.endswith('.npz'):
+        file_path += '.npz'
+    name, compress = _compressor(name, level)
+    entries = []
+    payload = []
+    for key, arr in arrays.items():
+        arr = np.ascontiguousarray(np.asarray(arr))
+        assert arr.dtype != object, ("{} can not be stored with codec {}".format(key, codec))
+        data = compress(arr.tobytes())
+        entries.append({'key': key, 'dtype': arr.dtype.str, 'shape': list(arr.shape), 'size': len(data)})
+        payload.append(data)
+    header = json.dumps({'codec': name, 'arrays': entries}).encode('utf-8')
+    with open(file_path, 'wb') as f:
+        f.write(MAGIC)
+        f.write(struct.pack('<I', len(header)))
+        f.write(header)
+        for data in payload:
+            f.write(data)
+
+#------------------------------------------------------------------------------------------------
+def load(file_path):
+    """ np.load replacement for frame files of any codec; use as 'with load(path) as data: x = data['x']'.
+        only the header is read here, the arrays on access """
+    f = open(file_path, 'rb')
+    try:
+        if f.read(len(MAGIC)) != MAGIC:
+            f.close()
+            return np.load(file_path)
+        header_size = struct.unpack('<I', f.read(4))[0]
+        header = json.loads(f.read(header_size).decode('utf-8'))
+    except:
+        f.close()
+        raise
+    return FrameFile(f, header['codec'], header['arrays'], len(MAGIC) + 4 + header_size)
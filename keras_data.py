@@ -1,5 +1,5 @@
 import os
-from glob import glob
+import json
 
 from datetime import datetime
 
@@ -9,8 +9,15 @@ import matplotlib.pyplot as plt
 
 from itertools import product
 from random import randint, seed
+from collections import OrderedDict
+import threading
+import multiprocessing
+import queue
+import signal
+import traceback
 
 from ops import *
+import frame_codec
 from math import floor
 
 from skimage import measure
@@ -134,16 +141,119 @@ class TileConfig(object):
         self.x_end = self.x_start + self.x_dim
         self.y_end = self.y_start + self.y_dim
         self.z_end = self.z_start + self.z_dim
+    # sets the current tile to start at pos (x, y, z)
+    def set_tile(self, pos):
+        self.x_start = int(pos[0])
+        self.x_end = self.x_start + self.x_dim
+        self.y_start = int(pos[1])
+        self.y_end = self.y_start + self.y_dim
+        self.z_start = int(pos[2])
+        self.z_end = self.z_start + self.z_dim
+    # returns [before, after] padding per x, y, z that covers every tile of generateRandomTile
+    def tile_padding(self, out_of_bounds_fac=0):
+        if out_of_bounds_fac <= 0:
+            return [[0, 0], [0, 0], [0, 0]]
+        return [[int(t/out_of_bounds_fac), t - int(t/out_of_bounds_fac)] for t in self.tile_size]
+    # returns count random tile starts (count, 3) in x, y, z with the same distribution as generateRandomTile
+    def random_tile_starts(self, count, rng=np.random, out_of_bounds_fac=0):
+        pad = self.tile_padding(out_of_bounds_fac)
+        low = [-p[0] for p in pad]
+        high = [d - t + p[1] + 1 for d, t, p in zip(self.data_dim, self.tile_size, pad)]
+        return rng.randint(low, high, size=(count, 3))
+    # returns a sequence buffer [..., (z,) y, x, c] padded once for all random tiles and the view of its unpadded interior;
+    # the border holds the out of bounds values of cut_tile: 0 for the velocity channels, -1 for all others
+    def padded_buffer(self, shape, is_3d, out_of_bounds_fac=0):
+        spatial = 3 if is_3d else 2
+        pad = self.tile_padding(out_of_bounds_fac)[:spatial][::-1]
+        offset = len(shape) - 1 - spatial
+        padded_shape = list(shape)
+        interior = [slice(None)] * len(shape)
+        for i, (before, after) in enumerate(pad):
+            padded_shape[offset+i] += before + after
+            interior[offset+i] = slice(before, before + shape[offset+i])
+        padded = np.empty(padded_shape, dtype=np.float32)
+        padded[..., :spatial] = 0.0
+        padded[..., spatial:] = -1.0
+        return padded, padded[tuple(interior)]
+    # returns the tiles at starts (n, 3) of a padded_buffer as strided views [..., (z,) y, x, c]; same values as cut_tile/cut_tile_2d,
+    # except for 3d tiles that leave the domain only in z: cut_tile sliced these with a negative or too large z range (a wrapped or
+    # thinner tile), here they get the out of bounds values like in x and y
+    def cut_tiles(self, padded, starts, is_3d, out_of_bounds_fac=0):
+        spatial = 3 if is_3d else 2
+        pad = self.tile_padding(out_of_bounds_fac)[:spatial][::-1]
+        tile = self.tile_size[:spatial][::-1]
+        offset = padded.ndim - 1 - spatial
+        spatial_shape = padded.shape[offset:offset+spatial]
+        spatial_strides = padded.strides[offset:offset+spatial]
+        # windows[(z,) y, x] is the tile starting at that padded position
+        windows = np.lib.stride_tricks.as_strided(padded,
+            shape=tuple(s - t + 1 for s, t in zip(spatial_shape, tile)) + padded.shape[:offset] + tuple(tile) + padded.shape[-1:],
+            strides=spatial_strides + padded.strides[:offset] + spatial_strides + padded.strides[-1:],
+            writeable=False)
+        return [windows[tuple(int(start[spatial-1-i]) + pad[i][0] for i in range(spatial))] for start in starts]
+    # returns all tile starts (n, 3) in x, y, z of generateRandomTile whose tile in padded_field [(z,) y, x] of a padded_buffer has a mean of at least min_mean;
+    # the tile sums of all positions are looked up in a summed-area table
+    def valid_tile_starts(self, padded_field, min_mean, out_of_bounds_fac=0):
+        spatial = padded_field.ndim
+        pad = self.tile_padding(out_of_bounds_fac)[:spatial][::-1]
+        tile = self.tile_size[:spatial][::-1]
+        counts = [s - t + 1 for s, t in zip(padded_field.shape, tile)]
+        sat = np.zeros([s + 1 for s in padded_field.shape])
+        sat[(slice(1, None),) * spatial] = padded_field
+        for axis in range(spatial):
+            np.cumsum(sat, axis=axis, out=sat)
+        tile_sum = np.zeros(counts)
+        for corner in product([0, 1], repeat=spatial):
+            sign = -1 if (spatial - sum(corner)) % 2 else 1
+            tile_sum += sign * sat[tuple(slice(c * t, c * t + n) for c, t, n in zip(corner, tile, counts))]
+        pos = np.argwhere(tile_sum / (self.x_dim * self.y_dim * self.z_dim) >= min_mean) - [p[0] for p in pad]
+        starts = np.zeros((len(pos), 3), dtype=np.int64)
+        starts[:, :spatial] = pos[:, ::-1]
+        return starts
+    # returns the block means of the spatial dims of data [..., (z,) y, x, c] with the factor data_dim / tile_size (global tile information)
+    def downscale(self, data, is_3d):
+        spatial = 3 if is_3d else 2
+        mult = [int(self.data_dim[i] / self.tile_size[i]) for i in range(spatial)][::-1]
+        return measure.block_reduce(data, tuple([1] * (data.ndim - 1 - spatial) + mult + [1]), np.mean)
+    # returns downscale() of a flag that is 1 on the part of the tile at pos (x, y, z) inside the domain; computed per axis from the block overlaps
+    def tile_flag_downscale(self, pos, is_3d):
+        spatial = 3 if is_3d else 2
+        axes = []
+        for i in range(spatial):
+            mult = int(self.data_dim[i] / self.tile_size[i])
+            block_start = np.arange(0, self.data_dim[i], mult)
+            # block_reduce pads the last block with zeros -> divide by the full block size
+            overlap = np.minimum(block_start + mult, min(pos[i] + self.tile_size[i], self.data_dim[i])) - np.maximum(block_start, max(pos[i], 0))
+            axes.append(np.maximum(overlap, 0) / float(mult))
+        flag = axes[1][:, np.newaxis] * axes[0][np.newaxis, :]
+        if is_3d:
+            flag = axes[2][:, np.newaxis, np.newaxis] * flag[np.newaxis]
+        return flag[..., np.newaxis]
+    # splits data [..., (Z,) Y, X, c] into grid (x, y, z) tiles [..., n, (Z/gz,) Y/gy, X/gx, c] in row major order; a remainder is dropped
+    def split_grid(self, data, grid, is_3d):
+        spatial = 3 if is_3d else 2
+        grid = list(grid[:spatial])[::-1]
+        lead = data.ndim - 1 - spatial
+        tile = [d // g for d, g in zip(data.shape[lead:-1], grid)]
+        data = data[(Ellipsis,) + tuple(slice(0, g * t) for g, t in zip(grid, tile)) + (slice(None),)]
+        # [..., gz, tz, gy, ty, gx, tx, c] -> [..., gz, gy, gx, tz, ty, tx, c]
+        data = data.reshape(data.shape[:lead] + tuple(d for g, t in zip(grid, tile) for d in (g, t)) + data.shape[-1:])
+        axes = list(range(lead)) + [lead + 2*i for i in range(spatial)] + [lead + 2*i + 1 for i in range(spatial)] + [lead + 2*spatial]
+        return data.transpose(axes).reshape(data.shape[:lead] + (int(np.prod(grid)),) + tuple(tile) + data.shape[-1:])
+    # inverse of split_grid: tiles [..., n, (z,) y, x, c] -> [..., (gz*z,) gy*y, gx*x, c]
+    def merge_grid(self, data, grid, is_3d):
+        spatial = 3 if is_3d else 2
+        grid = list(grid[:spatial])[::-1]
+        lead = data.ndim - 2 - spatial
+        tile = data.shape[lead+1:-1]
+        data = data.reshape(data.shape[:lead] + tuple(grid) + tile + data.shape[-1:])
+        # [..., gz, gy, gx, tz, ty, tx, c] -> [..., gz, tz, gy, ty, gx, tx, c]
+        axes = list(range(lead)) + [a for i in range(spatial) for a in (lead + i, lead + spatial + i)] + [lead + 2*spatial]
+        return data.transpose(axes).reshape(data.shape[:lead] + tuple(g * t for g, t in zip(grid, tile)) + data.shape[-1:])
     # returns next tile in multiples of tile_size
     def getNextTile(self):
         if self.cur_idx < self.tile_count_linear(self.tile_size):
-            pos = self.from_idx(self.cur_idx)
-            self.x_start = pos[0]
-            self.x_end = self.x_start + self.x_dim
-            self.y_start = pos[1]
-            self.y_end = self.y_start + self.y_dim
-            self.z_start = pos[2]
-            self.z_end = self.z_start + self.z_dim
+            self.set_tile(self.from_idx(self.cur_idx))
             self.cur_idx += 1
             return True
         else:
@@ -153,6 +263,299 @@ class TileConfig(object):
         print("({}:{}, {}:{}, {}:{})".format(self.x_start, self.x_end, self.y_start, self.y_end, self.z_start, self.z_end))
 
 ### ============ Class ==============
+class TiledInference(object):
+    """ applies a tile sized network to a whole field [(z,) y, x, c]: all tiles are cut into one batch, predicted with a single call and blended back """
+    def __init__(self, predict_fn, tile_size, is_3d, overlap=0, use_global=False, batch_size=32, output_index=0):
+        self.predict_fn = predict_fn
+        self.is_3d = is_3d
+        self.spatial = 3 if is_3d else 2
+        # tile_size and overlap in x, y, z like TileConfig; stored in array order (z,) y, x
+        self.tile = list(tile_size[:self.spatial])[::-1]
+        overlap = overlap if isinstance(overlap, (list, tuple)) else [overlap] * 3
+        self.stride = [t - o for t, o in zip(self.tile, list(overlap[:self.spatial])[::-1])]
+        assert min(self.stride) > 0, ("Tile overlap {} must be smaller than the tile size {}".format(overlap, tile_size))
+        self.use_global = use_global
+        self.batch_size = batch_size
+        self.output_index = output_index
+        self.weights = self._blend_weights([t - s for t, s in zip(self.tile, self.stride)])
+
+    #--------------------------------------------
+    def _blend_weights(self, overlap):
+        """ linear ramps over the overlapping borders of a tile, 1 in the inner part """
+        weights = np.ones(self.tile, dtype=np.float32)
+        for axis, (t, o) in enumerate(zip(self.tile, overlap)):
+            if o == 0:
+                continue
+            ramp = np.minimum(1.0, np.minimum(np.arange(t) + 0.5, t - np.arange(t) - 0.5) / o)
+            shape = [1] * self.spatial
+            shape[axis] = t
+            weights *= ramp.reshape(shape)
+        return weights[..., np.newaxis]
+
+    #--------------------------------------------
+    def _starts(self, dim, tile, stride):
+        starts = list(range(0, dim - tile + 1, stride))
+        if starts[-1] != dim - tile:
+            # last tile is aligned to the border
+            starts.append(dim - tile)
+        return starts
+
+    #--------------------------------------------
+    def tiles(self, field):
+        """ all tiles of field as one batch (n, (z,) y, x, c); fields smaller than a tile are padded like out of bounds training tiles """
+        self.field_shape = field.shape[:-1]
+        dims = [max(d, t) for d, t in zip(self.field_shape, self.tile)]
+        if dims != list(self.field_shape):
+            padded = np.empty(dims + [field.shape[-1]], dtype=np.float32)
+            padded[..., :self.spatial] = 0.0
+            padded[..., self.spatial:] = -1.0
+            padded[tuple(slice(0, d) for d in self.field_shape)] = field
+            field = padded
+        self.positions = list(product(*[self._starts(d, t, s) for d, t, s in zip(dims, self.tile, self.stride)]))
+        batch = np.stack([field[tuple(slice(p, p + t) for p, t in zip(pos, self.tile))] for pos in self.positions])
+
+        if self.use_global:
+            tile_generator = TileConfig(list(self.tile[::-1]) + ([] if self.is_3d else [1]), dims[::-1] + ([] if self.is_3d else [1]))
+            density_channel = 3 if self.is_3d else 2
+            x_downscale = tile_generator.downscale(field[..., density_channel:density_channel+1], self.is_3d)
+            assert list(x_downscale.shape[:-1]) == self.tile, ("Global information needs a field of a multiple of the tile size, got {}".format(field.shape))
+            global_info = np.empty(batch.shape[:-1] + (2,), dtype=np.float32)
+            global_info[..., 0:1] = x_downscale
+            for i, pos in enumerate(self.positions):
+                global_info[i, ..., 1:] = tile_generator.tile_flag_downscale(list(pos[::-1]) + ([] if self.is_3d else [0]), self.is_3d)
+            batch = np.concatenate([batch, global_info], axis=-1)
+        return batch
+
+    #--------------------------------------------
+    def stitch(self, tile_batch):
+        """ blends a batch of predicted tiles of the last tiles() call back into a field of its shape """
+        dims = [max(d, t) for d, t in zip(self.field_shape, self.tile)]
+        field = np.zeros(dims + [tile_batch.shape[-1]], dtype=np.float32)
+        weight_sum = np.zeros(dims + [1], dtype=np.float32)
+        for tile, pos in zip(tile_batch, self.positions):
+            region = tuple(slice(p, p + t) for p, t in zip(pos, self.tile))
+            field[region] += tile * self.weights
+            weight_sum[region] += self.weights
+        field /= weight_sum
+        return field[tuple(slice(0, d) for d in self.field_shape)]
+
+    #--------------------------------------------
+    def predict(self, field):
+        """ prediction of the whole field with a single batched call of predict_fn """
+        y = self.predict_fn(self.tiles(field), batch_size=self.batch_size)
+        if isinstance(y, list):
+            y = y[self.output_index]
+        return self.stitch(y)
+
+### ============ Class ==============
+class FrameCache(object):
+    """ LRU cache for preprocessed frames keyed by (scene, frame, data type index), bounded by max_bytes """
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.cur_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        # train and validation generators run in separate threads
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def put(self, key, value, nbytes):
+        if nbytes > self.max_bytes:
+            return
+        with self._lock:
+            if key in self._entries:
+                return
+            while self.cur_bytes + nbytes > self.max_bytes:
+                _, (_, evicted_bytes) = self._entries.popitem(last=False)
+                self.cur_bytes -= evicted_bytes
+            self._entries[key] = (value, nbytes)
+            self.cur_bytes += nbytes
+
+    def hit_rate(self):
+        requests = self.hits + self.misses
+        return self.hits / float(requests) if requests > 0 else 0.0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __str__(self):
+        return "FrameCache: {} frames, {:.1f}/{:.1f} MB, hits {}, misses {}, hit rate {:.3f}".format(
+            len(self), self.cur_bytes / 1048576.0, self.max_bytes / 1048576.0, self.hits, self.misses, self.hit_rate())
+
+### ============ Class ==============
+class DatasetIndex(object):
+    """ scene and frame ids of all samples that exist for every data type, ordered by scene and frame.
+        behaves like a list of path tuples, paths are only assembled on access """
+    file_name = 'dataset_index_{}.npz' # per type list, e.g. dataset_index_vdi.npz
+
+    def __init__(self, root, data_type, scene, frame):
+        self.root = root
+        self.type_dirs = [data_type_[0] for data_type_ in data_type]
+        self.scene = scene
+        self.frame = frame
+
+    @classmethod
+    def load(cls, root, data_type, args_path):
+        """ reads the index cached next to args.txt; the file tree is only scanned if it is missing or outdated """
+        type_dirs = "".join(data_type_[0] for data_type_ in data_type)
+        index_path = os.path.join(root, cls.file_name.format(type_dirs))
+        if os.path.exists(index_path) and (not os.path.exists(args_path) or os.path.getmtime(index_path) >= os.path.getmtime(args_path)):
+            with np.load(index_path) as data:
+                if str(data['type_dirs']) == type_dirs:
+                    return cls(root, data_type, data['scene'], data['frame'])
+
+        ids = None
+        for type_dir in type_dirs:
+            type_path = os.path.join(root, type_dir)
+            file_names = os.listdir(type_path) if os.path.isdir(type_path) else []
+            type_ids = set(tuple(int(i) for i in os.path.splitext(file_name)[0].split('_')) for file_name in file_names if file_name.endswith('.npz'))
+            ids = type_ids if ids is None else ids & type_ids
+        ids = np.array(sorted(ids), dtype=np.int32).reshape(-1, 2)
+        index = cls(root, data_type, ids[:, 0], ids[:, 1])
+        if len(ids) > 0:
+            index.save(index_path, type_dirs)
+        return index
+
+    def save(self, index_path, type_dirs):
+        """ written to a temporary file and renamed, so concurrent runs never read a partial index; read-only datasets keep the index in memory """
+        tmp_path = "{}.{}.tmp".format(index_path, os.getpid())
+        try:
+            with open(tmp_path, 'wb') as f:
+                np.savez(f, type_dirs=type_dirs, scene=self.scene, frame=self.frame)
+            os.replace(tmp_path, index_path)
+            print("Dataset index saved: {}".format(index_path))
+        except OSError as e:
+            print("WARNING: dataset index not saved ({})".format(e))
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+    @classmethod
+    def from_grid(cls, root, data_type, num_scenes, num_frames):
+        scene = np.repeat(np.arange(num_scenes, dtype=np.int32), num_frames)
+        frame = np.tile(np.arange(num_frames, dtype=np.int32), num_scenes)
+        return cls(root, data_type, scene, frame)
+
+    def valid_mask(self, sequence_length, max_frame):
+        """ samples that can start a window of sequence_length frames """
+        return self.frame <= max_frame - sequence_length + 1
+
+    def __len__(self):
+        return len(self.scene)
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[j] for j in range(*i.indices(len(self)))]
+        return tuple(os.path.join(self.root, type_dir, "{}_{}.npz".format(self.scene[i], self.frame[i])) for type_dir in self.type_dirs)
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+### ============ Class ==============
+class WindowSampler(object):
+    """ valid windows (indices into BatchManager.paths) of one split, reshuffled every epoch with seed random_seed + epoch;
+        without shuffle every epoch visits all windows in dataset order """
+    def __init__(self, windows, random_seed, windows_per_epoch=None, shuffle=True):
+        self.windows = windows
+        self.random_seed = random_seed
+        self.windows_per_epoch = len(windows) if windows_per_epoch is None else windows_per_epoch
+        self.shuffle = shuffle
+
+    def epoch(self, epoch):
+        if not self.shuffle:
+            return self.windows[:self.windows_per_epoch]
+        rng = np.random.RandomState(self.random_seed + epoch)
+        return rng.permutation(self.windows)[:self.windows_per_epoch]
+
+    def stream(self, chunk=1, shard=0, num_shards=1, epoch_end=False):
+        """ endless window stream over all epochs; with num_shards > 1 only every num_shards-th chunk of windows is returned;
+            with epoch_end None is returned after the last window of every epoch """
+        pos = 0
+        epoch = 0
+        while True:
+            for window in self.epoch(epoch):
+                if (pos // chunk) % num_shards == shard:
+                    yield window
+                pos += 1
+            if epoch_end:
+                yield None
+            epoch += 1
+
+### ============ Class ==============
+class DatasetSplit(object):
+    """ whole-scene train/validation split of a DatasetIndex, computed once and shared by the training generators and the test batches.
+        validation scenes are spread evenly over the supervised control params, so both splits cover the whole y_range """
+    def __init__(self, paths, validation_split, scene_params=None):
+        self.validation_split = validation_split
+        self.scenes = np.unique(paths.scene)
+        val_count = max(1, int(floor(len(self.scenes) * validation_split))) if validation_split > 0.0 else 0
+        val_count = min(val_count, len(self.scenes))
+        if val_count == len(self.scenes) or scene_params is None:
+            # no params known: the last scenes, as before
+            order = np.arange(len(self.scenes))
+            picks = np.arange(len(self.scenes) - val_count, len(self.scenes))
+        else:
+            # sort scenes by their mean params (first param varies slowest) and take every len/val_count-th one
+            params = np.asarray(scene_params, dtype=np.float64)[self.scenes].reshape(len(self.scenes), -1)
+            order = np.lexsort(params.T[::-1])
+            picks = np.round((np.arange(val_count) + 0.5) * len(self.scenes) / val_count - 0.5).astype(np.int64)
+        self.val_scenes = np.sort(self.scenes[order[picks]])
+        self.train_scenes = np.setdiff1d(self.scenes, self.val_scenes)
+        self.is_val = np.isin(paths.scene, self.val_scenes)
+
+    def samples(self, validation=False, mask=None):
+        """ indices into the DatasetIndex of all samples of one split in scene and frame order; mask e.g. BatchManager.valid_mask """
+        in_split = self.is_val if validation else ~self.is_val
+        if mask is not None:
+            in_split = in_split & mask
+        return np.flatnonzero(in_split)
+
+    def __str__(self):
+        return "DatasetSplit({:.2f}): {} train scenes, validation scenes {}".format(self.validation_split, len(self.train_scenes), self.val_scenes.tolist())
+
+### ============ Class ==============
+class PackedStore(object):
+    """ read-only view of a dataset converted by pack_dataset.py: one memory-mapped (scenes, frames, [z], y, x, c) array per data type """
+    def __init__(self, packed_path, data_type):
+        with open(os.path.join(packed_path, 'meta.json'), 'r') as f:
+            self.meta = json.load(f)
+        for data_type_ in data_type:
+            assert data_type_ in self.meta['data_type'], ("data_type {} was not packed in {}".format(data_type_, packed_path))
+        if "inflow" in data_type:
+            assert self.meta['den_inflow'] == ("density" in data_type), ("inflow was packed with a different normalization, repack with the same data_type list")
+        self.fields = [np.load(os.path.join(packed_path, data_type_[0]+'.npy'), mmap_mode='r') for data_type_ in data_type]
+        # supervised params are tiny -> keep them in memory
+        self.params = np.load(os.path.join(packed_path, 'params.npy'))
+        self.num_scenes = self.meta['num_scenes']
+        self.num_frames = self.meta['num_frames']
+
+    def frame(self, scene, frame, i_d):
+        return self.fields[i_d][scene, frame], list(self.params[scene, frame])
+
+    def read_sequence(self, x, y, scene, t, field_mask=None):
+        """ copies the slices [scene, t:t+len(x)] of all data types into the channel ranges of x, one write per data type;
+            with field_mask (frames, data types) only the frames of a data type that are set are read """
+        length = x.shape[0]
+        c = 0
+        for i_d, field in enumerate(self.fields):
+            if field_mask is None or field_mask[:, i_d].all():
+                x[..., c:c+field.shape[-1]] = field[scene, t:t+length]
+            else:
+                for i in np.flatnonzero(field_mask[:, i_d]):
+                    x[i, ..., c:c+field.shape[-1]] = field[scene, t+i]
+            c += field.shape[-1]
+        y[...] = self.params[scene, t:t+length]
+
 class BatchManager(object):
     def __init__(self, config, sequence_length, prediction_window, data_args_path=None):
         self.rng = np.random.RandomState(config.random_seed)
@@ -161,25 +564,30 @@ class BatchManager(object):
         self.config = config
         seed(config.random_seed)
 
-        if data_args_path:
-            self.args = read_args_file(data_args_path)
-        else:
-            self.args = read_args_file(os.path.join(self.root, 'args.txt'))
+        args_path = data_args_path if data_args_path else os.path.join(self.root, 'args.txt')
+        self.args = read_args_file(args_path)
 
         self.is_3d = config.is_3d
         self.c_num = int(self.args['num_param'])
 
-        self.paths = [[] for _ in range(len(config.data_type))]
-
         assert self.c_num >= 2, ("At least >num_scenes<, and >num_frames< must be given")
-        num_frames = int(self.args['num_frames'])
-        for i_d, data_type in enumerate(config.data_type):
-            self.paths[i_d] = sorted(glob("{}/{}/*".format(self.root, data_type[0])),
-                                        key=lambda path: int(os.path.basename(path).split('_')[0])*num_frames+\
-                                                int(os.path.basename(path).split('_')[1].split('.')[0]))
 
-        # make tuple out of paths (e.g. [(v0, d0), (v1, d1)])
-        self.paths = list(zip(*self.paths))
+        try:
+            use_packed = self.config.use_packed
+        except AttributeError:
+            use_packed = False
+        self.packed = None
+        if use_packed:
+            packed_path = os.path.join(self.root, 'packed')
+            assert os.path.exists(os.path.join(packed_path, 'meta.json')), ("No packed dataset found in {}, run pack_dataset.py first".format(packed_path))
+            self.packed = PackedStore(packed_path, config.data_type)
+            print("Using packed dataset {} ({} scenes, {} frames)".format(packed_path, self.packed.num_scenes, self.packed.num_frames))
+
+        # paths are ordered by scene and frame (e.g. [(v0, d0), (v1, d1)])
+        if self.packed is not None:
+            self.paths = DatasetIndex.from_grid(self.root, config.data_type, self.packed.num_scenes, self.packed.num_frames)
+        else:
+            self.paths = DatasetIndex.load(self.root, config.data_type, args_path)
 
         self.num_samples = len(self.paths)
         #assert(self.num_samples > 0)
@@ -190,8 +598,8 @@ class BatchManager(object):
 
         self.batch_size = config.batch_size
         self.epochs_per_step = self.batch_size / float(self.num_samples) # per epoch
-        self.random_indices = np.arange(self.num_samples)
-        np.random.shuffle(self.random_indices)
+        # (index, count) of the loader process; every count-th chunk of the window stream is drawn by this process
+        self.shard = (0, 1)
 
         self.data_type = config.data_type
         depth = []
@@ -231,6 +639,36 @@ class BatchManager(object):
         except AttributeError:
             self.tile_multitile_border = 0
 
+        try:
+            frame_cache_mb = self.config.frame_cache_mb
+        except AttributeError:
+            frame_cache_mb = 0
+        try:
+            num_worker = self.config.num_worker
+        except AttributeError:
+            num_worker = 1
+        if num_worker > 1:
+            # every PrefetchLoader process (num_worker for training, one for validation) fills its own copy
+            frame_cache_mb /= float(num_worker + 1)
+        self.frame_cache = FrameCache(int(frame_cache_mb * 1024 * 1024)) if frame_cache_mb > 0 else None
+
+        try:
+            self.max_queue_size = self.config.max_queue_size
+        except AttributeError:
+            self.max_queue_size = 10
+        # pass max_queue_size to fit_generator: the batches in its queue, the one trained on and the one being filled need their own buffer
+        self.batch_buffer_count = self.max_queue_size + 2
+
+        try:
+            self.data_backend = self.config.data_backend
+        except AttributeError:
+            self.data_backend = "python"
+
+        try:
+            self.validation_batch_size = self.config.validation_batch_size
+        except AttributeError:
+            self.validation_batch_size = 0
+
         if self.use_tiles:
             print("WARNING: use_tiles is activated since network resolution is different from dataset resolution ({},{},{}) <-> ({},{},{})".format(self.config.res_x, self.config.res_y, self.config.res_z, self.data_res_x, self.data_res_y, self.data_res_z))
             self.tile_generator = TileConfig([self.config.res_x*self.tile_scale, self.config.res_y*self.tile_scale, self.config.res_z*self.tile_scale if self.is_3d else self.config.res_z], [self.data_res_x, self.data_res_y, self.data_res_z])
@@ -275,9 +713,80 @@ class BatchManager(object):
 
         self.supervised_param_count = len(self.y_range) - 2
 
+        # per scene parameter table of newer datasets; the frame files only contain the current params
+        self.param_table = None
+        n_path = os.path.join(self.root, 'n.npz')
+        if self.packed is None and os.path.exists(n_path):
+            with np.load(n_path) as data:
+                if 'y' in data:
+                    param_table = data['y'].astype(np.float32)
+                    assert param_table.shape[-1] == self.supervised_param_count, ("n.npz contains {} params, args.txt {}".format(param_table.shape[-1], self.supervised_param_count))
+                    sup_range = np.array(self.y_range[2:], dtype=np.float32)
+                    self.param_table = (param_table - sup_range[:, 0]) / (sup_range[:, 1] - sup_range[:, 0]) * 2.0 - 1.0
+        self.valid_mask = self.paths.valid_mask(self.sequence_length, self.y_range[1][1])
+        # DatasetSplit per validation_split, see dataset_split
+        self.splits = {}
+
+        try:
+            shared_cache_dir = self.config.shared_cache_dir
+        except AttributeError:
+            shared_cache_dir = ""
+        if shared_cache_dir and self.packed is None and self.dataset_valid:
+            self.attach_shared_cache(shared_cache_dir)
+
         print("Dataset x_range: {}".format(self.x_range))
         print("Dataset y_range: {}".format(self.y_range))
 
+    #--------------------------------------------
+    def attach_shared_cache(self, cache_dir):
+        """ reads from a preprocessed, memory-mapped copy of the dataset in cache_dir (e.g. /dev/shm) that all runs on a node share;
+            the first run builds it with pack_dataset while holding a lock file exclusively, the others check and map the copy under
+            a shared lock, so a rebuild never replaces it between the check and the open """
+        import fcntl
+        import hashlib
+        import shutil
+        from pack_dataset import pack_dataset
+        try:
+            dtype = np.dtype(self.config.packed_dtype)
+        except AttributeError:
+            dtype = np.dtype(np.float32)
+
+        # one copy per dataset, data type list and storage type; the hash of the dataset root separates equally named datasets in other data dirs
+        root = os.path.realpath(self.root)
+        name = "{}_{}_{}_{}".format(os.path.basename(root), hashlib.sha1(root.encode('utf-8')).hexdigest()[:10], "".join(data_type[0] for data_type in self.data_type), dtype.name)
+        cache_path = os.path.join(cache_dir, name)
+        meta_path = os.path.join(cache_path, 'meta.json')
+        args_path = os.path.join(self.root, 'args.txt')
+        def is_current():
+            # a regenerated dataset invalidates the copy
+            return os.path.exists(meta_path) and os.path.getmtime(meta_path) >= os.path.getmtime(args_path)
+
+        os.makedirs(cache_dir, exist_ok=True)
+        with open(cache_path + '.lock', 'w') as lock:
+            fcntl.flock(lock, fcntl.LOCK_SH)
+            try:
+                if not is_current():
+                    # flock converts the lock by releasing it first, another run may have built the copy in between
+                    fcntl.flock(lock, fcntl.LOCK_EX)
+                    if not is_current():
+                        print("Building shared dataset cache {}".format(cache_path))
+                        build_path = cache_path + '.build'
+                        if os.path.exists(build_path):
+                            shutil.rmtree(build_path)
+                        pack_dataset(self, build_path, dtype)
+                        # runs still reading an old copy keep their mapped files
+                        if os.path.exists(cache_path):
+                            shutil.rmtree(cache_path)
+                        os.rename(build_path, cache_path)
+                    fcntl.flock(lock, fcntl.LOCK_SH)
+                # PackedStore maps all files when it is created, later rebuilds don't affect this run
+                self.packed = PackedStore(cache_path, self.data_type)
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+        self.param_table = None
+        print("Using shared dataset cache {} ({} scenes, {} frames)".format(cache_path, self.packed.num_scenes, self.packed.num_frames))
+
     #--------------------------------------------
     @property
     def num_scenes(self):
@@ -288,154 +797,181 @@ class BatchManager(object):
         return self.y_num[1]
 
     #--------------------------------------------
-    def validation_start_index(self, validation_split=0.1, file_based=True):
-        if file_based:
-            return floor(self.num_samples * (1.0 - validation_split))
-        else:
-            val_scene_count = max(1.0, floor(self.num_scenes * validation_split))
-            return int(self.num_samples - self.num_frames * val_scene_count)
+    def scene_params(self):
+        """ mean supervised params of every scene (scenes, params), None if the dataset has no parameter table """
+        if self.packed is not None:
+            return self.packed.params.mean(axis=1)
+        if self.param_table is not None:
+            return self.param_table.mean(axis=1)
+        # older datasets only store the trajectory of the first control param
+        n_path = os.path.join(self.root, 'n.npz')
+        if os.path.exists(n_path):
+            with np.load(n_path) as data:
+                if 'n' in data:
+                    return np.asarray(data['n'], dtype=np.float32).reshape(data['n'].shape[0], -1).mean(axis=1, keepdims=True)
+        return None
+
+    #--------------------------------------------
+    def dataset_split(self, validation_split=0.1):
+        """ train/validation split by whole scenes; computed once per validation_split and used by all generators and test batches """
+        if validation_split not in self.splits:
+            scene_params = self.scene_params() if self.dataset_valid else None
+            if scene_params is not None and len(scene_params) <= self.paths.scene.max():
+                print("Parameter table holds {} scenes, dataset {}; splitting without params".format(len(scene_params), self.paths.scene.max()+1))
+                scene_params = None
+            self.splits[validation_split] = DatasetSplit(self.paths, validation_split, scene_params)
+            print(self.splits[validation_split])
+        return self.splits[validation_split]
 
     #------------------------------------------------------------------------------------------------
-    def steps_per_epoch(self, batch_size, validation_split=0.1, validation=False):
-        """ number of batches to train on. can be used in fit_generator """
+    def steps_per_epoch(self, batch_size, validation_split=0.1, validation=False, drop_remainder=False):
+        """ number of batches to train on. can be used in fit_generator; drop_remainder: no partial last validation batch (stateful models) """
         assert self.dataset_valid, "Dataset was created with no samples..."
 
-        scene_count = self.y_num[0]
-        frame_count = self.y_num[1]
-        num_draws = scene_count * ( frame_count - self.sequence_length + 1)
-        num_draws = floor(num_draws * validation_split) if validation else floor(num_draws * (1.0 - validation_split))
+        num_draws = len(self.window_sampler(batch_size, validation_split, validation).windows)
         if self.use_tiles:
             num_draws *= self.tiles_per_sample
+        if validation and not drop_remainder:
+            # the last validation batch holds the remainder
+            return int(np.ceil(num_draws / float(batch_size)))
         return int(num_draws / batch_size)
 
     #------------------------------------------------------------------------------------------------
-    def generator_ae(self, batch_size, validation_split=0.1, validation=False, multitile=False):
-        """ generator for use with keras __fit_generator__ function. runs in its own thread """
-        assert self.dataset_valid, "Dataset was created with no samples..."
+    def window_sampler(self, batch_size, validation_split=0.1, validation=False):
+        """ sampler over all valid windows of the train or validation scenes of dataset_split.
+            validation visits every window exactly once per epoch in a fixed order """
+        windows = self.dataset_split(validation_split).samples(validation, self.valid_mask)
+        if validation:
+            return WindowSampler(windows, self.config.random_seed, shuffle=False)
+        # whole batches per epoch; tiles of a window may be spread over two batches anyway
+        windows_per_epoch = len(windows) if self.use_tiles else len(windows) // batch_size * batch_size
+        return WindowSampler(windows, self.config.random_seed, windows_per_epoch)
 
-        start_index = lambda: self.validation_start_index(validation_split) if validation else 0
-        index_cond = lambda idx: idx < self.num_samples if validation else idx < floor(self.num_samples * (1.0 - validation_split))
+    #------------------------------------------------------------------------------------------------
+    def batch_sample_shape(self):
+        """ [sequence_length, (z,) y, x, c] of one sample of generator_ae: the full field or a tile with the global information channels """
+        concat_depth = sum(self.depth)
+        if self.use_tiles:
+            tile_size = self.tile_generator.tile_size
+            return [self.sequence_length] + ([tile_size[2]] if self.is_3d else []) + [tile_size[1], tile_size[0], concat_depth + (2 if self.tiles_use_global else 0)]
+        return [self.sequence_length] + ([self.data_res_z] if self.is_3d else []) + [self.data_res_y, self.data_res_x, concat_depth]
+
+    #------------------------------------------------------------------------------------------------
+    def generator_ae(self, batch_size, validation_split=0.1, validation=False, multitile=False, field_mask=None, drop_remainder=False):
+        """ generator for use with keras __fit_generator__ function. runs in its own thread.
+            field_mask (sequence_length, data types) selects the fields that are read, all others stay zero (see fill_sequence).
+            drop_remainder discards the partial last validation batch, see steps_per_epoch """
+        assert self.dataset_valid, "Dataset was created with no samples..."
 
-        index = start_index()
+        if self.data_backend == "tfdata" and not multitile and not self.tiles_use_global:
+            from keras_data_tf import TFDataPipeline
+            yield from TFDataPipeline(self).generator(batch_size, validation_split, validation, field_mask, drop_remainder)
+            return
+
+        if field_mask is not None and self.use_tiles:
+            # tiles are drawn where the last channel of the middle frame is not empty
+            field_mask = field_mask.copy()
+            field_mask[int(self.sequence_length / 2), -1] = True
+
+        sampler = self.window_sampler(batch_size, validation_split, validation)
+        assert sampler.windows_per_epoch > 0, ("No {} windows of length {} for batch size {}".format("validation" if validation else "train", self.sequence_length, batch_size))
+        # chunks of whole batches keep the batch order of a single process when sharded over loader processes;
+        # validation epochs end with a partial batch and are not sharded (single loader process)
+        windows = sampler.stream(1 if self.use_tiles else batch_size, *self.shard, epoch_end=validation)
+        # validation tiles are the same in every epoch
+        rng = np.random.RandomState(self.config.random_seed) if validation else self.rng
+
+        # batches are filled in place; yielded batches may still wait in the keras queue, hence a ring of buffers is used
+        concat_depth = sum(self.depth)
+        sample_shape = [self.sequence_length] + ([self.data_res_z] if self.is_3d else []) + [self.data_res_y, self.data_res_x, concat_depth]
+        batch_sample_shape = self.batch_sample_shape()
+        if self.use_tiles:
+            # sequences are written into the interior of a buffer padded once for all tiles with empty parts on the borders
+            x_padded, x__ = self.tile_generator.padded_buffer(sample_shape, self.is_3d, out_of_bounds_fac=3)
+            y__ = np.empty((self.sequence_length, self.supervised_param_count), dtype=np.float32)
+        # zero initialized: fields left out by field_mask are never written
+        x_buffers = [np.zeros([batch_size] + batch_sample_shape, dtype=np.float32) for _ in range(self.batch_buffer_count)]
+        y_buffers = [np.empty((batch_size, self.sequence_length, self.supervised_param_count), dtype=np.float32) for _ in range(self.batch_buffer_count)]
+        buffer_idx = 0
+        # tiles of the last sample that did not fit into the previous batch
+        carry = []
 
         while True:
-            x = []
-            y = []
-            while len(x) < batch_size:
-                if not index_cond(index):
-                    index = start_index()
-
-                random_idx = self.random_indices[index]
-                if not self.sample_is_valid_for_timewindow(random_idx):
-                    index += 1
-                    continue
-
-                file_name = []
-                dir_name = []
-                cur_paths = self.paths[random_idx]
-                for i_d, data_type in enumerate(self.data_type):
-                    file_name.append(cur_paths[i_d])
-                    dir_name.append(os.path.dirname(file_name[-1]))
-                idx = os.path.basename(file_name[-1]).split('.')[0].split('_')
-
-                def getSequenceData(self, file_name, dir_name, idx):
-                    t = int(idx[1])
-                    x__ = []
-                    y__ = []
-                    for i in range(self.sequence_length):
-                        t_ = t+i
-                        x_ = None
-                        y_ = None
-                        for i_d, data_type in enumerate(self.data_type):
-                            file_name = os.path.join(dir_name[i_d], idx[0] + '_%d.npz' % t_)
-                            x_t, y_t = preprocess(file_name, data_type, self.x_range[i_d], self.y_range, den_inflow="density" in self.data_type)
-                            if x_ is None:
-                                x_ = x_t
-                            else:
-                                x_ = np.concatenate((x_,x_t), axis=-1)
-                            if y_ is None:
-                                y_ = y_t
-                            # The following is not necessary, since it only contains the supervised part (-> it is equal for all data types)
-                            #else:
-                            #    y_ = np.concatenate((y_,y_t), axis=-1)
-                        x__.append(x_)
-                        y__.append(y_)
-                    return x__, y__
+            x = x_buffers[buffer_idx]
+            y = y_buffers[buffer_idx]
+            buffer_idx = (buffer_idx + 1) % self.batch_buffer_count
+            b = 0
+            while carry and b < batch_size:
+                x[b], y[b] = carry.pop(0)
+                b += 1
+            while b < batch_size:
+                sample_idx = next(windows)
+                if sample_idx is None:
+                    # end of the validation epoch
+                    rng.seed(self.config.random_seed)
+                    if b == 0 or drop_remainder:
+                        b = 0
+                        continue
+                    break
+                scene = int(self.paths.scene[sample_idx])
+                t = int(self.paths.frame[sample_idx])
 
                 if self.use_tiles:
-                    x__, y__ = getSequenceData(self, file_name, dir_name, idx)
-                    x__ = np.array(x__, dtype=np.float32)
-                    tile_count = 0
-                    while tile_count < self.tiles_per_sample:
-                        # get also tiles with empty parts on the borders
-                        self.tile_generator.generateRandomTile(out_of_bounds_fac=3)
-                        if x__[0].ndim == 4:
-                            x_tile = self.tile_generator.cut_tile(x__)
+                    self.fill_sequence(x__, y__, scene, t, field_mask)
+                    if self.tiles_use_global:
+                        # global information: the density downscale is the same for all tiles of a sequence
+                        density_channel = 3 if self.is_3d else 2
+                        x__downscale = self.tile_generator.downscale(x__[..., density_channel:density_channel+1], self.is_3d)
+                    # get also tiles with empty parts on the borders, but only where something is happening in the middle frame;
+                    # drawing uniformly from the valid starts keeps the distribution of rejection sampling at a fixed cost
+                    valid_starts = self.tile_generator.valid_tile_starts(x_padded[int(self.sequence_length / 2), ..., -1], -0.99, out_of_bounds_fac=3)
+                    if len(valid_starts) > 0:
+                        starts = valid_starts[rng.randint(len(valid_starts), size=self.tiles_per_sample)]
+                    else:
+                        # empty sequence: take any tiles instead of spinning forever
+                        starts = self.tile_generator.random_tile_starts(self.tiles_per_sample, rng, out_of_bounds_fac=3)
+
+                    for start, x_tile in zip(starts, self.tile_generator.cut_tiles(x_padded, starts, self.is_3d, out_of_bounds_fac=3)):
+                        if b < batch_size:
+                            x_dst = x[b]
+                            y[b] = y__
+                            b += 1
                         else:
-                            x_tile = self.tile_generator.cut_tile_2d(x__)
-                        # check if something is happening in the tile
-                        tile_dim = self.tile_generator.x_dim * self.tile_generator.y_dim * self.tile_generator.z_dim
-                        if np.sum(x_tile[int(self.sequence_length / 2), ..., -1]) / tile_dim  < -0.99:
-                            continue
+                            x_dst = np.empty(batch_sample_shape, dtype=np.float32)
+                            carry.append((x_dst, y__.copy()))
+                        x_dst[..., :concat_depth] = x_tile
 
                         # Append global information
                         if self.tiles_use_global:
-                            x_mult = int(self.tile_generator.data_dim[0] / self.tile_generator.tile_size[0])
-                            y_mult = int(self.tile_generator.data_dim[1] / self.tile_generator.tile_size[1])
-                            z_mult = int(self.tile_generator.data_dim[2] / self.tile_generator.tile_size[2])
-                            tile_flag_shape = list(x__.shape)
-                            tile_flag_shape[-1] = 1
-                            if x__[0].ndim == 4:
-                                tile_flag = np.zeros(tile_flag_shape)
-                                tile_flag = self.tile_generator.set_constant(tile_flag, slice(0,None,1), 1)
-                                # 3:4 -> capture only density part
-                                x__downscale = measure.block_reduce(x__[...,3:4], (1, z_mult, y_mult, x_mult, 1), np.mean)
-                                tile_flag_downscale = measure.block_reduce(tile_flag, (1, z_mult, y_mult, x_mult, 1), np.mean)
-                            else:
-                                tile_flag = np.zeros(tile_flag_shape)
-                                tile_flag = self.tile_generator.set_constant_2d(tile_flag, slice(0,None,1), 1)
-                                # 2:3 -> capture only density part
-                                x__downscale = measure.block_reduce(x__[...,2:3], (1, y_mult, x_mult, 1), np.mean)
-                                tile_flag_downscale = measure.block_reduce(tile_flag, (1, y_mult, x_mult, 1), np.mean)
-                            x_tile = np.append(x_tile, x__downscale, axis=-1)
-                            x_tile = np.append(x_tile, tile_flag_downscale, axis=-1)
-
-                        x.append(x_tile)
-                        y.append(y__)
-                        tile_count += 1
+                            x_dst[..., concat_depth:concat_depth+1] = x__downscale
+                            x_dst[..., concat_depth+1:] = self.tile_generator.tile_flag_downscale(start, self.is_3d)
                 else:
-                    x__, y__ = getSequenceData(self, file_name, dir_name, idx)
-                    x.append(x__)
-                    y.append(y__)
-
-                index += 1
-
-            x = np.array(x, dtype=np.float32)
-            if x.shape[1] == 1:
-                x = np.squeeze(x, axis=1)
-            y = np.array(y, dtype=np.float32)
-            if y.shape[1] == 1:
-                y = np.squeeze(y, axis=1)
+                    self.fill_sequence(x[b], y[b], scene, t, field_mask)
+                    b += 1
+
+            if b < batch_size:
+                x = x[:b]
+                y = y[:b]
+            if self.sequence_length == 1:
+                x = x[:, 0]
+                y = y[:, 0]
             # AE: y = x
             if self.use_tiles:
                 global_tiles_endmarker = -2 if self.tiles_use_global else None
                 if multitile and self.tile_multitile_border > 0:
-                    if self.is_3d:
-                        assert False, "Not implemented!"
-                    else:
-                        border_region_start = self.tile_generator.tile_size[0] // 2 - 1 - self.tile_multitile_border
-                        border_region_end = self.tile_generator.tile_size[0] //2 + self.tile_multitile_border
-                        x_border = x[:batch_size, :, border_region_start:border_region_end, :global_tiles_endmarker]
-                        border_region_start = self.tile_generator.tile_size[1] // 2 - 1 - self.tile_multitile_border
-                        border_region_end = self.tile_generator.tile_size[1] //2 + self.tile_multitile_border
-                        y_border = x[:batch_size, border_region_start:border_region_end, :, :global_tiles_endmarker]
-                    yield x[:batch_size], [x[:batch_size,...,:global_tiles_endmarker], y[:batch_size], y_border, x_border]
+                    # bands around the tile center; in 3D the x and y bands span all z slices
+                    y_axis = x.ndim - 3
+                    border_region_start = self.tile_generator.tile_size[0] // 2 - 1 - self.tile_multitile_border
+                    border_region_end = self.tile_generator.tile_size[0] //2 + self.tile_multitile_border
+                    x_border = x[(slice(None),) * (y_axis + 1) + (slice(border_region_start, border_region_end), slice(None, global_tiles_endmarker))]
+                    border_region_start = self.tile_generator.tile_size[1] // 2 - 1 - self.tile_multitile_border
+                    border_region_end = self.tile_generator.tile_size[1] //2 + self.tile_multitile_border
+                    y_border = x[(slice(None),) * y_axis + (slice(border_region_start, border_region_end), Ellipsis, slice(None, global_tiles_endmarker))]
+                    yield x, [x[...,:global_tiles_endmarker], y, y_border, x_border]
                 else:
-                    yield x[:batch_size], [x[:batch_size,...,:global_tiles_endmarker], y[:batch_size]]
+                    yield x, [x[...,:global_tiles_endmarker], y]
             else:
-                yield x[:batch_size], [x[:batch_size], y[:batch_size]]
-            x = x[batch_size:]
-            y = y[batch_size:]
+                yield x, [x, y]
 
     #------------------------------------------------------------------------------------------------
     def generator_ae_tile_sequence(self, batch_size, validation_split=0.1, validation=False, ls_split_loss=False, advection_loss=False):
@@ -457,26 +993,18 @@ class BatchManager(object):
             # x = np.random.rand(80, 4, 128, 96, 2); (b,s,y,x,c)
             # y = [np.random.rand(80, 128, 96, 2), np.random.rand(80, 2, 1), np.random.rand(80, 4, 32)]
 
-            # transform to tile based indexing (b,s,t,y/3,x/3,c)
-            tile_dim_x = int(self.tile_generator.tile_size[0] / 3)
-            tile_dim_y = int(self.tile_generator.tile_size[1] / 3)
-
-            input_tiles = None
-            for y_i in range(0,3):
-                for x_i in range(0,3):
-                    if input_tiles is None:
-                        input_tiles = np.expand_dims(input_array[:, :, y_i*tile_dim_y:(y_i+1)*tile_dim_y, x_i*tile_dim_x:(x_i+1)*tile_dim_x], axis=2)
-                    else:
-                        input_tiles = np.concatenate([input_tiles, np.expand_dims(input_array[:, :, y_i*tile_dim_y:(y_i+1)*tile_dim_y, x_i*tile_dim_x:(x_i+1)*tile_dim_x], axis=2)], axis=2)
+            # transform to tile based indexing (b,s,t,(z/3,)y/3,x/3,c)
+            input_tiles = self.tile_generator.split_grid(input_array, [3, 3, 3], self.is_3d)
+            center_tile = input_tiles.shape[2] // 2
 
             # with w = 1 -> t0, t1, t2 is needed
             input_v_d_t0_t1 = input_tiles[:, :self.w_num+1]
             input_list.append(input_v_d_t0_t1)
             
-            v_d_t1_gt = input_tiles[:, self.w_num, 4]
+            v_d_t1_gt = input_tiles[:, self.w_num, center_tile]
             output_list.append(v_d_t1_gt)
             if advection_loss:
-                d_t2_gt = input_tiles[:, self.w_num+1, 4, ..., 3 if self.is_3d else 2]
+                d_t2_gt = input_tiles[:, self.w_num+1, center_tile, ..., 3 if self.is_3d else 2]
                 d_t2_gt = d_t2_gt[...,np.newaxis]
                 output_list.append(d_t2_gt)
 
@@ -484,61 +1012,114 @@ class BatchManager(object):
 
 
     #------------------------------------------------------------------------------------------------
-    def generator_ae_sequence(self, batch_size, validation_split=0.1, validation=False, decode_predictions=False, ls_prediction_loss=False, ls_split_loss=False, train_prediction_only=False, advection_loss=False):
+    def generator_ae_sequence(self, batch_size, validation_split=0.1, validation=False, decode_predictions=False, ls_prediction_loss=False, ls_split_loss=False, train_prediction_only=False, advection_loss=False, drop_remainder=False):
         """ generator for use with keras __fit_generator__ function. runs in its own thread """
         assert self.dataset_valid, "Dataset was created with no samples..."
 
-        if decode_predictions:
-            pred_shape = [batch_size] + self.feature_dim[1:] 
-            pred_dummy = np.zeros(pred_shape, dtype=np.float32)
-        else:
-            pred_dummy = np.zeros((batch_size, (self.sequence_length-self.w_num) * 2, self.z_num), dtype=np.float32)
-        if ls_prediction_loss:
-            pred_dummy_ls = np.zeros((batch_size, (self.sequence_length-self.w_num) * 2, self.z_num), dtype=np.float32)
-        if ls_split_loss:
-            pred_dummy_ls_split = np.zeros((batch_size, self.z_num), dtype=np.float32)
-        gen_ae = self.generator_ae(batch_size, validation_split=validation_split, validation=validation)
+        output_spec = self.sequence_output_spec(batch_size, decode_predictions, ls_prediction_loss, ls_split_loss, train_prediction_only, advection_loss)
+        print("generator_ae_sequence outputs: {}".format(", ".join(name for name, _, _ in output_spec)))
+        field_mask = self.sequence_field_mask(decode_predictions, ls_prediction_loss, advection_loss)
+        gen_ae = self.generator_ae(batch_size, validation_split=validation_split, validation=validation, field_mask=field_mask, drop_remainder=drop_remainder)
+
+        use_inflow = "inflow" in self.data_type
+        if use_inflow:
+            # denormalized inflow is written into a ring of buffers like the batches of generator_ae
+            inflow_fac = self.data_type_normalization["inflow"]
+            inflow_buffers = [np.empty([batch_size] + self.batch_sample_shape()[:-1] + [1], dtype=np.float32) for _ in range(self.batch_buffer_count)]
+            buffer_idx = 0
         while True:
             input_array, [_, p] = next(gen_ae)
             # x = np.random.rand(80, 4, 128, 96, 2)
             # y = [np.random.rand(80, 128, 96, 2), np.random.rand(80, 2, 1), np.random.rand(80, 4, 32)]
-            #yield [input_array, np.zeros((batch_size, 512)), np.zeros((batch_size, 512)), np.zeros((batch_size, 512)), np.zeros((batch_size, 512))], [input_array[:,0], p[:,0], pred_dummy]
+            input_array_inflow = None
+            if use_inflow:
+                # the last validation batch may be smaller
+                input_array_inflow = inflow_buffers[buffer_idx][:input_array.shape[0]]
+                buffer_idx = (buffer_idx + 1) % self.batch_buffer_count
+                np.multiply(input_array[..., -1:], inflow_fac, out=input_array_inflow)
+            yield self._sequence_batch(input_array, p, output_spec, input_array_inflow)
 
-            input_array_w_passive = input_array[..., :min(4 if self.is_3d else 3, input_array.shape[-1])]
-            if "inflow" in self.data_type:
-                input_array_inflow = input_array[..., -1:]
+    #------------------------------------------------------------------------------------------------
+    def _sequence_batch(self, input_array, p, output_spec, input_array_inflow=None):
+        """ inputs and targets of generator_ae_sequence; only views of the batch and of the preallocated dummies, see sequence_output_spec """
+        n = input_array.shape[0]
+        sources = {"x": input_array[..., :min(4 if self.is_3d else 3, input_array.shape[-1])], "p": p}
+        output_array = [sources[source][index] if isinstance(source, str) else source[:n] for _, source, index in output_spec]
+        if input_array_inflow is not None:
+            return [sources["x"], p, input_array_inflow], output_array
+        return [input_array, p], output_array
 
-            if train_prediction_only:
-                output_array = []
-            else:
-                output_array = [input_array_w_passive[:,0]]
-            if decode_predictions:
-                if self.config.only_last_prediction:
-                    output_array.append(input_array_w_passive[:,-1:])
-                else:
-                    output_array.append(input_array_w_passive[:,-(self.sequence_length-self.w_num):])
-            else:
-                output_array.append(pred_dummy)
-            if not train_prediction_only:
-                output_array.append(p[:,0])
-            if ls_prediction_loss:
-                output_array.append(pred_dummy_ls)
-            if ls_split_loss and not train_prediction_only:
-                output_array.append(pred_dummy_ls_split)
-                output_array.append(pred_dummy_ls_split)
-            if advection_loss:
-                # ranges from w_num+1 to rec_pred -> current gt + 1
-                # extract only GT values of passive quantity
-                if self.config.only_last_prediction:
-                    output_array.append(input_array_w_passive[:,-1:, ..., -1:])
-                else:
-                    output_array.append(input_array_w_passive[:, -(self.sequence_length - (self.w_num+1)):, ..., -1:])
+    #------------------------------------------------------------------------------------------------
+    def sequence_batch_template(self, batch_size, decode_predictions=False, ls_prediction_loss=False, ls_split_loss=False, train_prediction_only=False, advection_loss=False):
+        """ a full generator_ae_sequence batch of broadcast zeros: the shapes and types of the batches without reading any data """
+        output_spec = self.sequence_output_spec(batch_size, decode_predictions, ls_prediction_loss, ls_split_loss, train_prediction_only, advection_loss)
+        x = np.broadcast_to(np.float32(0.0), [batch_size] + self.batch_sample_shape())
+        p = np.broadcast_to(np.float32(0.0), (batch_size, self.sequence_length, self.supervised_param_count))
+        inflow = np.broadcast_to(np.float32(0.0), [batch_size] + self.batch_sample_shape()[:-1] + [1]) if "inflow" in self.data_type else None
+        return self._sequence_batch(x, p, output_spec, inflow)
+
+    #------------------------------------------------------------------------------------------------
+    def sequence_loaders(self, batch_size, validation_split, num_worker, queue_depth=4, drop_remainder=False, **sequence_args):
+        """ (train, validation) PrefetchLoaders of generator_ae_sequence with the arguments sequence_args;
+            start them before keras/tf create their session, the loader processes are forked.
+            drop_remainder: fixed batch size of stateful models, see steps_per_epoch """
+        val_batch_size = batch_size if drop_remainder or self.validation_batch_size <= 0 else self.validation_batch_size
+        train_loader = PrefetchLoader(self, lambda: self.generator_ae_sequence(batch_size, validation_split, validation=False, **sequence_args),
+            self.sequence_batch_template(batch_size, **sequence_args), num_worker, queue_depth=queue_depth)
+        validation_loader = PrefetchLoader(self, lambda: self.generator_ae_sequence(val_batch_size, validation_split, validation=True, drop_remainder=drop_remainder, **sequence_args),
+            self.sequence_batch_template(val_batch_size, **sequence_args), 1, queue_depth=queue_depth)
+        return train_loader, validation_loader
+
+    #------------------------------------------------------------------------------------------------
+    def sequence_output_spec(self, batch_size, decode_predictions=False, ls_prediction_loss=False, ls_split_loss=False, train_prediction_only=False, advection_loss=False):
+        """ targets of generator_ae_sequence in the order of the RecursivePrediction outputs as (name, source, index):
+            source "x" (velocity and passive quantity) or "p" (supervised params) is indexed with index,
+            an array source is a zero dummy target allocated once and cut to the batch length """
+        last_prediction = self.config.only_last_prediction
+        spec = []
+        if not train_prediction_only:
+            spec.append(("ae", "x", (slice(None), 0)))
+        if decode_predictions:
+            spec.append(("prediction", "x", (slice(None), slice(-1, None) if last_prediction else slice(self.w_num, None))))
+        else:
+            # the latent prediction loss compares parts of the model output
+            spec.append(("prediction_dummy", np.zeros((batch_size, (self.sequence_length-self.w_num) * 2, self.z_num), dtype=np.float32), None))
+        if not train_prediction_only:
+            spec.append(("sup_param", "p", (slice(None), 0)))
+        if ls_prediction_loss:
+            spec.append(("ls_prediction_dummy", np.zeros((batch_size, (self.sequence_length-self.w_num) * 2, self.z_num), dtype=np.float32), None))
+        if ls_split_loss and not train_prediction_only:
+            ls_split_dummy = np.zeros((batch_size, self.z_num), dtype=np.float32)
+            spec.append(("ls_split_vel_dummy", ls_split_dummy, None))
+            spec.append(("ls_split_den_dummy", ls_split_dummy, None))
+        if advection_loss:
+            # GT of the passive quantity from w_num+1 on -> current gt + 1
+            spec.append(("advection", "x", (slice(None), slice(-1, None) if last_prediction else slice(self.w_num+1, None), Ellipsis, slice(-1, None))))
+        return spec
 
+    #------------------------------------------------------------------------------------------------
+    def sequence_field_mask(self, decode_predictions=False, ls_prediction_loss=False, advection_loss=False):
+        """ (sequence_length, data types) mask of the fields generator_ae_sequence passes on to RecursivePrediction:
+            the encoder only sees the first w_num frames (all with ls_prediction_loss), the decoded predictions and the
+            advection GT the later ones; with inflow only velocity, the passive quantity and inflow are used """
+        channel_end = np.cumsum(self.depth)
+        channel_start = channel_end - np.array(self.depth)
+        passive_end = min(4 if self.is_3d else 3, channel_end[-1])
+        input_end = passive_end if "inflow" in self.data_type else channel_end[-1]
+        last_prediction = self.config.only_last_prediction
+        field_mask = np.zeros((self.sequence_length, len(self.data_type)), dtype=bool)
+        def need(frames, c0, c1):
+            field_mask[frames] |= (channel_start < c1) & (channel_end > c0)
+
+        need(slice(None) if ls_prediction_loss else slice(0, self.w_num), 0, input_end)
+        if decode_predictions:
+            need(slice(-1, None) if last_prediction else slice(self.w_num, None), 0, passive_end)
+        if advection_loss:
+            need(slice(-1, None) if last_prediction else slice(self.w_num+1, None), passive_end-1, passive_end)
             if "inflow" in self.data_type:
-                input_array_inflow = self.denorm(input_array_inflow, "inflow")
-                yield [input_array_w_passive, p, input_array_inflow], output_array
-            else:
-                yield [input_array, p], output_array
+                # inflow regions of the advected frames
+                need(slice(self.w_num, None), channel_end[-1]-1, channel_end[-1])
+        return field_mask
 
     #------------------------------------------------------------------------------------------------
     def generator_ae_sequence_clean(self, batch_size, validation_split=0.1, validation=False, decode_predictions=False, ls_prediction_loss=False):
@@ -557,7 +1138,7 @@ class BatchManager(object):
             input_array, [_, p] = next(gen_ae)
 
             output_array = [input_array[:,0]]
-            output_array.append(pred_dummy)
+            output_array.append(pred_dummy[:input_array.shape[0]])
             output_array.append(p[:,0])
             output_array.append(p[:,0])
 
@@ -572,7 +1153,7 @@ class BatchManager(object):
         gen_ae = self.generator_ae(batch_size, validation_split=validation_split, validation=validation)
         while True:
             input_array, [_, p] = next(gen_ae)
-            output_array = [input_array, p, pred_dummy, pred_dummy]
+            output_array = [input_array, p, pred_dummy[:input_array.shape[0]], pred_dummy[:input_array.shape[0]]]
             yield input_array, output_array
 
     #------------------------------------------------------------------------------------------------
@@ -588,25 +1169,69 @@ class BatchManager(object):
             yield input_array, output_array
 
     #------------------------------------------------------------------------------------------------
-    def sample_is_valid_for_timewindow(self, id, dt=0):
-        file_name = self.paths[id][dt]
+    def fill_sequence(self, x, y, scene, t, field_mask=None):
+        """ writes frames [t, t+sequence_length) of a scene into x (seq, ..., c) and their supervised params into y (seq, p);
+            with field_mask (seq, data types) only the set fields are read, the params are always written """
+        if self.packed is not None:
+            self.packed.read_sequence(x, y, scene, t, field_mask)
+            return
+        for i in range(self.sequence_length):
+            c = 0
+            y_t = None
+            for i_d in range(len(self.data_type)):
+                if field_mask is None or field_mask[i, i_d]:
+                    x_t, y_t = self.load_frame(scene, t+i, i_d)
+                    x[i, ..., c:c+self.depth[i_d]] = x_t
+                c += self.depth[i_d]
+            if self.param_table is None:
+                # supervised params are equal for all data types
+                y[i] = y_t if y_t is not None else self.load_params(scene, t+i)
+        if self.param_table is not None:
+            y[...] = self.param_table[scene, t:t+self.sequence_length]
 
-        filename = os.path.basename(file_name).split('.')[0]
-        idx = filename.split('_')
-        t = int(idx[1])
-        max_frame = self.y_range[1][1]
-        if t <= max_frame - self.sequence_length + 1:
-            return True
-        return False
+    #------------------------------------------------------------------------------------------------
+    def load_frame(self, scene, frame, i_d):
+        """ preprocessed (x, y) of one frame of data type index i_d; served from the packed store or the frame cache if enabled """
+        if self.packed is not None:
+            return self.packed.frame(scene, frame, i_d)
+        key = (scene, frame, i_d)
+        if self.frame_cache is not None:
+            entry = self.frame_cache.get(key)
+            if entry is not None:
+                return entry
+        data_type = self.data_type[i_d]
+        file_name = os.path.join(self.root, data_type[0], "{}_{}.npz".format(scene, frame))
+        x, y = preprocess(file_name, data_type, self.x_range[i_d], self.y_range, den_inflow="density" in self.data_type)
+        if self.frame_cache is not None:
+            # cached frames are shared between windows -> must not be modified in place
+            x.flags.writeable = False
+            self.frame_cache.put(key, (x, y), x.nbytes)
+        return x, y
+
+    #------------------------------------------------------------------------------------------------
+    def load_params(self, scene, frame):
+        """ normalized supervised params of one frame without reading its fields """
+        file_name = os.path.join(self.root, self.data_type[0][0], "{}_{}.npz".format(scene, frame))
+        with frame_codec.load(file_name) as data:
+            return preprocess_params(data['y'], self.y_range)
+
+    #------------------------------------------------------------------------------------------------
+    def reseed(self, random_seed, shard=0, num_shards=1):
+        """ reseeds all random sources and selects the share of windows drawn by a loader worker """
+        self.rng = np.random.RandomState(random_seed)
+        np.random.seed(random_seed)
+        seed(random_seed)
+        self.shard = (shard, num_shards)
+
+    #------------------------------------------------------------------------------------------------
+    def sample_is_valid_for_timewindow(self, id, dt=0):
+        return self.valid_mask[id]
 
     #------------------------------------------------------------------------------------------------
     def sample(self, num, validation_split=0.1, validation=False, file_based=True):
-        val_start_idx = self.validation_start_index(validation_split, file_based=file_based)
-        max_idx = len(self.paths)
-        choice_range = max_idx - val_start_idx if validation else val_start_idx
-        idx = self.rng.choice(choice_range, num).tolist()
-        offset = val_start_idx if validation else 0
-        return [self.paths[i+offset] for i in idx]
+        # file_based is kept for compatibility, samples are always drawn from the scenes of dataset_split
+        idx = self.rng.choice(self.dataset_split(validation_split).samples(validation), num).tolist()
+        return [self.paths[i] for i in idx]
 
     #------------------------------------------------------------------------------------------------
     def to_vel(self, x, dt=0):
@@ -652,17 +1277,17 @@ class BatchManager(object):
 
     #------------------------------------------------------------------------------------------------
     def batch_with_name(self, b_num, validation_split=0.1, validation=False, randomized=True, file_based=True, adjust_to_batch=False, data_types=["velocity", "density", "levelset", "inflow"], use_tiles=False):
+        # samples of the same scenes as the validation generators, see dataset_split
+        samples = self.dataset_split(validation_split).samples(validation)
         if adjust_to_batch:
-            paths = self.paths[:int(len(self.paths) / b_num) * b_num]
-        else:
-            paths = self.paths
-        assert len(paths) % b_num == 0, "Length: {}; Batch Size: {}".format(len(paths), b_num)
+            samples = samples[:int(len(samples) / b_num) * b_num]
+        if not randomized:
+            assert len(samples) % b_num == 0, "Length: {}; Batch Size: {}".format(len(samples), b_num)
         x_batch = []
         y_batch = []
         sup_params_batch = []
-        val_start_idx = self.validation_start_index(validation_split, file_based=file_based) if validation else 0
         while True:
-            for i, filepath in enumerate( self.sample(b_num, validation_split=validation_split, file_based=file_based, validation=validation) if randomized else paths[val_start_idx:] ):
+            for i, filepath in enumerate( self.sample(b_num, validation_split=validation_split, file_based=file_based, validation=validation) if randomized else (self.paths[j] for j in samples) ):
                 x = None
                 sup_params = None
                 for i_d, data_type in enumerate(self.data_type):
@@ -682,23 +1307,10 @@ class BatchManager(object):
 
                     # Append global information
                     if self.tiles_use_global:
-                        x_mult = int(self.tile_generator.data_dim[0] / self.tile_generator.tile_size[0])
-                        y_mult = int(self.tile_generator.data_dim[1] / self.tile_generator.tile_size[1])
-                        z_mult = int(self.tile_generator.data_dim[2] / self.tile_generator.tile_size[2])
-                        tile_flag_shape = list(x.shape)
-                        tile_flag_shape[-1] = 1
-                        if x.ndim == 4:                                
-                            tile_flag = np.zeros(tile_flag_shape)
-                            tile_flag[self.tile_generator.z_start:self.tile_generator.z_end, self.tile_generator.y_start:self.tile_generator.y_end, self.tile_generator.x_start:self.tile_generator.x_end, :] = 1
-                            # 3:4 -> capture only density part
-                            x_downscale = measure.block_reduce(x[...,3:4], (z_mult, y_mult, x_mult, 1), np.mean)
-                            tile_flag_downscale = measure.block_reduce(tile_flag, (z_mult, y_mult, x_mult, 1), np.mean)
-                        else:
-                            tile_flag = np.zeros(tile_flag_shape)
-                            tile_flag[self.tile_generator.y_start:self.tile_generator.y_end, self.tile_generator.x_start:self.tile_generator.x_end, :] = 1
-                            # 2:3 -> capture only density part
-                            x_downscale = measure.block_reduce(x[...,2:3], (y_mult, x_mult, 1), np.mean)
-                            tile_flag_downscale = measure.block_reduce(tile_flag, (y_mult, x_mult, 1), np.mean)
+                        # 3:4 / 2:3 -> capture only density part
+                        density_channel = 3 if x.ndim == 4 else 2
+                        x_downscale = self.tile_generator.downscale(x[..., density_channel:density_channel+1], x.ndim == 4)
+                        tile_flag_downscale = self.tile_generator.tile_flag_downscale([self.tile_generator.x_start, self.tile_generator.y_start, self.tile_generator.z_start], x.ndim == 4)
                         x_tile = np.append(x_tile, x_downscale, axis=-1)
                         x_tile = np.append(x_tile, tile_flag_downscale, axis=-1)
                     x = x_tile
@@ -713,12 +1325,133 @@ class BatchManager(object):
                     y_batch.clear()
                     sup_params_batch.clear()
 
+### ============ Class ==============
+class PrefetchLoader(object):
+    """ runs a BatchManager generator in num_worker forked processes and hands the batches over through shared memory;
+        a yielded batch is a view into a shared slot and stays valid until the next batch is requested.
+        batch_template is a full size batch (e.g. BatchManager.sequence_batch_template) that defines the layout of the slots,
+        batches may be smaller (last validation batch) """
+    def __init__(self, batch_manager, generator_fn, batch_template, num_worker, queue_depth=4, random_seed=None, poll_timeout=10.0):
+        self.num_worker = num_worker
+        self.queue_depth = queue_depth
+        self.poll_timeout = poll_timeout
+        if random_seed is None:
+            random_seed = batch_manager.config.random_seed
+
+        arrays, self.layout = _flatten_batch(batch_template)
+        self.specs = []
+        slot_bytes = 0
+        for a in arrays:
+            self.specs.append((slot_bytes, a.shape, a.dtype))
+            slot_bytes += (a.nbytes + 63) // 64 * 64
+        self.slot_bytes = slot_bytes
+
+        ctx = multiprocessing.get_context('fork')
+        self.slots = [[ctx.RawArray('b', slot_bytes) for _ in range(queue_depth)] for _ in range(num_worker)]
+        self.free_queues = [ctx.Queue() for _ in range(num_worker)]
+        self.ready_queues = [ctx.Queue() for _ in range(num_worker)]
+        self.workers = []
+        for worker_id in range(num_worker):
+            for slot_id in range(queue_depth):
+                self.free_queues[worker_id].put(slot_id)
+            worker = ctx.Process(target=self._worker_loop, args=(batch_manager, generator_fn, worker_id, random_seed + worker_id + 1))
+            worker.daemon = True
+            worker.start()
+            self.workers.append(worker)
+
+        self.cur_worker = 0
+        self.pending = None
+        print("PrefetchLoader: {} workers, queue depth {}, {:.1f} MB per batch".format(num_worker, queue_depth, slot_bytes / 1048576.0))
+
+    def _views(self, worker_id, slot_id):
+        buf = self.slots[worker_id][slot_id]
+        return [np.frombuffer(buf, dtype=dtype, count=int(np.prod(shape)), offset=offset).reshape(shape) for offset, shape, dtype in self.specs]
+
+    def _worker_loop(self, batch_manager, generator_fn, worker_id, worker_seed):
+        # ctrl+c is handled by the training process
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        try:
+            batch_manager.reseed(worker_seed, worker_id, self.num_worker)
+            generator = generator_fn()
+            while True:
+                slot_id = self.free_queues[worker_id].get()
+                arrays, _ = _flatten_batch(next(generator))
+                batch_len = len(arrays[0])
+                for view, a in zip(self._views(worker_id, slot_id), arrays):
+                    assert a.shape[1:] == view.shape[1:] and len(a) <= len(view), ("batch shape {} does not match the template {}".format(a.shape, view.shape))
+                    view[:batch_len] = a
+                self.ready_queues[worker_id].put((slot_id, batch_len))
+        except Exception:
+            self.ready_queues[worker_id].put(traceback.format_exc())
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        # workers are consumed round-robin -> the batch order only depends on the seeds
+        if self.pending is not None:
+            self.free_queues[self.pending[0]].put(self.pending[1])
+        worker_id = self.cur_worker
+        self.cur_worker = (self.cur_worker + 1) % self.num_worker
+        while True:
+            try:
+                ready = self.ready_queues[worker_id].get(timeout=self.poll_timeout)
+                break
+            except queue.Empty:
+                # a killed worker (e.g. out of memory) can not report its failure
+                worker = self.workers[worker_id]
+                assert worker.is_alive(), ("PrefetchLoader worker {} died with exit code {}".format(worker_id, worker.exitcode))
+        assert not isinstance(ready, str), ("PrefetchLoader worker {} failed:\n{}".format(worker_id, ready))
+        slot_id, batch_len = ready
+        self.pending = (worker_id, slot_id)
+        return _unflatten_batch([view[:batch_len] for view in self._views(worker_id, slot_id)], self.layout)
+
+    def next(self):
+        return self.__next__()
+
+    def close(self):
+        for worker in self.workers:
+            worker.terminate()
+            worker.join()
+        self.workers = []
+
+#------------------------------------------------------------------------------------------------
+def _flatten_batch(batch):
+    """ (inputs, outputs) with array or list entries -> flat array list and layout """
+    arrays = []
+    layout = []
+    for part in batch:
+        if isinstance(part, np.ndarray):
+            layout.append(None)
+            arrays.append(part)
+        else:
+            layout.append(len(part))
+            arrays.extend([np.asarray(a) for a in part])
+    return arrays, layout
+
+#------------------------------------------------------------------------------------------------
+def _unflatten_batch(arrays, layout):
+    batch = []
+    i = 0
+    for part_len in layout:
+        if part_len is None:
+            batch.append(arrays[i])
+            i += 1
+        else:
+            batch.append(arrays[i:i+part_len])
+            i += part_len
+    return tuple(batch)
+
 #------------------------------------------------------------------------------------------------
 def preprocess(file_path, data_type, x_range, y_range, den_inflow=False):
-    with np.load(file_path) as data:
+    with frame_codec.load(file_path) as data:
         x = data['x']
         y = data['y']
 
+    # datasets stored with --field_dtype=float16
+    if x.dtype == np.float16:
+        x = x.astype(np.float32)
+
     # horizontal flip
     if x.ndim == 4:
         # mirror y axis
@@ -737,6 +1470,10 @@ def preprocess(file_path, data_type, x_range, y_range, den_inflow=False):
     else:
         x /= x_range
 
+    return x, preprocess_params(y, y_range)
+
+#------------------------------------------------------------------------------------------------
+def preprocess_params(y, y_range):
     y_list = []
     # scenes and frames are needed in all scenes, hence we start at 2
     for i in range(0, len(y_range)-2):
@@ -746,7 +1483,7 @@ def preprocess(file_path, data_type, x_range, y_range, den_inflow=False):
         cur_sup_param = (cur_sup_param - cur_sup_range[0]) / (cur_sup_range[1] - cur_sup_range[0]) * 2.0 - 1.0
         y_list.append( cur_sup_param )
 
-    return x, y_list
+    return y_list
 
 #------------------------------------------------------------------------------------------------
 if __name__ == "__main__":
@@ -820,16 +1557,7 @@ if __name__ == "__main__":
         for a in output_array:
             print(a.shape)
 
-        def global_concat(x, t):
-            # first concat x axis for individual rows
-            c0 = np.concatenate([x[:, t, 0], x[:, t, 1], x[:, t, 2]], axis=2)
-            c1 = np.concatenate([x[:, t, 3], x[:, t, 4], x[:, t, 5]], axis=2)
-            c2 = np.concatenate([x[:, t, 6], x[:, t, 7], x[:, t, 8]], axis=2)
-            # then concat y axis
-            ct = np.concatenate([c0,c1,c2], axis=1)
-            return ct
-
-        global_img = global_concat(input_array[0], 1)
+        global_img = batch_manager.tile_generator.merge_grid(input_array[0][:, 1], [3, 3, 3], batch_manager.is_3d)
         print(global_img.shape)
         _save_img_keras_data(global_img, inf_loop+0, "./test/", batch_manager, "input")
 
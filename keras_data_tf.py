@@ -0,0 +1,217 @@
+import os
+
+import numpy as np
+import tensorflow as tf
+import keras.backend as K
+
+import frame_codec
+from keras_data import FrameCache
+
+### ============ Class ==============
+class TFDataPipeline(object):
+    """ tf.data version of BatchManager.generator_ae: frames are decoded in parallel, flipped, normalized and tiled by tf ops,
+        optionally cached and prefetched in TensorFlow's thread pool. windows, split, packed store, parameter table and field mask
+        are the ones of the BatchManager """
+    def __init__(self, batch_manager):
+        self.bm = batch_manager
+        config = batch_manager.config
+        try:
+            self.num_parallel_calls = config.tfdata_parallel_calls
+            self.cache = config.tfdata_cache
+            self.prefetch = config.loader_queue_depth
+        except AttributeError:
+            self.num_parallel_calls = 4
+            self.cache = ""
+            self.prefetch = 4
+        self.random_seed = config.random_seed
+        self.den_inflow = "density" in self.bm.data_type
+        # the packed store (or shared cache) holds normalized fields and params, the parameter table normalized params
+        self.packed = self.bm.packed
+        self.params_normalized = self.packed is not None or self.bm.param_table is not None
+        # training windows are read in random order, which tf's sequential cache can not serve -> the raw frames are kept in the
+        # frame cache of the BatchManager, bounded by --frame_cache_mb
+        self.frame_cache = None
+        if self.cache == "memory" and self.packed is None:
+            assert self.bm.frame_cache is not None, ("--tfdata_cache=memory keeps the frames in the frame cache, set --frame_cache_mb")
+            self.frame_cache = self.bm.frame_cache
+        assert not self.bm.tiles_use_global, ("tiles_use_global is not supported by the tfdata backend")
+
+        # shapes as stored by the scenes: [z,] y, x [, c]; the packed store always has a channel axis
+        spatial_shape = ([self.bm.data_res_z] if self.bm.is_3d else []) + [self.bm.data_res_y, self.bm.data_res_x]
+        self.raw_shapes = [spatial_shape + ([depth] if depth > 1 or self.packed is not None else []) for depth in self.bm.depth]
+
+    #--------------------------------------------
+    def _read_file(self, scene, frame, i_d):
+        """ raw field and supervised params of one data type of a frame """
+        key = ("tfdata", scene, frame, i_d)
+        if self.frame_cache is not None:
+            entry = self.frame_cache.get(key)
+            if entry is not None:
+                return entry
+        file_name = os.path.join(self.bm.root, self.bm.data_type[i_d][0], "{}_{}.npz".format(scene, frame))
+        with frame_codec.load(file_name) as data:
+            entry = (data['x'].astype(np.float32), self._raw_params(data['y']))
+        if self.frame_cache is not None:
+            self.frame_cache.put(key, entry, entry[0].nbytes)
+        return entry
+
+    #--------------------------------------------
+    def _raw_params(self, y):
+        return np.array([(y if len(self.bm.y_range) == 3 else y[i])[-1] for i in range(self.bm.supervised_param_count)], dtype=np.float32)
+
+    #--------------------------------------------
+    def _load_raw(self, scene, frame, read):
+        """ runs in tf.py_func; reads the data types set in read of one frame (all others are zero) and its supervised params """
+        fields = []
+        params = None
+        for i_d in range(len(self.bm.data_type)):
+            if not read[i_d]:
+                fields.append(np.zeros(self.raw_shapes[i_d], dtype=np.float32))
+            elif self.packed is not None:
+                fields.append(self.packed.fields[i_d][scene, frame].astype(np.float32))
+            else:
+                field, params = self._read_file(scene, frame, i_d)
+                fields.append(field)
+        if self.packed is not None:
+            params = self.packed.params[scene, frame]
+        elif self.bm.param_table is not None:
+            params = self.bm.param_table[scene, frame]
+        elif params is None:
+            # like BatchManager.load_params, only the params are read
+            with frame_codec.load(os.path.join(self.bm.root, self.bm.data_type[0][0], "{}_{}.npz".format(scene, frame))) as data:
+                params = self._raw_params(data['y'])
+        return fields + [np.asarray(params, dtype=np.float32)]
+
+    #--------------------------------------------
+    def _preprocess(self, fields, params):
+        """ same flip and normalization as keras_data.preprocess """
+        x = []
+        for i_d, data_type in enumerate(self.bm.data_type):
+            field = fields[i_d]
+            if self.packed is None:
+                if self.bm.depth[i_d] == 1:
+                    field = tf.expand_dims(field, axis=-1)
+                # mirror y axis
+                field = tf.reverse(field, axis=[1 if self.bm.is_3d else 0])
+                if data_type[0] == 'd' or (data_type == "inflow" and self.den_inflow):
+                    field = field * 2.0 - 1.0
+                else:
+                    field = field / self.bm.x_range[i_d]
+            x.append(field)
+        x = tf.concat(x, axis=-1) if len(x) > 1 else x[0]
+
+        if not self.params_normalized:
+            sup_range = np.array(self.bm.y_range[2:], dtype=np.float32).reshape(-1, 2)
+            params = (params - sup_range[:, 0]) / (sup_range[:, 1] - sup_range[:, 0]) * 2.0 - 1.0
+        return x, params
+
+    #--------------------------------------------
+    def _decode(self, scene, frame, read):
+        tensors = tf.py_func(self._load_raw, [scene, frame, read], [tf.float32] * (len(self.bm.data_type) + 1), stateful=False)
+        for tensor, shape in zip(tensors, self.raw_shapes + [[self.bm.supervised_param_count]]):
+            tensor.set_shape(shape)
+        return self._preprocess(tensors[:-1], tensors[-1])
+
+    #--------------------------------------------
+    def windows(self, windows, field_mask=None, shuffle=True):
+        """ (x, params, window) of the given windows (indices into BatchManager.paths); with shuffle an endless stream in a new random
+            order every epoch like WindowSampler, otherwise every window once in the given order. the frames of a window are read
+            in parallel, field_mask (sequence_length, data types) selects the fields that are read """
+        seq_len = self.bm.sequence_length
+        if field_mask is None:
+            field_mask = np.ones((seq_len, len(self.bm.data_type)), dtype=bool)
+        field_mask = tf.constant(field_mask)
+        windows = np.asarray(windows, dtype=np.int64)
+        index = tf.data.Dataset.from_tensor_slices((self.bm.paths.scene[windows].astype(np.int64), self.bm.paths.frame[windows].astype(np.int64), windows))
+        if shuffle:
+            index = index.shuffle(len(windows), seed=self.random_seed, reshuffle_each_iteration=True).repeat()
+        def window_frames(scene, start, window):
+            frames = tf.data.Dataset.range(seq_len).map(lambda i: self._decode(scene, start + i, field_mask[i]), num_parallel_calls=self.num_parallel_calls)
+            return frames.batch(seq_len).map(lambda x, params: (x, params, window))
+        return index.apply(tf.contrib.data.parallel_interleave(window_frames, cycle_length=self.num_parallel_calls, block_length=1, sloppy=False))
+
+    #--------------------------------------------
+    def _tiles(self, x, params, window, validation=False):
+        """ tiles_per_sample random tiles of a window like the python generator: TileConfig.valid_tile_starts(out_of_bounds_fac=3) and cut_tiles;
+            validation tiles are drawn statelessly from the seed and the window, so they are the same in every epoch """
+        tile_generator = self.bm.tile_generator
+        tile_size = list(reversed(tile_generator.tile_size))
+        if not self.bm.is_3d:
+            tile_size = tile_size[1:]
+        border = [int(t / 3) for t in tile_size]
+
+        # pad once for all tiles: velocity with 0, all other quantities with -1
+        pad = [[0, 0]] + [[b, t - b] for b, t in zip(border, tile_size)] + [[0, 0]]
+        vel_channels = 3 if self.bm.is_3d else 2
+        x = tf.concat([
+            tf.pad(x[..., :vel_channels], pad, constant_values=0.0),
+            tf.pad(x[..., vel_channels:], pad, constant_values=-1.0)], axis=-1)
+
+        # like TileConfig.valid_tile_starts: mean of the last channel of the middle frame for every tile position of the padded window,
+        # drawn uniformly from the positions where something is happening; an empty window takes any tiles instead of spinning forever
+        seq_len = self.bm.sequence_length
+        field = x[int(seq_len / 2):int(seq_len / 2) + 1, ..., -1:]
+        pool = tf.nn.avg_pool3d if self.bm.is_3d else tf.nn.avg_pool
+        tile_mean = pool(field, ksize=[1] + tile_size + [1], strides=[1] * (len(tile_size) + 2), padding="VALID")[0, ..., 0]
+        valid_starts = tf.where(tile_mean >= -0.99)
+        all_starts = tf.where(tf.ones_like(tile_mean, dtype=tf.bool))
+        starts = tf.cond(tf.shape(valid_starts)[0] > 0, lambda: valid_starts, lambda: all_starts)
+        num_starts = tf.shape(starts)[0]
+        if validation:
+            u = tf.contrib.stateless.stateless_random_uniform([self.bm.tiles_per_sample], seed=tf.stack([tf.constant(self.random_seed, dtype=tf.int64), window]))
+            draws = tf.minimum(tf.cast(u * tf.cast(num_starts, tf.float32), tf.int32), num_starts - 1)
+        else:
+            draws = tf.random_uniform([self.bm.tiles_per_sample], 0, num_starts, dtype=tf.int32, seed=self.random_seed)
+        starts = tf.gather(starts, draws)
+
+        def cut(start):
+            begin = tf.concat([[0], tf.cast(start, tf.int32), [0]], axis=0)
+            return tf.slice(x, begin, [seq_len] + tile_size + [-1])
+        tiles = tf.map_fn(cut, starts, dtype=x.dtype)
+        return tf.data.Dataset.from_tensor_slices((tiles, tf.tile(tf.expand_dims(params, 0), [self.bm.tiles_per_sample, 1, 1])))
+
+    #--------------------------------------------
+    def dataset(self, batch_size, validation_split=0.1, validation=False, field_mask=None, drop_remainder=False):
+        """ endless dataset of (x, y) batches of the train or validation windows of BatchManager.window_sampler;
+            drop_remainder discards the partial last validation batch of every epoch """
+        sampler = self.bm.window_sampler(batch_size, validation_split, validation)
+        if field_mask is not None and self.bm.use_tiles:
+            # tiles are drawn where the last channel of the middle frame is not empty
+            field_mask = field_mask.copy()
+            field_mask[int(self.bm.sequence_length / 2), -1] = True
+        if validation:
+            # every window once per epoch in dataset order
+            dataset = self.windows(sampler.windows, field_mask, shuffle=False)
+            # 'memory' is served by the frame cache
+            if self.cache and self.cache != "memory":
+                dataset = dataset.cache(self.cache + "_val")
+            if self.bm.use_tiles:
+                dataset = dataset.flat_map(lambda x, params, window: self._tiles(x, params, window, validation=True))
+            else:
+                dataset = dataset.map(lambda x, params, window: (x, params))
+            # the last batch holds the remainder like BatchManager.steps_per_epoch
+            dataset = dataset.apply(tf.contrib.data.batch_and_drop_remainder(batch_size)) if drop_remainder else dataset.batch(batch_size)
+            return dataset.repeat().prefetch(self.prefetch)
+
+        dataset = self.windows(sampler.windows, field_mask)
+        if self.bm.use_tiles:
+            dataset = dataset.flat_map(self._tiles)
+        else:
+            dataset = dataset.map(lambda x, params, window: (x, params))
+        dataset = dataset.apply(tf.contrib.data.batch_and_drop_remainder(batch_size))
+        return dataset.prefetch(self.prefetch)
+
+    #--------------------------------------------
+    def generator(self, batch_size, validation_split=0.1, validation=False, field_mask=None, drop_remainder=False):
+        """ yields the batches of dataset() in the format of BatchManager.generator_ae """
+        sess = K.get_session()
+        with sess.graph.as_default():
+            iterator = self.dataset(batch_size, validation_split, validation, field_mask, drop_remainder).make_initializable_iterator()
+            next_batch = iterator.get_next()
+        sess.run(iterator.initializer)
+        while True:
+            x, y = sess.run(next_batch)
+            if self.bm.sequence_length == 1:
+                x = x[:, 0]
+                y = y[:, 0]
+            yield x, [x, y]
@@ -24,7 +24,6 @@ from keras.layers.pooling import AveragePooling2D, MaxPooling2D
 from keras.models import Model, save_model, load_model
 from keras.backend import int_shape
 from keras.callbacks import Callback
-from keras.utils import multi_gpu_model
 import keras.backend as K
 
 
@@ -58,8 +57,9 @@ class RecursivePrediction(Network):
         self.tensorflow_seed = kwargs.get("tensorflow_seed", 4)
         self.model = None
         tf.set_random_seed(self.tensorflow_seed)
-        self.gpus = [ int(gpu.strip()) for gpu in config.gpu_id.split(",")]
-        print("Using GPUs: {}".format(self.gpus))
+        # data parallel replicas on the GPUs of every worker, see data_parallel_model
+        self.replica_devices = replica_devices(config)
+        print("Using replicas: {}".format(self.replica_devices))
         self.parallel_model = None
 
         self.stateful = kwargs.get("stateful", False)
@@ -107,6 +107,18 @@ class RecursivePrediction(Network):
 
         self.is_train = config.is_train#true
 
+        # float16 layers with float32 master weights, see setup_mixed_precision
+        self.mixed_precision = setup_mixed_precision(config)
+        try:
+            self.loss_scale = config.loss_scale
+        except AttributeError:
+            self.loss_scale = 0.0
+        # recompute encoder/decoder blocks and rollout steps in the backward pass, see checkpointed_gradients
+        try:
+            self.gradient_checkpointing = config.gradient_checkpointing
+        except AttributeError:
+            self.gradient_checkpointing = False
+
         self.dataset = config.dataset
 
         self.b_num = config.batch_size
@@ -169,12 +181,17 @@ class RecursivePrediction(Network):
 
     #---------------------------------------------------------------------------------
     def _init_optimizer(self, epochs=1):
-        self.optimizer = Adam(  lr=self.adam_learning_rate,
+        adam = MixedPrecisionAdam if self.mixed_precision else Adam
+        adam_kwargs = {'loss_scale': self.loss_scale} if self.mixed_precision else {}
+        self.optimizer = adam(  lr=self.adam_learning_rate,
                                 beta_1=0.9,
                                 beta_2=0.999,
                                 epsilon=self.adam_epsilon, 
                                 decay=self.adam_lr_decay,
-                                amsgrad=False)
+                                amsgrad=False,
+                                **adam_kwargs)
+        if self.gradient_checkpointing:
+            use_gradient_checkpointing(self.optimizer)
         return self.optimizer
 
     #---------------------------------------------------------------------------------
@@ -215,7 +232,7 @@ class RecursivePrediction(Network):
         # State init network
         #不执行
         if self.in_out_states:
-            state_init_in = Input(shape=(self.w_num, self.z_num), dtype="float32", name="State_Init_Input")
+            state_init_in = Input(shape=(self.w_num, self.z_num), dtype=K.floatx(), name="State_Init_Input")
             state_init_x = Reshape((self.w_num * self.z_num,), name="Reshape_io_states")(state_init_in)
             state_init_x = Dense(128)(state_init_x)
             state_init_x = LeakyReLU()(state_init_x)
@@ -225,46 +242,56 @@ class RecursivePrediction(Network):
             self.state_init_model = Model(name="State_Init", inputs=state_init_in, outputs=state_init_x)
         #go else
         if self.stateful:
-            inputs = Input(batch_shape=(self.b_num,) + self.input_shape, dtype="float32", name="Combined_AE_Input_Fields") # (b, input_depth, x, y, c)
+            inputs = Input(batch_shape=(self.b_num,) + self.input_shape, dtype=K.floatx(), name="Combined_AE_Input_Fields") # (b, input_depth, x, y, c)
         else:
-            inputs = Input(shape=self.input_shape, dtype="float32", name="Combined_AE_Input_Fields") # (b, input_depth, y, x, c)
+            inputs = Input(shape=self.input_shape, dtype=K.floatx(), name="Combined_AE_Input_Fields") # (b, input_depth, y, x, c)
 
         # Input for GT supervised parameters (e.g. rotation and position)
         # -> (b_num, 14, 2)              #sup_param_count is 1
-        sup_param_inputs = Input(shape=(self.input_shape[0], self.sup_param_count), dtype="float32", name="Combined_AE_Input_Sup_Param")
+        sup_param_inputs = Input(shape=(self.input_shape[0], self.sup_param_count), dtype=K.floatx(), name="Combined_AE_Input_Sup_Param")
 
         if self.use_inflow or self.advection_loss > 0.0:#go
             #就是输入的最后一项，速度和密度的那项，这里是1，表示inflow
-            input_inflow = Input(shape=self.input_inflow_shape, dtype="float32", name="Inflow_Input") # (b, input_depth, y, x, 1)
+            input_inflow = Input(shape=self.input_inflow_shape, dtype=K.floatx(), name="Inflow_Input") # (b, input_depth, y, x, 1)
 
 
 
         #train_prediction_only是false
-        if self.ls_split > 0.0 and not self.train_prediction_only:
+        use_ls_split = self.ls_split > 0.0 and not self.train_prediction_only
+        if use_ls_split:
             inputs_full = Lambda(lambda x: x[:, 0:1], name="ls_split_slice")(inputs)
             inputs_full = Lambda(lambda x: K.squeeze(x,1), name="ls_split_0")(inputs_full)
             #只输入速度                                                                      #axis=0 表示列   axis=1 表示行
             inputs_vel = Lambda(lambda x: K.concatenate([x[...,0:velo_dim], K.zeros_like(x)[...,velo_dim:velo_dim+1]], axis=-1), name="ls_split_1")(inputs_full)
             #只输入密度
             inputs_den = Lambda(lambda x: K.concatenate([K.zeros_like(x)[...,0:velo_dim], x[...,velo_dim:velo_dim+1]], axis=-1), name="ls_split_2")(inputs_full)
-            z_vel = enc(inputs_vel)
-            z_vel = Lambda(lambda x: x, name="z_vel")(z_vel)
-            z_den = enc(inputs_den)
-            z_den = Lambda(lambda x: x, name="z_den")(z_den)
-
-        #？这块啥意思
-        enc_input = None
-        enc_input_range = inputs.shape[1] if self.ls_prediction_loss else self.w_num
-        for i in range(enc_input_range): # input depth iteration
-            if enc_input == None:
-                enc_input = Lambda(lambda x: x[:, i], name="Slice_enc_input_{}".format(i))(inputs)
-                enc_input = enc(enc_input)
-                enc_input = Lambda(lambda x: K.expand_dims(x, axis=1))(enc_input)
-            else:
+
+        enc_input_range = int(inputs.shape[1]) if self.ls_prediction_loss else self.w_num
+        if self.stateful:
+            # the stateful encoder has a fixed batch size -> one call per frame
+            if use_ls_split:
+                z_vel = Lambda(lambda x: x, name="z_vel")(enc(inputs_vel))
+                z_den = Lambda(lambda x: x, name="z_den")(enc(inputs_den))
+            encoded = []
+            for i in range(enc_input_range): # input depth iteration
                 temp_enc = Lambda(lambda x: x[:, i], name="Slice_enc_input_{}".format(i))(inputs)
-                temp_enc = enc(temp_enc)
-                encoded = Lambda(lambda x: K.expand_dims(x, axis=1))(temp_enc)
-                enc_input = concatenate([enc_input, encoded], axis=1) # (b, input_depth, z)
+                encoded.append(Lambda(lambda x: K.expand_dims(x, axis=1))(enc(temp_enc)))
+            enc_input = concatenate(encoded, axis=1) if len(encoded) > 1 else encoded[0] # (b, input_depth, z)
+        else:
+            # all input frames (and the ls split inputs of frame 0) go through the encoder as one batch (b * frames, [z,] y, x, c)
+            enc_frames = Lambda(lambda x: x[:, :enc_input_range], name="Slice_enc_input")(inputs)
+            if use_ls_split:
+                enc_frames = Lambda(lambda x: K.concatenate([x[0], K.expand_dims(x[1], axis=1), K.expand_dims(x[2], axis=1)], axis=1), name="ls_split_enc_concat")([enc_frames, inputs_vel, inputs_den])
+            enc_frame_count = enc_input_range + (2 if use_ls_split else 0)
+            enc_frames = Lambda(lambda x: K.reshape(x, (-1,) + int_shape(x)[2:]), name="Fold_enc_input")(enc_frames)
+            encoded = enc(enc_frames)
+            encoded = Lambda(lambda x: K.reshape(x, (-1, enc_frame_count, self.z_num)), name="Unfold_enc_input")(encoded) # (b, frames, z)
+            if use_ls_split:
+                z_vel = Lambda(lambda x: x[:, enc_input_range], name="z_vel")(encoded)
+                z_den = Lambda(lambda x: x[:, enc_input_range+1], name="z_den")(encoded)
+                enc_input = Lambda(lambda x: x[:, :enc_input_range], name="Slice_enc_output")(encoded) # (b, input_depth, z)
+            else:
+                enc_input = encoded
 
         # directly extract z to apply supervised latent space loss afterwards
         z = Lambda(lambda x: x[:, 0:1], name="Slice_z")(enc_input)
@@ -295,6 +322,9 @@ class RecursivePrediction(Network):
         rec_output = None
         adv_output = None
         rec_den = None
+        # without advection the decoded predictions are not fed back -> decode all steps at once after the loop
+        batched_decode = self.decode_predictions and not self.advection_loss > 0.0
+        rec_latent = []
         for i in range(self.recursive_prediction):
             # 不执行 if, go else
             if self.in_out_states:
@@ -324,7 +354,10 @@ class RecursivePrediction(Network):
             if self.decode_predictions:
                 if self.ls_prediction_loss:
                     x_ls = x
-                x = dec(Reshape((self.z_num,), name="Reshape_xDecPred_{}".format(i))(x))
+                if batched_decode:
+                    rec_latent.append(x)
+                else:
+                    x = dec(Reshape((self.z_num,), name="Reshape_xDecPred_{}".format(i))(x))
 
             # ########################################################################################################################
             # density/ls advection loss
@@ -380,15 +413,19 @@ class RecursivePrediction(Network):
                 m_np = np.zeros( (self.pred.out_w_num, self.z_num), dtype=np.float32)
                 m_np[:,self.ls_split_idx:-self.sup_param_count] = 1.0
                 # create lambda with a,b: a * m + b * (1-m)
-                rec_input_last = Lambda(lambda x: x[0] * K.constant(value=m_np, dtype='float32') + x[1] * (1.0-K.constant(value=m_np, dtype='float32')), name="z_reenc_stitch_{}".format(self.w_num + i))( [z_reenc, rec_input_last] )
+                rec_input_last = Lambda(lambda x: x[0] * K.constant(value=m_np, dtype=K.floatx()) + x[1] * (1.0-K.constant(value=m_np, dtype=K.floatx())), name="z_reenc_stitch_{}".format(self.w_num + i))( [z_reenc, rec_input_last] )
                 # replace rec_input last elem
                 rec_input = Lambda(lambda x: x[:, :-1], name="rec_input_cut_{}".format(self.w_num+i))(rec_input) 
                 rec_input = concatenate([rec_input, rec_input_last], axis=1, name="rec_input_concat_{}".format(self.w_num+i))
 
-            if rec_output == None or self.only_last_prediction:
-                rec_output = x
-            else:
-                rec_output = concatenate([rec_output, x], axis=1, name="Pred_Output_Concat_{}".format(i))
+            # rollout step boundary: only the latent history is kept, the step is recomputed in the backward pass
+            rec_input = checkpoint_layer(rec_input, self.gradient_checkpointing)
+
+            if not batched_decode:
+                if rec_output == None or self.only_last_prediction:
+                    rec_output = x
+                else:
+                    rec_output = concatenate([rec_output, x], axis=1, name="Pred_Output_Concat_{}".format(i))
 
             if self.ls_prediction_loss:
                 if rec_output_ls == None or self.only_last_prediction:
@@ -401,7 +438,16 @@ class RecursivePrediction(Network):
                 rec_out_shape = (1,)+self.input_shape[1:]
             else:
                 rec_out_shape = (self.recursive_prediction,)+self.input_shape[1:]
-            rec_output = Reshape(rec_out_shape, name="Prediction_output")(rec_output)
+            if batched_decode:
+                # one decoder call for all steps: (b, steps, z) -> (b * steps, z) -> (b, steps, [z,] y, x, c)
+                if self.only_last_prediction:
+                    rec_latent = rec_latent[-1:]
+                rec_latent = concatenate(rec_latent, axis=1, name="Pred_Latent_Concat") if len(rec_latent) > 1 else rec_latent[0]
+                rec_latent = Lambda(lambda x: K.reshape(x, (-1, self.z_num)), name="Fold_pred_latent")(rec_latent)
+                rec_output = dec(rec_latent)
+                rec_output = Lambda(lambda x: K.reshape(x, (-1,) + rec_out_shape), name="Prediction_output")(rec_output)
+            else:
+                rec_output = Reshape(rec_out_shape, name="Prediction_output")(rec_output)
 
         if self.decode_predictions:
             if self.ls_prediction_loss:
@@ -453,19 +499,20 @@ class RecursivePrediction(Network):
             input_list.append(input_inflow)
 
         print("Setup Model")
-        if len(self.gpus) > 1:
-            with tf.device('/cpu:0'):
+        if len(self.replica_devices) > 1:
+            with tf.device(parameter_device(self.replica_devices)):
                 self.model = Model(name="Combined_AE_LSTM", inputs=input_list, outputs=output_list)
         else:
             self.model = Model(name="Combined_AE_LSTM", inputs=input_list, outputs=output_list)
 
     #---------------------------------------------------------------------------------
     def _compile_model(self):
-        if len(self.gpus) > 1:
-            self.parallel_model = multi_gpu_model(self.model, gpus=self.gpus)
-            self.parallel_model.compile(loss=self.loss, optimizer=self.optimizer, metrics=self.metrics, loss_weights=self.loss_weights, options=self.tf_run_options)
+        if len(self.replica_devices) > 1:
+            self.parallel_model = data_parallel_model(self.model, self.replica_devices)
+            use_data_parallel(self.optimizer, self.parallel_model)
+            compile_model(self.parallel_model, self.mixed_precision, loss=self.loss, optimizer=self.optimizer, metrics=self.metrics, loss_weights=self.loss_weights, options=self.tf_run_options)
         else:
-            self.model.compile(loss=self.loss, optimizer=self.optimizer, metrics=self.metrics, loss_weights=self.loss_weights, options=self.tf_run_options)
+            compile_model(self.model, self.mixed_precision, loss=self.loss, optimizer=self.optimizer, metrics=self.metrics, loss_weights=self.loss_weights, options=self.tf_run_options)
 
     #---------------------------------------------------------------------------------
     def train(self, epochs, **kwargs):
@@ -524,13 +571,23 @@ class RecursivePrediction(Network):
             train_gen_nb_samples = batch_manager.steps_per_epoch(batch_size, validation_split, validation=False)
             print ("Number of train batch samples per epoch: {}".format(train_gen_nb_samples))
             assert train_gen_nb_samples > 0, ("Batch size is too large for current scene samples/timestep settings. Training by generator not possible. Please adjust the batch size in the 'settings.json' file.")
-            train_generator = batch_manager.generator_ae_sequence(batch_size, validation_split, validation=False, decode_predictions=self.decode_predictions, ls_prediction_loss=self.ls_prediction_loss, ls_split_loss=self.ls_split > 0.0, train_prediction_only=self.train_prediction_only, advection_loss=self.advection_loss > 0.0)
 
-            # validation samples
-            val_gen_nb_samples = batch_manager.steps_per_epoch(batch_size, validation_split, validation=True)
+            # validation samples: every validation window once per epoch, no gradients -> may use larger batches;
+            # the stateful model has a fixed batch size -> training batch size and no partial last batch
+            drop_remainder = self.stateful
+            val_batch_size = batch_size if self.stateful or batch_manager.validation_batch_size <= 0 else batch_manager.validation_batch_size
+            val_gen_nb_samples = batch_manager.steps_per_epoch(val_batch_size, validation_split, validation=True, drop_remainder=drop_remainder)
             assert val_gen_nb_samples > 0, ("Batch size is too large for current scene samples/timestep settings. Training by generator not possible. Please adjust the batch size in the 'settings.json' file.")
             print ("Number of validation batch samples per epoch: {}".format(val_gen_nb_samples))
-            validation_generator = batch_manager.generator_ae_sequence(batch_size, validation_split, validation=True, decode_predictions=self.decode_predictions, ls_prediction_loss=self.ls_prediction_loss, ls_split_loss=self.ls_split > 0.0, train_prediction_only=self.train_prediction_only, advection_loss=self.advection_loss > 0.0)
+
+            loaders = kwargs.get("loaders")
+            if loaders is not None:
+                # PrefetchLoaders of BatchManager.sequence_loaders, batch assembly runs in separate processes, keras consumes the loaders directly (workers=0)
+                train_generator, validation_generator = loaders
+            else:
+                train_generator = batch_manager.generator_ae_sequence(batch_size, validation_split, validation=False, decode_predictions=self.decode_predictions, ls_prediction_loss=self.ls_prediction_loss, ls_split_loss=self.ls_split > 0.0, train_prediction_only=self.train_prediction_only, advection_loss=self.advection_loss > 0.0)
+                validation_generator = batch_manager.generator_ae_sequence(val_batch_size, validation_split, validation=True, decode_predictions=self.decode_predictions, ls_prediction_loss=self.ls_prediction_loss, ls_split_loss=self.ls_split > 0.0, train_prediction_only=self.train_prediction_only, advection_loss=self.advection_loss > 0.0, drop_remainder=drop_remainder)
+        generator_workers = 0 if isinstance(train_generator, PrefetchLoader) else 1
 
         try:
             trainingDuration = 0.0
@@ -561,7 +618,8 @@ class RecursivePrediction(Network):
                             validation_data=validation_generator,
                             validation_steps=val_gen_nb_samples,
                             class_weight=None,
-                            workers=1)
+                            max_queue_size=batch_manager.max_queue_size,
+                            workers=generator_workers)
                         history = merge_histories(history, hist)
                         model.reset_states()
             else:
@@ -588,11 +646,17 @@ class RecursivePrediction(Network):
                         validation_data=validation_generator,
                         validation_steps=val_gen_nb_samples,
                         class_weight=None,
-                        max_queue_size=10)
+                        max_queue_size=batch_manager.max_queue_size,
+                        workers=generator_workers)
             trainingDuration = time.time() - trainStartTime
         except KeyboardInterrupt:
             print("Training duration (s): {}\nInterrupted by user!".format(trainingDuration))
         print("Training duration (s): {}".format(trainingDuration))
+        for generator in [train_generator, validation_generator]:
+            if isinstance(generator, PrefetchLoader):
+                generator.close()
+        if batch_manager and batch_manager.frame_cache is not None:
+            print(batch_manager.frame_cache)
         
         return history
 
@@ -652,7 +716,7 @@ class RecursivePrediction(Network):
 
 from config import get_config
 from utils import prepare_dirs_and_logger
-from keras_data import BatchManager, copy_dataset_info
+from keras_data import BatchManager, PrefetchLoader, copy_dataset_info
 import os
 from utils import save_image
 from LatentSpacePhysics.src.util.requirements import init_packages
@@ -663,6 +727,8 @@ import git
 #---------------------------------------------------------------------------------
 if __name__ == "__main__":
     config, unparsed = get_config()
+    # the chief starts its session after the loader processes are forked
+    setup_workers(config, start_chief=False)
     prepare_dirs_and_logger(config)
 
     # create GIT file
@@ -706,6 +772,13 @@ if __name__ == "__main__":
     if train_prediction_only: 
         print("Training only the prediction network!")
 
+    # the loader processes are forked before keras/tf create their session and threads
+    loaders = None
+    if config.is_train and config.num_worker > 1 and keras_batch_manager.data_backend == "python":
+        loaders = keras_batch_manager.sequence_loaders(batch_num, validation_split, config.num_worker, config.loader_queue_depth,
+            decode_predictions=decode_predictions, ls_prediction_loss=ls_prediction_loss, ls_split_loss=ls_split > 0.0, train_prediction_only=train_prediction_only, advection_loss=config.advection_loss > 0.0)
+    setup_workers(config)
+
     ## Write config to file
     config_d = vars(config) if config else {}
     unparsed_d = vars(unparsed) if unparsed else {}
@@ -740,7 +813,7 @@ if __name__ == "__main__":
             save_img_to_disk(test_data, 0, config.model_dir, keras_batch_manager, "x_fixed_gt")
             plot_callback = PlotAEFields(rec_pred.ae_predict, test_data, save_img_to_disk, config.model_dir, keras_batch_manager)
 
-        hist = rec_pred.train(epochs, batch_manager=keras_batch_manager, batch_size=batch_num, validation_split=validation_split, callbacks=[plot_callback])
+        hist = rec_pred.train(epochs, batch_manager=keras_batch_manager, batch_size=batch_num, validation_split=validation_split, callbacks=[plot_callback], loaders=loaders)
         #把训练得到的模型存下来
         rec_pred.save_model(config.model_dir)
 
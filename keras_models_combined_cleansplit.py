@@ -432,11 +432,12 @@ class RecursivePredictionCleanSplit(Network):
             assert train_gen_nb_samples > 0, ("Batch size is too large for current scene samples/timestep settings. Training by generator not possible. Please adjust the batch size in the 'settings.json' file.")
             train_generator = batch_manager.generator_ae_sequence_clean(batch_size, validation_split, validation=False, decode_predictions=self.decode_predictions, ls_prediction_loss=self.ls_prediction_loss)
 
-            # validation samples
-            val_gen_nb_samples = batch_manager.steps_per_epoch(batch_size, validation_split, validation=True)
+            # validation samples: every validation window once per epoch, no gradients -> may use larger batches
+            val_batch_size = batch_manager.validation_batch_size if batch_manager.validation_batch_size > 0 else batch_size
+            val_gen_nb_samples = batch_manager.steps_per_epoch(val_batch_size, validation_split, validation=True)
             assert val_gen_nb_samples > 0, ("Batch size is too large for current scene samples/timestep settings. Training by generator not possible. Please adjust the batch size in the 'settings.json' file.")
             print ("Number of validation batch samples per epoch: {}".format(val_gen_nb_samples))
-            validation_generator = batch_manager.generator_ae_sequence_clean(batch_size, validation_split, validation=True, decode_predictions=self.decode_predictions, ls_prediction_loss=self.ls_prediction_loss)
+            validation_generator = batch_manager.generator_ae_sequence_clean(val_batch_size, validation_split, validation=True, decode_predictions=self.decode_predictions, ls_prediction_loss=self.ls_prediction_loss)
 
         try:
             trainingDuration = 0.0
@@ -467,6 +468,7 @@ class RecursivePredictionCleanSplit(Network):
                             validation_data=validation_generator,
                             validation_steps=val_gen_nb_samples,
                             class_weight=None,
+                            max_queue_size=batch_manager.max_queue_size,
                             workers=1)
                         history = merge_histories(history, hist)
                         model.reset_states()
@@ -494,7 +496,7 @@ class RecursivePredictionCleanSplit(Network):
                         validation_data=validation_generator,
                         validation_steps=val_gen_nb_samples,
                         class_weight=None,
-                        max_queue_size=10)
+                        max_queue_size=batch_manager.max_queue_size)
             trainingDuration = time.time() - trainStartTime
         except KeyboardInterrupt:
             print("Training duration (s): {}\nInterrupted by user!".format(trainingDuration))
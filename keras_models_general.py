@@ -316,8 +316,10 @@ def advect(src_in, dt, mac_adv=False, name="velocity"):
     #src = np.zeros([1, 80, 64, 2])  # 2D: (batch, y, x, 2)
     #src = np.zeros([1, 80, 64, 64, 3])  # 3D  (batch, z, y, x, 3)
     # phiflow dimension order zyx <-> manta dim order xyz
-    src = src_in[0]
-    v = src_in[1]
+    # advected in float32, also with float16 layers
+    dtype = src_in[0].dtype
+    src = K.cast(src_in[0], "float32")
+    v = K.cast(src_in[1], "float32")
     src = src[...,::-1]
     v = v[...,::-1]
     if len(src.shape) == 4: # 2D
@@ -332,7 +334,7 @@ def advect(src_in, dt, mac_adv=False, name="velocity"):
         src_advected = src_advected[:,::-1]
     else: # 3D
         src_advected = src_advected[:,:,::-1]
-    return src_advected
+    return K.cast(src_advected, dtype)
 
 # --------------------------------------------------------------------------------------------------------------------------------------------------
 def grad_density(x, data_format='NHWC', is_3d=False):
@@ -623,3 +625,349 @@ class Split_Loss(object):
         loss = losses.mean_absolute_error(y_true[..., self.first_idx:self.last_idx], y_pred[..., self.first_idx:self.last_idx])
         return loss
 
+
+# --------------------------------------------------------------------------------------------------------------------------------------------------
+# Mixed Precision ----------------------------------------------------------------------------------------------------------------------------------
+# --------------------------------------------------------------------------------------------------------------------------------------------------
+def setup_mixed_precision(config):
+    """ --mixed_precision float16: layers are built with float16 weights and activations (keras floatx); has to be called before any layer is created """
+    try:
+        mixed_precision = config.mixed_precision
+    except AttributeError:
+        mixed_precision = "float32"
+    if mixed_precision == "float16":
+        K.set_floatx("float16")
+        print("Mixed precision: float16 layers, float32 losses and master weights")
+    return mixed_precision == "float16"
+
+# --------------------------------------------------------------------------------------------------------------------------------------------------
+class Float32Loss(object):
+    """ evaluates a loss on float32 copies of y_true and y_pred; the per sample result stays float32, see compile_model """
+    #---------------------------------------------------------------------------------
+    def __init__(self, loss):
+        self.loss = losses.get(loss)
+        self.__name__ = self.loss.__name__
+    #---------------------------------------------------------------------------------
+    def __call__(self, y_true, y_pred):
+        return self.loss(K.cast(y_true, "float32"), K.cast(y_pred, "float32"))
+
+# --------------------------------------------------------------------------------------------------------------------------------------------------
+def float32_losses(loss):
+    """ wraps a loss, a list or a dict of losses as passed to compile in Float32Loss """
+    if isinstance(loss, dict):
+        return {name: Float32Loss(loss_) for name, loss_ in loss.items()}
+    if isinstance(loss, (list, tuple)):
+        return [Float32Loss(loss_) for loss_ in loss]
+    return Float32Loss(loss)
+
+# --------------------------------------------------------------------------------------------------------------------------------------------------
+def cast_model_losses(layer, dtype):
+    """ casts the tensors collected by layer.losses (e.g. float16 weight regularizers) of a layer or a model and its nested models to dtype """
+    for sublayer in getattr(layer, "layers", []):
+        cast_model_losses(sublayer, dtype)
+    casts = {}
+    def cast(loss):
+        if not K.is_tensor(loss) or K.dtype(loss) == dtype:
+            return loss
+        if id(loss) not in casts:
+            casts[id(loss)] = K.cast(loss, dtype)
+        return casts[id(loss)]
+    layer._losses = [cast(loss) for loss in layer._losses]
+    layer._per_input_losses = {key: [cast(loss) for loss in losses_] for key, losses_ in layer._per_input_losses.items()}
+
+# --------------------------------------------------------------------------------------------------------------------------------------------------
+def compile_model(model, mixed_precision, loss, **kwargs):
+    """ model.compile; with mixed precision the losses are wrapped in Float32Loss and keras builds the sample weights, masks and the
+        weighted total loss while floatx is float32, so the loss is reduced in float32 and only the layers run in float16 """
+    if not mixed_precision:
+        model.compile(loss=loss, **kwargs)
+        return
+    cast_model_losses(model, "float32")
+    floatx = K.floatx()
+    K.set_floatx("float32")
+    try:
+        model.compile(loss=float32_losses(loss), **kwargs)
+    finally:
+        K.set_floatx(floatx)
+
+# --------------------------------------------------------------------------------------------------------------------------------------------------
+class MixedPrecisionAdam(keras.optimizers.Adam):
+    """ Adam on float32 master copies of the float16 model weights with loss scaling.
+        loss_scale > 0 is a static scale; with 0 the scale starts at 2^15, every step with inf/nan gradients is skipped and halves it,
+        scale_window finite steps in a row double it. The master copies are taken from the model weights when the train function
+        is built (first fit), hence weights have to be loaded before training starts """
+    def __init__(self, loss_scale=0.0, scale_window=2000, **kwargs):
+        super(MixedPrecisionAdam, self).__init__(**kwargs)
+        self.dynamic_loss_scale = loss_scale <= 0.0
+        self.scale_window = scale_window
+        with K.name_scope(self.__class__.__name__):
+            # hyper parameters in float32 instead of floatx
+            self.lr = K.variable(K.get_value(self.lr), dtype="float32", name="lr")
+            self.beta_1 = K.variable(K.get_value(self.beta_1), dtype="float32", name="beta_1")
+            self.beta_2 = K.variable(K.get_value(self.beta_2), dtype="float32", name="beta_2")
+            self.decay = K.variable(K.get_value(self.decay), dtype="float32", name="decay")
+            self.loss_scale = K.variable(2.0**15 if self.dynamic_loss_scale else loss_scale, dtype="float32", name="loss_scale")
+            self.finite_steps = K.variable(0, dtype="int64", name="finite_steps")
+
+    #---------------------------------------------------------------------------------
+    def get_updates(self, loss, params):
+        scaled_grads = self.get_gradients(K.cast(loss, "float32") * self.loss_scale, params)
+        grads = [K.cast(g, "float32") / self.loss_scale for g in scaled_grads]
+        finite = tf.reduce_all(tf.stack([tf.reduce_all(tf.is_finite(g)) for g in grads]))
+
+        masters = [K.variable(K.get_value(p), dtype="float32", name="master_" + p.name.split(":")[0].replace("/", "_")) for p in params]
+        ms = [K.zeros(K.int_shape(p), dtype="float32") for p in params]
+        vs = [K.zeros(K.int_shape(p), dtype="float32") for p in params]
+        vhats = [K.zeros(K.int_shape(p), dtype="float32") for p in params] if self.amsgrad else []
+        self.weights = [self.iterations] + ms + vs + vhats + masters + [self.loss_scale, self.finite_steps]
+
+        def apply_step():
+            # same update as keras.optimizers.Adam, computed on the master weights
+            updates = [K.update_add(self.iterations, 1)]
+            lr = self.lr
+            if self.initial_decay > 0:
+                lr = lr * (1. / (1. + self.decay * K.cast(self.iterations, "float32")))
+            t = K.cast(self.iterations, "float32") + 1
+            lr_t = lr * (K.sqrt(1. - K.pow(self.beta_2, t)) / (1. - K.pow(self.beta_1, t)))
+            for i, (p, master, g, m, v) in enumerate(zip(params, masters, grads, ms, vs)):
+                m_t = (self.beta_1 * m) + (1. - self.beta_1) * g
+                v_t = (self.beta_2 * v) + (1. - self.beta_2) * K.square(g)
+                if self.amsgrad:
+                    vhat_t = K.maximum(vhats[i], v_t)
+                    p_t = master - lr_t * m_t / (K.sqrt(vhat_t) + self.epsilon)
+                    updates.append(K.update(vhats[i], vhat_t))
+                else:
+                    p_t = master - lr_t * m_t / (K.sqrt(v_t) + self.epsilon)
+                if getattr(p, 'constraint', None) is not None:
+                    p_t = p.constraint(p_t)
+                updates.append(K.update(m, m_t))
+                updates.append(K.update(v, v_t))
+                updates.append(K.update(master, p_t))
+                updates.append(K.update(p, K.cast(p_t, K.dtype(p))))
+            with tf.control_dependencies(updates):
+                return tf.constant(True)
+
+        # overflowing steps leave weights and moments untouched
+        applied = tf.cond(finite, apply_step, lambda: tf.constant(False))
+        self.updates = [applied]
+        if self.dynamic_loss_scale:
+            with tf.control_dependencies([applied]):
+                finite_steps = tf.where(finite, self.finite_steps + 1, tf.zeros_like(self.finite_steps))
+                grow = finite_steps >= self.scale_window
+                new_scale = tf.where(finite, tf.where(grow, self.loss_scale * 2.0, self.loss_scale), tf.maximum(self.loss_scale * 0.5, 1.0))
+                self.updates.append(K.update(self.loss_scale, new_scale))
+                self.updates.append(K.update(self.finite_steps, tf.where(grow, tf.zeros_like(finite_steps), finite_steps)))
+        return self.updates
+
+    #---------------------------------------------------------------------------------
+    def get_config(self):
+        config = super(MixedPrecisionAdam, self).get_config()
+        config['loss_scale'] = 0.0 if self.dynamic_loss_scale else float(K.get_value(self.loss_scale))
+        config['scale_window'] = self.scale_window
+        return config
+
+# --------------------------------------------------------------------------------------------------------------------------------------------------
+# Gradient Checkpointing ---------------------------------------------------------------------------------------------------------------------------
+# --------------------------------------------------------------------------------------------------------------------------------------------------
+CHECKPOINT_COLLECTION = "gradient_checkpoints"
+
+def mark_checkpoint(x):
+    """ identity that registers its output (of every call, also inside nested models) as gradient checkpoint """
+    x = tf.identity(x, name="checkpoint")
+    tf.add_to_collection(CHECKPOINT_COLLECTION, x)
+    return x
+
+# --------------------------------------------------------------------------------------------------------------------------------------------------
+def checkpoint_layer(x, enabled=True):
+    return Lambda(mark_checkpoint)(x) if enabled else x
+
+# the Lambda layers of checkpoint_layer are saved as bytecode that refers to these globals, load_model needs them as custom objects
+CHECKPOINT_OBJECTS = {'tf': tf, 'CHECKPOINT_COLLECTION': CHECKPOINT_COLLECTION}
+
+# --------------------------------------------------------------------------------------------------------------------------------------------------
+def _topological_order(ops):
+    ops = set(ops)
+    pending = {op: sum(1 for t in op.inputs if t.op in ops) for op in ops}
+    ready = [op for op, count in pending.items() if count == 0]
+    order = {}
+    while ready:
+        op = ready.pop()
+        order[op] = len(order)
+        for t in op.outputs:
+            for consumer in t.consumers():
+                if consumer in pending:
+                    pending[consumer] -= 1
+                    if pending[consumer] == 0:
+                        ready.append(consumer)
+    return order
+
+# --------------------------------------------------------------------------------------------------------------------------------------------------
+def checkpointed_gradients(loss, params):
+    """ gradients of loss with respect to params that only keep the tensors marked by checkpoint_layer for the backward pass:
+        the forward ops between two checkpoints are copied and recomputed from the earlier checkpoint once the gradient of the later one
+        is available. ops inside control flow (the LSTM while loops, switches) are not copied, gradients pass through the original ops """
+    from tensorflow.contrib import graph_editor as ge
+    params = list(params)
+    param_ops = set(p.op for p in params)
+    loss_ops = ge.get_backward_walk_ops([loss.op], inclusive=True)
+    fwd_ops = set(op for op in ge.get_forward_walk_ops([p.op for p in params], inclusive=True, within_ops=loss_ops)
+                  if op.inputs and op not in param_ops and not op.name.endswith("/read"))
+    checkpoints = [t for t in loss.graph.get_collection(CHECKPOINT_COLLECTION) if t.op in fwd_ops]
+    if not checkpoints:
+        return tf.gradients(loss, params)
+    order = _topological_order(fwd_ops)
+    checkpoints.sort(key=lambda t: order[t.op])
+    stopped = {t: tf.stop_gradient(t) for t in checkpoints}
+
+    def recompute(seed, others, after):
+        # copy of the ops behind seed down to the other checkpoints, fed by their stopped versions; runs after the op 'after'
+        ops = set(ge.get_backward_walk_ops([seed.op], inclusive=True, stop_at_ts=others)) & fwd_ops
+        ops = [op for op in ops - set(t.op for t in others) if op._get_control_flow_context() is None]
+        if not ops:
+            return seed
+        _, info = ge.copy_with_input_replacements(ge.sgv(ops), {})
+        copied_ops = list(info._transformed_ops.values())
+        ge.reroute_ts([stopped[t] for t in others], others, can_modify=copied_ops)
+        for op in copied_ops:
+            ge.add_control_inputs(op, [after])
+        return info._transformed_ops[seed.op].outputs[seed.value_index] if seed.op in info._transformed_ops else seed
+
+    # last segment: loss -> checkpoints
+    grads = tf.gradients(recompute(loss, checkpoints, loss.op), [stopped[t] for t in checkpoints] + params)
+    d_checkpoints = dict(zip(checkpoints, grads[:len(checkpoints)]))
+    d_params = grads[len(checkpoints):]
+
+    def accumulate(a, b):
+        return b if a is None else (a if b is None else a + b)
+    # earlier segments in reverse order: every checkpoint receives all of its gradient before its segment is recomputed
+    for t in reversed(checkpoints):
+        d_t = d_checkpoints[t]
+        if d_t is None:
+            continue
+        others = [c for c in checkpoints if c is not t]
+        grads = tf.gradients(recompute(t, others, d_t.op), [stopped[c] for c in others] + params, grad_ys=[d_t])
+        for c, d_c in zip(others, grads[:len(others)]):
+            d_checkpoints[c] = accumulate(d_checkpoints[c], d_c)
+        d_params = [accumulate(d_p, d) for d_p, d in zip(d_params, grads[len(others):])]
+    return d_params
+
+# --------------------------------------------------------------------------------------------------------------------------------------------------
+def use_gradient_checkpointing(optimizer):
+    """ lets a keras optimizer compute its gradients with checkpointed_gradients """
+    def get_gradients(loss, params):
+        grads = checkpointed_gradients(loss, params)
+        if None in grads:
+            raise ValueError('An operation has `None` for gradient. Please make sure that all of your ops have a gradient defined (i.e. are differentiable).')
+        return grads
+    optimizer.get_gradients = get_gradients
+    optimizer.gradient_checkpointing = True
+    return optimizer
+
+# --------------------------------------------------------------------------------------------------------------------------------------------------
+# Data Parallel ------------------------------------------------------------------------------------------------------------------------------------
+# --------------------------------------------------------------------------------------------------------------------------------------------------
+def _worker_hosts(config):
+    try:
+        return [host.strip() for host in config.worker_hosts.split(",") if host.strip()]
+    except AttributeError:
+        return []
+
+# --------------------------------------------------------------------------------------------------------------------------------------------------
+def setup_workers(config, start_chief=True):
+    """ --worker_hosts: starts the tf server of this process. the chief (--task_index 0) builds the graph and runs the training on the devices
+        of all workers, every other task only serves its devices and never returns. with start_chief=False the chief returns without
+        a server or session, call again once the loader processes are forked """
+    worker_hosts = _worker_hosts(config)
+    if not worker_hosts or (config.task_index == 0 and not start_chief):
+        return
+    session_config = tf.ConfigProto(allow_soft_placement=True)
+    cluster = tf.train.ClusterSpec({"worker": worker_hosts})
+    server = tf.train.Server(cluster, job_name="worker", task_index=config.task_index, config=session_config)
+    if config.task_index > 0:
+        print("Worker {} serving {}".format(config.task_index, worker_hosts[config.task_index]))
+        server.join()
+    print("Chief of {} workers: {}".format(len(worker_hosts), worker_hosts))
+    K.set_session(tf.Session(server.target, config=session_config))
+
+# --------------------------------------------------------------------------------------------------------------------------------------------------
+def replica_devices(config):
+    """ one replica per GPU of --gpu_id (or the CPU without GPUs) on every worker of --worker_hosts; all workers need the same devices """
+    gpus = [gpu for gpu in config.gpu_id.split(",") if gpu.strip()]
+    # CUDA_VISIBLE_DEVICES is set to --gpu_id, the visible GPUs are numbered from 0
+    local_devices = ["/gpu:{}".format(i) for i in range(len(gpus))] or ["/cpu:0"]
+    worker_hosts = _worker_hosts(config)
+    if not worker_hosts:
+        return local_devices
+    return ["/job:worker/task:{}{}".format(task, device) for task in range(len(worker_hosts)) for device in local_devices]
+
+# --------------------------------------------------------------------------------------------------------------------------------------------------
+def parameter_device(devices):
+    """ variables and merged outputs stay on the CPU of the chief """
+    return "/job:worker/task:0/cpu:0" if devices[0].startswith("/job:") else "/cpu:0"
+
+# --------------------------------------------------------------------------------------------------------------------------------------------------
+def data_parallel_model(model, devices):
+    """ replaces keras.utils.multi_gpu_model: every device gets an equal slice of the batch and a replica of model, the outputs are concatenated
+        on the parameter device. the outputs of each replica are kept for replicated_gradients """
+    def get_slice(data, i, parts):
+        shape = tf.shape(data)
+        batch_size = shape[:1]
+        step = batch_size // parts
+        size = batch_size - step * i if i == parts - 1 else step
+        size = tf.concat([size, shape[1:]], axis=0)
+        start = tf.concat([step * i, shape[1:] * 0], axis=0)
+        return tf.slice(data, start, size)
+
+    replica_outputs = []
+    for i, device in enumerate(devices):
+        with tf.device(device), tf.name_scope("replica_{}".format(i)):
+            inputs = [Lambda(get_slice, output_shape=K.int_shape(x)[1:], arguments={'i': i, 'parts': len(devices)})(x) for x in model.inputs]
+            outputs = model(inputs if len(inputs) > 1 else inputs[0])
+            replica_outputs.append(outputs if isinstance(outputs, list) else [outputs])
+
+    with tf.device(parameter_device(devices)):
+        merged = [concatenate(list(outputs), axis=0, name=name) for name, outputs in zip(model.output_names, zip(*replica_outputs))]
+    parallel_model = Model(inputs=model.inputs, outputs=merged)
+    parallel_model.replica_outputs = replica_outputs
+    parallel_model.replica_devices = devices
+    return parallel_model
+
+# --------------------------------------------------------------------------------------------------------------------------------------------------
+def replicated_gradients(loss, params, replica_outputs, devices, model_losses=()):
+    """ every replica computes the gradients of its batch slice on its own device, the gradients are summed with one add_n on the
+        parameter device next to the variables. the loss is the mean over the whole batch, so this sum is the average of the per replica
+        mean gradients.
+        model_losses (model.losses, e.g. weight regularizers) are added to the loss directly, their gradients are added on the parameter device """
+    outputs = [y for replica in replica_outputs for y in replica]
+    model_losses = list(model_losses)
+    # the gradients w.r.t. the model losses carry the scaling of the loss (e.g. MixedPrecisionAdam)
+    d_outputs = tf.gradients(loss, outputs + model_losses)
+    d_model_losses = d_outputs[len(outputs):]
+    replica_grads = []
+    for i, (device, replica) in enumerate(zip(devices, replica_outputs)):
+        d_replica = d_outputs[i * len(replica):(i + 1) * len(replica)]
+        ys = [(y, d_y) for y, d_y in zip(replica, d_replica) if d_y is not None]
+        with tf.device(device):
+            grads = tf.gradients([y for y, _ in ys], params, grad_ys=[d_y for _, d_y in ys], colocate_gradients_with_ops=True)
+            if None in grads:
+                raise ValueError('An operation has `None` for gradient. Please make sure that all of your ops have a gradient defined (i.e. are differentiable).')
+            replica_grads.append([tf.identity(tf.convert_to_tensor(g)) for g in grads])
+
+    with tf.device(parameter_device(devices)):
+        summed = [tf.add_n(list(grads)) for grads in zip(*replica_grads)]
+
+    ys = [(y, d_y) for y, d_y in zip(model_losses, d_model_losses) if d_y is not None]
+    if ys:
+        with tf.device(parameter_device(devices)):
+            model_loss_grads = tf.gradients([y for y, _ in ys], params, grad_ys=[d_y for _, d_y in ys], colocate_gradients_with_ops=True)
+            summed = [g if g_model is None else g + tf.convert_to_tensor(g_model) for g, g_model in zip(summed, model_loss_grads)]
+    return summed
+
+# --------------------------------------------------------------------------------------------------------------------------------------------------
+def use_data_parallel(optimizer, parallel_model):
+    """ lets a keras optimizer compute its gradients with replicated_gradients of a data_parallel_model """
+    assert not getattr(optimizer, "gradient_checkpointing", False), ("gradient checkpointing is not supported with data parallel training")
+    def get_gradients(loss, params):
+        return replicated_gradients(loss, params, parallel_model.replica_outputs, parallel_model.replica_devices, parallel_model.losses)
+    optimizer.get_gradients = get_gradients
+    return optimizer
@@ -18,7 +18,6 @@ from keras.layers import *
 from keras.layers.pooling import AveragePooling2D, MaxPooling2D
 from keras.models import Model, save_model, load_model
 from keras.callbacks import Callback
-from keras.utils import multi_gpu_model
 from keras.utils import CustomObjectScope
 import keras.backend as K
 
@@ -53,8 +52,9 @@ class Autoencoder(Network):
         self.tensorflow_seed = kwargs.get("tensorflow_seed", 4)
         self.model = None
         tf.set_random_seed(self.tensorflow_seed)
-        self.gpus = [ int(gpu.strip()) for gpu in config.gpu_id.split(",")]
-        print("Using GPUs: {}".format(self.gpus))
+        # data parallel replicas on the GPUs of every worker, see data_parallel_model
+        self.replica_devices = replica_devices(config)
+        print("Using replicas: {}".format(self.replica_devices))
         self.parallel_model = None
 
         self.stateful = kwargs.get("stateful", False)
@@ -118,6 +118,17 @@ class Autoencoder(Network):
 
         self.use_c = config.use_curl
 
+        # float16 layers with float32 master weights, see setup_mixed_precision
+        self.mixed_precision = setup_mixed_precision(config)
+        try:
+            self.loss_scale = config.loss_scale
+        except AttributeError:
+            self.loss_scale = 0.0
+        try:
+            self.gradient_checkpointing = config.gradient_checkpointing
+        except AttributeError:
+            self.gradient_checkpointing = False
+
         self.w_kl = config.w_kl
         self.sparsity = config.sparsity
         self.use_sparse = config.use_sparse
@@ -130,7 +141,12 @@ class Autoencoder(Network):
 
     #---------------------------------------------------------------------------------
     def _init_optimizer(self, epochs=1):
-        self.optimizer = Adam(lr=self.adam_learning_rate, epsilon=self.adam_epsilon, decay=self.adam_lr_decay)
+        if self.mixed_precision:
+            self.optimizer = MixedPrecisionAdam(loss_scale=self.loss_scale, lr=self.adam_learning_rate, epsilon=self.adam_epsilon, decay=self.adam_lr_decay)
+        else:
+            self.optimizer = Adam(lr=self.adam_learning_rate, epsilon=self.adam_epsilon, decay=self.adam_lr_decay)
+        if self.gradient_checkpointing:
+            use_gradient_checkpointing(self.optimizer)
         self.kernel_regularizer = regularizers.l1_l2(l1=self.l1_reg, l2=self.l2_reg)
         return self.optimizer
 
@@ -175,6 +191,7 @@ class Autoencoder(Network):
             x = conv_layer(x, filters=ch, kernel_size=conv_k, stride=1, activation=act, padding='same', kernel_initializer=self.init_func, kernel_regularizer=self.kernel_regularizer, is_3d=is_3d)
 
             x = LeakyReLU(0.3)(x)
+            x = checkpoint_layer(x, self.gradient_checkpointing)
             x0 = x
             layer_num += 1
             for idx in range(repeat_num):
@@ -197,6 +214,7 @@ class Autoencoder(Network):
                     x = conv_layer(x, filters=ch, kernel_size=conv_k, stride=2, activation=act, padding='same', kernel_initializer=self.init_func, kernel_regularizer=self.kernel_regularizer, is_3d=is_3d)
                     x = LeakyReLU(0.3)(x)
                     layer_num += 1
+                    x = checkpoint_layer(x, self.gradient_checkpointing)
                     x0 = x
 
             if self.fully_conv:
@@ -249,6 +267,7 @@ class Autoencoder(Network):
                 x = conv_layer(x, filters=filters, kernel_size=1, stride=1, activation=act, padding='same', kernel_initializer=self.init_func, kernel_regularizer=self.kernel_regularizer, is_3d=is_3d)
                 x = LeakyReLU(0.3)(x)
 
+            x = checkpoint_layer(x, self.gradient_checkpointing)
             x0 = x
 
             for idx in range(repeat_num):
@@ -262,9 +281,11 @@ class Autoencoder(Network):
                         x = upscale_layer(x, is_3d=is_3d)
                         x0 = upscale_layer(x0, is_3d=is_3d)
                         x = Concatenate(axis=-1)([x, x0])
+                        x = checkpoint_layer(x, self.gradient_checkpointing)
                     else:
                         x = Add()([x,x0])
                         x = upscale_layer(x, is_3d=is_3d)
+                        x = checkpoint_layer(x, self.gradient_checkpointing)
                         x0 = x
                 elif not skip_concat:
                     x = Add()([x,x0])
@@ -304,7 +325,7 @@ class Autoencoder(Network):
         self._create_submodels()
 
         # AUTOENCODER #########################################################################################
-        ae_input = Input(shape=self.input_shape, dtype="float32", name=self.name_prefix+"Autoencoder_Input")
+        ae_input = Input(shape=self.input_shape, dtype=K.floatx(), name=self.name_prefix+"Autoencoder_Input")
         z = self._encoder(ae_input)
         print("z: {}".format(z.shape))
 
@@ -314,19 +335,20 @@ class Autoencoder(Network):
         p_pred = self._p_pred(z)
         print("p_pred: {}".format(p_pred.shape))
 
-        if len(self.gpus) > 1:
-            with tf.device('/cpu:0'):
+        if len(self.replica_devices) > 1:
+            with tf.device(parameter_device(self.replica_devices)):
                 self.model = Model(name=self.name_prefix+"Autoencoder", inputs=ae_input, outputs=[ae_output, p_pred])
         else:
             self.model = Model(name=self.name_prefix+"Autoencoder", inputs=ae_input, outputs=[ae_output, p_pred])
 
     #---------------------------------------------------------------------------------
     def _compile_model(self):
-        if len(self.gpus) > 1:
-            self.parallel_model = multi_gpu_model(self.model, gpus=self.gpus)
-            self.parallel_model.compile(loss=self.loss, optimizer=self.optimizer, metrics=self.metrics)
+        if len(self.replica_devices) > 1:
+            self.parallel_model = data_parallel_model(self.model, self.replica_devices)
+            use_data_parallel(self.optimizer, self.parallel_model)
+            compile_model(self.parallel_model, self.mixed_precision, loss=self.loss, optimizer=self.optimizer, metrics=self.metrics)
         else:
-            self.model.compile(loss=self.loss, optimizer=self.optimizer, metrics=self.metrics)
+            compile_model(self.model, self.mixed_precision, loss=self.loss, optimizer=self.optimizer, metrics=self.metrics)
 
     #---------------------------------------------------------------------------------
     def train(self, epochs, **kwargs):
@@ -380,11 +402,12 @@ class Autoencoder(Network):
             assert train_gen_nb_samples > 0, ("Batch size is too large for current scene samples/timestep settings. Training by generator not possible. Please adjust the batch size in the 'settings.json' file.")
             train_generator = batch_manager.generator_ae(batch_size, validation_split, validation=False)
 
-            # validation samples
-            val_gen_nb_samples = batch_manager.steps_per_epoch(batch_size, validation_split, validation=True)
+            # validation samples: every validation window once per epoch, no gradients -> may use larger batches
+            val_batch_size = batch_manager.validation_batch_size if batch_manager.validation_batch_size > 0 else batch_size
+            val_gen_nb_samples = batch_manager.steps_per_epoch(val_batch_size, validation_split, validation=True)
             assert val_gen_nb_samples > 0, ("Batch size is too large for current scene samples/timestep settings. Training by generator not possible. Please adjust the batch size in the 'settings.json' file.")
             print ("Number of validation batch samples per epoch: {}".format(val_gen_nb_samples))
-            validation_generator = batch_manager.generator_ae(batch_size, validation_split, validation=True)
+            validation_generator = batch_manager.generator_ae(val_batch_size, validation_split, validation=True)
 
         try:
             trainingDuration = 0.0
@@ -426,6 +449,7 @@ class Autoencoder(Network):
                         validation_data=validation_generator,
                         validation_steps=val_gen_nb_samples,
                         class_weight=None,
+                        max_queue_size=batch_manager.max_queue_size,
                         workers=1)
             trainingDuration = time.time() - trainStartTime
         except KeyboardInterrupt:
@@ -464,7 +488,7 @@ class Autoencoder(Network):
 
         self._create_submodels()
 
-        with CustomObjectScope({'int_shape': int_shape, 'tf': tf}):
+        with CustomObjectScope(dict(CHECKPOINT_OBJECTS, int_shape=int_shape)):
             # Load Encoder
             if os.path.exists(path + "/encoder_w.h5"):
                 self._encoder.load_weights(path + "/encoder_w.h5", by_name=False)
@@ -529,7 +553,7 @@ class Autoencoder(Network):
 
 from config import get_config
 from utils import prepare_dirs_and_logger
-from keras_data import BatchManager, copy_dataset_info
+from keras_data import BatchManager, TiledInference, copy_dataset_info
 import os
 from utils import save_image
 from LatentSpacePhysics.src.util.requirements import init_packages
@@ -608,6 +632,7 @@ import git
 #---------------------------------------------------------------------------------
 if __name__ == "__main__":
     config, unparsed = get_config()
+    setup_workers(config)
     prepare_dirs_and_logger(config)
 
     config_d = vars(config) if config else {}
@@ -698,34 +723,16 @@ if __name__ == "__main__":
         print("test_data shape: {}".format(test_data.shape))
 
         full_res_image = np.zeros_like(test_data, dtype=np.float32)
-        print("full_res_image shape: {}".format(full_res_image.shape))
-
-        plot_callback = PlotAEFields(ae.predict, None, save_img_to_disk, "./test/", keras_batch_manager)
-
-        from skimage import measure
 
         if keras_batch_manager.tile_generator is not None:
-            while keras_batch_manager.tile_generator.getNextTile():
-                keras_batch_manager.tile_generator.print()
-                tile = keras_batch_manager.tile_generator.cut_tile_2d(test_data)
-                print("tile shape: {}".format(tile.shape))
-                if tiles_use_global:
-                    x_mult = int(keras_batch_manager.tile_generator.data_dim[0] / keras_batch_manager.tile_generator.tile_size[0])
-                    y_mult = int(keras_batch_manager.tile_generator.data_dim[1] / keras_batch_manager.tile_generator.tile_size[1])
-                    z_mult = int(keras_batch_manager.tile_generator.data_dim[2] / keras_batch_manager.tile_generator.tile_size[2])
-                    tile_flag_shape = list(test_data.shape)
-                    tile_flag_shape[-1] = 1
-                    tile_flag = np.zeros(tile_flag_shape)
-                    tile_flag[keras_batch_manager.tile_generator.y_start:keras_batch_manager.tile_generator.y_end, keras_batch_manager.tile_generator.x_start:keras_batch_manager.tile_generator.x_end, :] = 1
-                    # 2:3 -> capture only density part
-                    x_downscale = measure.block_reduce(test_data[...,2:3], (1, y_mult, x_mult, 1), np.mean)
-                    tile_flag_downscale = measure.block_reduce(tile_flag, (1, y_mult, x_mult, 1), np.mean)
-                    tile = np.append(tile, x_downscale, axis=-1)
-                    tile = np.append(tile, tile_flag_downscale, axis=-1)
-                plot_callback._x = tile
-                plot_callback.on_epoch_end(0,0)
-                full_res_image[...,keras_batch_manager.tile_generator.y_start:keras_batch_manager.tile_generator.y_end,
-                keras_batch_manager.tile_generator.x_start:keras_batch_manager.tile_generator.x_end, :] = plot_callback._y
+            try:
+                tile_overlap = config.tile_overlap
+            except AttributeError:
+                tile_overlap = 0
+            # all tiles of the field in one batch and one predict call
+            tiled_inference = TiledInference(ae.predict, keras_batch_manager.tile_generator.tile_size, keras_batch_manager.is_3d, overlap=tile_overlap, use_global=tiles_use_global)
+            full_res_image = tiled_inference.predict(test_data[0])[np.newaxis]
+            print("predicted {} tiles".format(len(tiled_inference.positions)))
         print("full_res_image shape: {}".format(full_res_image.shape))
         save_img_to_disk(full_res_image, 0, "./test/", keras_batch_manager, "EncDec")
         save_img_to_disk(test_data, 0, "./test/", keras_batch_manager, "GT")
\ No newline at end of file
@@ -21,10 +21,9 @@ from keras.layers.pooling import AveragePooling2D, MaxPooling2D
 from keras.models import Model, save_model, load_model
 from keras.callbacks import Callback
 from keras.regularizers import l1_l2, l2
-from keras.utils import multi_gpu_model
 import keras.backend as K
 
-from keras_models_general import model_to_json
+from keras_models_general import model_to_json, setup_mixed_precision, compile_model, MixedPrecisionAdam, setup_workers, replica_devices, parameter_device, data_parallel_model, use_data_parallel
 
 #=====================================================================================
 class Prediction(Network):
@@ -81,8 +80,9 @@ class Prediction(Network):
         self.tensorflow_seed = kwargs.get("tensorflow_seed", 4)
         self.model = None
         tf.set_random_seed(self.tensorflow_seed)
-        self.gpus = [ int(gpu.strip()) for gpu in config.gpu_id.split(",")]
-        print("Using GPUs: {}".format(self.gpus))
+        # data parallel replicas on the GPUs of every worker, see data_parallel_model
+        self.replica_devices = replica_devices(config)
+        print("Using replicas: {}".format(self.replica_devices))
         self.parallel_model = None
 
         # Trainer Variables
@@ -99,6 +99,13 @@ class Prediction(Network):
 
         self.dataset = config.dataset
 
+        # float16 layers with float32 master weights, see setup_mixed_precision
+        self.mixed_precision = setup_mixed_precision(config)
+        try:
+            self.loss_scale = config.loss_scale
+        except AttributeError:
+            self.loss_scale = 0.0
+
     #---------------------------------------------------------------------------------
     def set_states(self, states):
         self.states = states
@@ -110,7 +117,10 @@ class Prediction(Network):
 
     #---------------------------------------------------------------------------------
     def _init_optimizer(self, epochs=1):
-        self.optimizer = Adam(lr=self.adam_learning_rate, epsilon=self.adam_epsilon, decay=self.adam_lr_decay)
+        if self.mixed_precision:
+            self.optimizer = MixedPrecisionAdam(loss_scale=self.loss_scale, lr=self.adam_learning_rate, epsilon=self.adam_epsilon, decay=self.adam_lr_decay)
+        else:
+            self.optimizer = Adam(lr=self.adam_learning_rate, epsilon=self.adam_epsilon, decay=self.adam_lr_decay)
         return self.optimizer
 
     #---------------------------------------------------------------------------------
@@ -124,14 +134,14 @@ class Prediction(Network):
     #---------------------------------------------------------------------------------
     def _build_model(self):
         if self.stateful:
-            pred_input = Input(batch_shape=(self.b_num,) + self.input_shape, dtype="float32", name='Temp_Prediction_Input') # (self.time_steps, self.data_dimension)
+            pred_input = Input(batch_shape=(self.b_num,) + self.input_shape, dtype=K.floatx(), name='Temp_Prediction_Input') # (self.time_steps, self.data_dimension)
         else:
-            pred_input = Input(shape=self.input_shape, dtype="float32", name='Temp_Prediction_Input0') # (self.time_steps, self.data_dimension)
+            pred_input = Input(shape=self.input_shape, dtype=K.floatx(), name='Temp_Prediction_Input0') # (self.time_steps, self.data_dimension)
             if self.in_out_states:
-                state_input_0_0 = Input(shape=(self.encoder_lstm_neurons,), dtype="float32", name='State00_Prediction_Input') 
-                state_input_0_1 = Input(shape=(self.encoder_lstm_neurons,), dtype="float32", name='State01_Prediction_Input') 
-                state_input_1_0 = Input(shape=(self.decoder_lstm_neurons,), dtype="float32", name='State10_Prediction_Input') 
-                state_input_1_1 = Input(shape=(self.decoder_lstm_neurons,), dtype="float32", name='State11_Prediction_Input') 
+                state_input_0_0 = Input(shape=(self.encoder_lstm_neurons,), dtype=K.floatx(), name='State00_Prediction_Input') 
+                state_input_0_1 = Input(shape=(self.encoder_lstm_neurons,), dtype=K.floatx(), name='State01_Prediction_Input') 
+                state_input_1_0 = Input(shape=(self.decoder_lstm_neurons,), dtype=K.floatx(), name='State10_Prediction_Input') 
+                state_input_1_1 = Input(shape=(self.decoder_lstm_neurons,), dtype=K.floatx(), name='State11_Prediction_Input') 
 
         lstm_layer = []
 
@@ -192,8 +202,8 @@ class Prediction(Network):
             inputs.append(state_input_1_0)
             inputs.append(state_input_1_1)
 
-        if len(self.gpus) > 1:
-            with tf.device('/cpu:0'):
+        if len(self.replica_devices) > 1:
+            with tf.device(parameter_device(self.replica_devices)):
                 self.model = Model(name="Prediction", inputs=inputs, outputs=outputs)
         else:
             self.model = Model(name="Prediction", inputs=inputs, outputs=outputs)
@@ -268,11 +278,12 @@ class Prediction(Network):
 
     #---------------------------------------------------------------------------------
     def _compile_model(self):
-        if len(self.gpus) > 1:
-            self.parallel_model = multi_gpu_model(self.model, gpus=self.gpus)
-            self.parallel_model.compile(loss=self.loss, optimizer=self.optimizer, metrics=self.metrics)
+        if len(self.replica_devices) > 1:
+            self.parallel_model = data_parallel_model(self.model, self.replica_devices)
+            use_data_parallel(self.optimizer, self.parallel_model)
+            compile_model(self.parallel_model, self.mixed_precision, loss=self.loss, optimizer=self.optimizer, metrics=self.metrics)
         else:
-            self.model.compile(loss=self.loss, optimizer=self.optimizer, metrics=self.metrics)
+            compile_model(self.model, self.mixed_precision, loss=self.loss, optimizer=self.optimizer, metrics=self.metrics)
 
 
     #--------------------------------------------
@@ -473,6 +484,7 @@ import git
 #---------------------------------------------------------------------------------
 if __name__ == "__main__":
     config, unparsed = get_config()
+    setup_workers(config)
     prepare_dirs_and_logger(config)
 
     config_d = vars(config) if config else {}
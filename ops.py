@@ -251,7 +251,9 @@ def jacobian3(x):
     return j, c
 
 def curl3(x):
-    # x: bzyxd
+    # x: bzyxd; finite differences in float32 also with float16 layers
+    dtype = x.dtype
+    x = tf.cast(x, tf.float32)
     dudx = x[:,:,:,1:,0] - x[:,:,:,:-1,0]
     dvdx = x[:,:,:,1:,1] - x[:,:,:,:-1,1]
     dwdx = x[:,:,:,1:,2] - x[:,:,:,:-1,2]
@@ -285,7 +287,7 @@ def curl3(x):
     #j = tf.stack([dudx,dudy,dudz,dvdx,dvdy,dvdz,dwdx,dwdy,dwdz], axis=-1)
     c = tf.stack([u,v,w], axis=-1)
     
-    return c
+    return tf.cast(c, dtype)
 
 def jacobian(x, data_format='NHWC'):
     print(x.shape)
@@ -325,12 +327,15 @@ def vort(x, data_format='NHWC'):
 def curl(x, data_format='NHWC'):
     if data_format == 'NCHW':
         x = nchw_to_nhwc(x)
+    # finite differences in float32 also with float16 layers
+    dtype = x.dtype
+    x = tf.cast(x, tf.float32)
 
     u = x[:,:-1,:,0] - x[:,1:,:,0] # ds/dy, horizontally flipped
     v = x[:,:,:-1,0] - x[:,:,1:,0] # -ds/dx,
     u = tf.concat([tf.expand_dims(u[:,0,:], axis=1), u], axis=1)
     v = tf.concat([v,tf.expand_dims(v[:,:,-1], axis=2)], axis=2)
-    c = tf.stack([u,v], axis=-1)
+    c = tf.cast(tf.stack([u,v], axis=-1), dtype)
 
     if data_format == 'NCHW':
         c = nhwc_to_nchw(c)
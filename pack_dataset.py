@@ -0,0 +1,66 @@
+import os
+import json
+
+import numpy as np
+
+from config import get_config
+from keras_data import BatchManager, preprocess
+
+#------------------------------------------------------------------------------------------------
+def pack_dataset(batch_manager, packed_path, dtype=np.float32):
+    """ writes every data type of the dataset preprocessed into one (scenes, frames, [z], y, x, c) array, readable by PackedStore """
+    if not os.path.exists(packed_path):
+        os.makedirs(packed_path)
+
+    num_scenes = batch_manager.num_scenes
+    num_frames = batch_manager.num_frames
+    assert len(batch_manager.paths) == num_scenes * num_frames, ("Expected {} scenes with {} frames, found {} samples".format(num_scenes, num_frames, len(batch_manager.paths)))
+
+    den_inflow = "density" in batch_manager.data_type
+    fields = []
+    shapes = {}
+    for i_d, data_type in enumerate(batch_manager.data_type):
+        x, _ = preprocess(batch_manager.paths[0][i_d], data_type, batch_manager.x_range[i_d], batch_manager.y_range, den_inflow=den_inflow)
+        shape = (num_scenes, num_frames) + x.shape
+        shapes[data_type] = list(shape)
+        fields.append(np.lib.format.open_memmap(os.path.join(packed_path, data_type[0]+'.npy'), mode='w+', dtype=dtype, shape=shape))
+    params = np.zeros((num_scenes, num_frames, batch_manager.supervised_param_count), dtype=np.float32)
+
+    for i, file_paths in enumerate(batch_manager.paths):
+        scene = batch_manager.paths.scene[i]
+        frame = batch_manager.paths.frame[i]
+        assert scene < num_scenes and frame < num_frames, ("Sample {} is outside of the dataset bounds".format(file_paths[0]))
+        for i_d, data_type in enumerate(batch_manager.data_type):
+            x, y = preprocess(file_paths[i_d], data_type, batch_manager.x_range[i_d], batch_manager.y_range, den_inflow=den_inflow)
+            fields[i_d][scene, frame] = x
+        params[scene, frame] = y
+        if (i+1) % 1000 == 0:
+            print("Packed {}/{} samples".format(i+1, len(batch_manager.paths)))
+
+    for field in fields:
+        field.flush()
+    del fields
+    np.save(os.path.join(packed_path, 'params.npy'), params)
+
+    meta = {
+        'data_type': batch_manager.data_type,
+        'dtype': np.dtype(dtype).name,
+        'den_inflow': den_inflow,
+        'num_scenes': num_scenes,
+        'num_frames': num_frames,
+        'shape': shapes,
+    }
+    with open(os.path.join(packed_path, 'meta.json'), 'w') as f:
+        json.dump(meta, f, indent=4, sort_keys=True)
+    print("[*] Packed dataset saved: {}".format(packed_path))
+
+#------------------------------------------------------------------------------------------------
+if __name__ == "__main__":
+    # e.g. python pack_dataset.py --dataset=smoke_mov50_f400 --data_type velocity density inflow --packed_dtype=float16
+    config, unparsed = get_config()
+    config.data_path = os.path.join(config.data_dir, config.dataset)
+    config.use_packed = False
+    config.frame_cache_mb = 0
+
+    batch_manager = BatchManager(config, 1, 1)
+    pack_dataset(batch_manager, os.path.join(config.data_path, 'packed'), dtype=np.dtype(config.packed_dtype))
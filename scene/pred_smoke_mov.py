@@ -240,12 +240,12 @@ def main():
 					enc = encode(v_, d_, net, m, pred_config.net_config)
 
 					if pred_args.prediction_type == "enc_only":
-						store_latentspace(enc[0], pred_config.log_dir % i, t, nx, pred_args.field_path_format)
+						store_latentspace(enc[0], pred_config.log_dir % i, t, nx, pred_args.field_path_format, codec=pred_args.frame_codec)
 
 					# Supervised entry
-					enc[0, -1] = nx
+					enc[0, ..., -1] = nx
 					if net.classic_ae:
-						enc[0, net.rec_pred.z_num_vel-1] = nx
+						enc[0, ..., net.rec_pred.z_num_vel-1] = nx
 					net.prediction_history.add_simulation(enc[0])
 
 					if t >= warmup_list[i] and pred_args.prediction_type == "enc_dec":
@@ -265,9 +265,9 @@ def main():
 				cur_pred = predict_ls(net)
 
 				# supervised entries
-				cur_pred[0,-1,-1] = nx
+				cur_pred[0, -1, ..., -1] = nx
 				if net.classic_ae:
-					cur_pred[0, -1, net.rec_pred.z_num_vel-1] = nx
+					cur_pred[0, -1, ..., net.rec_pred.z_num_vel-1] = nx
 
 				# add to history
 				net.prediction_history.add_prediction(cur_pred[0])
@@ -286,8 +286,8 @@ def main():
 				if net.is_3d and pred_args.output_uni:
 					store_density_blender(m.density_upres if pred_args.upres else m.density, pred_config.log_dir % i, t, density_blender=m.density_blender, density_blender_cubic=m.density_blender_cubic)
 
-				store_velocity(v_, pred_config.log_dir % i, t, list(nq), pred_args.field_path_format)
-				store_density(d_, pred_config.log_dir % i, t, list(nq), pred_args.field_path_format)
+				store_velocity(v_, pred_config.log_dir % i, t, list(nq), pred_args.field_path_format, codec=pred_args.frame_codec)
+				store_density(d_, pred_config.log_dir % i, t, list(nq), pred_args.field_path_format, codec=pred_args.frame_codec)
 
 			end = timer()
 			if t > warmup_list[i]:
@@ -232,14 +232,14 @@ def main():
 					enc = encode(v_, d_, net, m, pred_config.net_config)
 
 					if pred_args.prediction_type == "enc_only":
-						store_latentspace(enc[0], pred_config.log_dir % i, t, (px,pz), pred_args.field_path_format)
+						store_latentspace(enc[0], pred_config.log_dir % i, t, (px,pz), pred_args.field_path_format, codec=pred_args.frame_codec)
 
 					# Supervised entry
-					enc[0, -2] = px
-					enc[0, -1] = pz
+					enc[0, ..., -2] = px
+					enc[0, ..., -1] = pz
 					if pred_args.classic_ae:
-						enc[0, rec_pred.z_num_vel-2] = px
-						enc[0, rec_pred.z_num_vel-1] = pz
+						enc[0, ..., rec_pred.z_num_vel-2] = px
+						enc[0, ..., rec_pred.z_num_vel-1] = pz
 					net.prediction_history.add_simulation(enc[0])
 
 					if t >= pred_args.warmup_steps and pred_args.prediction_type == "enc_dec":
@@ -259,11 +259,11 @@ def main():
 				cur_pred = predict_ls(net)
 
 				# supervised entries
-				cur_pred[0,-1,-2] = px
-				cur_pred[0,-1,-1] = pz
+				cur_pred[0, -1, ..., -2] = px
+				cur_pred[0, -1, ..., -1] = pz
 				if pred_args.classic_ae:
-						cur_pred[0, -1, rec_pred.z_num_vel-2] = px
-						cur_pred[0, -1, rec_pred.z_num_vel-1] = pz
+						cur_pred[0, -1, ..., rec_pred.z_num_vel-2] = px
+						cur_pred[0, -1, ..., rec_pred.z_num_vel-1] = pz
 
 				# add to history
 				net.prediction_history.add_prediction(cur_pred[0])
@@ -282,8 +282,8 @@ def main():
 				if net.is_3d and pred_args.output_uni:
 					store_density_blender(m.density_upres if pred_args.upres else m.density, pred_config.log_dir % i, t, density_blender=m.density_blender, density_blender_cubic=m.density_blender_cubic)
 
-				store_velocity(v_, pred_config.log_dir % i, t, [list(nq_x), list(nq_z)], pred_args.field_path_format)
-				store_density(d_, pred_config.log_dir % i, t, [list(nq_x), list(nq_z)], pred_args.field_path_format)
+				store_velocity(v_, pred_config.log_dir % i, t, [list(nq_x), list(nq_z)], pred_args.field_path_format, codec=pred_args.frame_codec)
+				store_density(d_, pred_config.log_dir % i, t, [list(nq_x), list(nq_z)], pred_args.field_path_format, codec=pred_args.frame_codec)
 
 			end = timer()
 			if t > pred_args.warmup_steps:
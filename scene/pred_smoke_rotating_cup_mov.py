@@ -261,11 +261,11 @@ def main():
 					enc = encode(v_, d_, net, m, pred_config.net_config)
 
 					# Set supervised parameters -> (batch, dim)
-					enc[0, -2] = norm_curRotAngle
-					enc[0, -1] = norm_pz_pos
+					enc[0, ..., -2] = norm_curRotAngle
+					enc[0, ..., -1] = norm_pz_pos
 					if net.classic_ae:
-						enc[0, net.rec_pred.z_num_vel-2] = norm_curRotAngle
-						enc[0, net.rec_pred.z_num_vel-1] = norm_pz_pos
+						enc[0, ..., net.rec_pred.z_num_vel-2] = norm_curRotAngle
+						enc[0, ..., net.rec_pred.z_num_vel-1] = norm_pz_pos
 					net.prediction_history.add_simulation(enc[0])
 
 					if t >= pred_args.warmup_steps and pred_args.prediction_type == "enc_dec":
@@ -286,11 +286,11 @@ def main():
 				cur_pred = predict_ls(net)
 
 				# supervised entries
-				cur_pred[0,-1,-2] = norm_curRotAngle
-				cur_pred[0,-1,-1] = norm_pz_pos
+				cur_pred[0, -1, ..., -2] = norm_curRotAngle
+				cur_pred[0, -1, ..., -1] = norm_pz_pos
 				if net.classic_ae:
-					cur_pred[0, -1, net.rec_pred.z_num_vel-2] = norm_curRotAngle
-					cur_pred[0, -1, net.rec_pred.z_num_vel-1] = norm_pz_pos
+					cur_pred[0, -1, ..., net.rec_pred.z_num_vel-2] = norm_curRotAngle
+					cur_pred[0, -1, ..., net.rec_pred.z_num_vel-1] = norm_pz_pos
 
 				# add to history
 				net.prediction_history.add_prediction(cur_pred[0])
@@ -306,8 +306,8 @@ def main():
 				if net.is_3d and pred_args.output_uni:
 					store_density_blender(m.density_upres if pred_args.upres else m.density, pred_config.log_dir % i, t, density_blender=m.density_blender, density_blender_cubic=m.density_blender_cubic)
 
-				store_velocity(v_, pred_config.log_dir % i, t, param_, pred_args.field_path_format)
-				store_density(d_, pred_config.log_dir % i, t, param_, pred_args.field_path_format)
+				store_velocity(v_, pred_config.log_dir % i, t, param_, pred_args.field_path_format, codec=pred_args.frame_codec)
+				store_density(d_, pred_config.log_dir % i, t, param_, pred_args.field_path_format, codec=pred_args.frame_codec)
 
 			end = timer()
 			if t > pred_args.warmup_steps:
@@ -12,7 +12,8 @@ import sys
 sys.path.append(sys.path[0]+"/../")
 sys.path.append(sys.path[0]+"/../LatentSpacePhysics/src/")
 
-from keras_data import read_args_file
+from keras_data import read_args_file, TiledInference
+import frame_codec
 
 prediction_types = ["vel_den_prediction", "vel_prediction", "simulation", "enc_dec", "enc_only", "vel_ls_prediction"]
 screenshot_path_format = "%06d.jpg"
@@ -29,6 +30,7 @@ def add_storage_args(parser):
     parser.add_argument('--prediction_type', type=str, default=prediction_types[0], choices=prediction_types)
     parser.add_argument("--screenshot_path_format", type=str, default='%06d.jpg')
     parser.add_argument("--field_path_format", type=str, default='%06d.npz')
+    parser.add_argument("--frame_codec", type=str, default='zlib') # none, zlib[:level], lz4[:level], zstd[:level]
 
 #----------------------------------------------------------------------------------
 def get_path_to_sim(pred_scene_name, model_name, pred_type, seed):
@@ -151,12 +153,12 @@ def shelve_file_to_var(storage_path):
     return shelve_vars
 
 #----------------------------------------------------------------------------------
-def store_latentspace(field, path, frame_count, param, field_path_format=field_path_format):
+def store_latentspace(field, path, frame_count, param, field_path_format=field_path_format, codec='zlib'):
     ls_file_path = os.path.join(path, 'ls')
     if not os.path.exists(ls_file_path):
 	    os.makedirs(ls_file_path)
     ls_file_path = os.path.join(ls_file_path, field_path_format % frame_count)
-    np.savez_compressed(ls_file_path,
+    frame_codec.save(ls_file_path, codec,
                         x=field,
                         y=param)
 
@@ -165,7 +167,8 @@ def load_velocity(path, frame_count, field_path_format=field_path_format):
     v_file_path = os.path.join(path, 'v')
     assert os.path.exists(v_file_path), "File path '{}' to velocity field does not exist!".format(v_file_path)
     v_file_path = os.path.join(v_file_path, field_path_format % frame_count)
-    v = np.load(v_file_path)["x"]
+    with frame_codec.load(v_file_path) as data:
+        v = data["x"]
     if v.ndim < 4:
         v = np.expand_dims(v, axis=0)
     if v.shape[-1] < 3:
@@ -176,25 +179,25 @@ def load_velocity(path, frame_count, field_path_format=field_path_format):
     return v
 
 #----------------------------------------------------------------------------------
-def store_velocity(field, path, frame_count, param, field_path_format=field_path_format):
+def store_velocity(field, path, frame_count, param, field_path_format=field_path_format, codec='zlib'):
     v_file_path = os.path.join(path, 'v')
     if not os.path.exists(v_file_path):
 	    os.makedirs(v_file_path)
     v_file_path = os.path.join(v_file_path, field_path_format % frame_count)
     is_3d = field.shape[0] > 1
     v_store = np.squeeze(field[...,:3 if is_3d else 2], axis=0) if field.shape[0] == 1 else field[...,:3 if is_3d else 2]
-    np.savez_compressed(v_file_path,
+    frame_codec.save(v_file_path, codec,
                         x=v_store,
                         y=param)
     return v_file_path
 
 #----------------------------------------------------------------------------------
-def store_pressure(field, path, frame_count, param, field_path_format=field_path_format):
+def store_pressure(field, path, frame_count, param, field_path_format=field_path_format, codec='zlib'):
     p_file_path = os.path.join(path, 'p')
     if not os.path.exists(p_file_path):
 	    os.makedirs(p_file_path)
     p_file_path = os.path.join(p_file_path, field_path_format % frame_count)
-    np.savez_compressed(p_file_path,
+    frame_codec.save(p_file_path, codec,
                         x=field,
                         y=param)
 
@@ -203,28 +206,29 @@ def load_density(path, frame_count, field_path_format=field_path_format):
     d_file_path = os.path.join(path, 'd')
     assert os.path.exists(d_file_path), "File path '{}' to density field does not exist!".format(d_file_path)
     d_file_path = os.path.join(d_file_path, field_path_format % frame_count)
-    d = np.load(d_file_path)["x"]
+    with frame_codec.load(d_file_path) as data:
+        d = data["x"]
     if d.ndim < 4:
         d = np.expand_dims(d, axis=0)
     return d
 
 #----------------------------------------------------------------------------------
-def store_density(field, path, frame_count, param, field_path_format=field_path_format):
+def store_density(field, path, frame_count, param, field_path_format=field_path_format, codec='zlib'):
     d_file_path = os.path.join(path, 'd')
     if not os.path.exists(d_file_path):
 	    os.makedirs(d_file_path)
     d_file_path = os.path.join(d_file_path, field_path_format % frame_count)
-    np.savez_compressed(d_file_path,
+    frame_codec.save(d_file_path, codec,
                         x=field,
                         y=param)
 
 #----------------------------------------------------------------------------------
-def store_levelset(field, path, frame_count, param, field_path_format=field_path_format):
+def store_levelset(field, path, frame_count, param, field_path_format=field_path_format, codec='zlib'):
     l_file_path = os.path.join(path, 'l')
     if not os.path.exists(l_file_path):
 	    os.makedirs(l_file_path)
     l_file_path = os.path.join(l_file_path, field_path_format % frame_count)
-    np.savez_compressed(l_file_path,
+    frame_codec.save(l_file_path, codec,
                         x=field,
                         y=param)
 
@@ -321,6 +325,7 @@ def convert_sequence(path, output_name="output", file_format="%06d.jpg", delete_
 # Prediction History and Network Initialization
 #----------------------------------------------------------------------------------
 class PredictionHistory(object):
+    # data_shape is (z,) or (tiles, z) for a tiled field
     def __init__(self, in_ts, data_shape):
         self.lstm_input_shape = (1, in_ts) # (batch_size, in_ts)
         self.data_shape = data_shape #(1, 1, 1, 1024)
@@ -367,15 +372,26 @@ def initialize_networks(args, config, norm_factors):
     net.res_x = int(net.dataset_meta_info["resolution_x"])
     net.res_y = int(net.dataset_meta_info["resolution_y"])
     net.res_z = int(net.dataset_meta_info["resolution_z"])
-    # prepare input shape
+    # prepare input shape; a model trained on tiles (--res_* smaller than the dataset) gets the fields of the scene tile by tile
     in_out_dim = 3 if "density" in config.data_type else 2
     in_out_dim = in_out_dim + 1 if config.is_3d else in_out_dim
+    net.is_3d = net.res_z > 1
+    model_res = [config.res_x, config.res_y, config.res_z if net.is_3d else 1]
+    net.tiled = None
+    if model_res != [net.res_x, net.res_y, net.res_z]:
+        try:
+            overlap = config.tile_overlap
+        except AttributeError:
+            overlap = 0
+        net.tiled = TiledInference(None, model_res, net.is_3d, overlap=overlap, batch_size=config.batch_size)
+        # the tile positions of the scene resolution, used by stitch
+        net.tiled.tiles(np.zeros(([net.res_z] if net.is_3d else []) + [net.res_y, net.res_x, in_out_dim], dtype=np.float32))
+        print("Tiled inference: {} tiles of {} per field".format(len(net.tiled.positions), model_res))
     net.input_shape = (config.input_frame_count,)
-    net.input_shape += (net.res_z,) if config.is_3d else ()
-    net.input_shape += (net.res_y, net.res_x, in_out_dim)
+    net.input_shape += (model_res[2],) if config.is_3d else ()
+    net.input_shape += (model_res[1], model_res[0], in_out_dim)
     # create models
     net.classic_ae = args.classic_ae
-    net.is_3d = net.res_z > 1
     if net.classic_ae:
         net.rec_pred = RecursivePredictionCleanSplit(config=config, input_shape=net.input_shape, decode_predictions=config.decode_predictions, skip_pred_steps=config.skip_pred_steps, init_state_network=config.init_state_network, in_out_states=config.in_out_states, pred_gradient_loss=config.pred_gradient_loss, ls_prediction_loss=config.ls_prediction_loss, ls_supervision=config.ls_supervision, sqrd_diff_loss=config.sqrd_diff_loss, ls_split=config.ls_split, supervised_parameters=net.sup_param_count)
     else:
@@ -386,10 +402,25 @@ def initialize_networks(args, config, norm_factors):
     net.pred = Prediction(config=net.rec_pred.config, input_shape=(net.rec_pred.w_num, net.rec_pred.z_num))
     net.pred._build_model()
     net.pred.model.set_weights(net.rec_pred.pred.model.get_weights())
-    # create prediction history
-    net.prediction_history = PredictionHistory(in_ts=net.rec_pred.w_num, data_shape=(net.rec_pred.z_num,)) 
+    # create prediction history; one latent code per tile
+    net.prediction_history = PredictionHistory(in_ts=net.rec_pred.w_num, data_shape=((len(net.tiled.positions),) if net.tiled else ()) + (net.rec_pred.z_num,)) 
     return net
 
+#----------------------------------------------------------------------------------
+def encoder_predict(encoder, input_arr, net):
+    """ encodes input_arr (1, [z,] y, x, c) -> (1, z); a tiled field is encoded as one batch of tiles -> (1, tiles, z) """
+    if net.tiled is None:
+        return encoder.predict(input_arr, batch_size=1)
+    return encoder.predict(net.tiled.tiles(input_arr[0]), batch_size=net.tiled.batch_size)[np.newaxis]
+
+#----------------------------------------------------------------------------------
+def decoder_predict(decoder, cur_ls_frame, net):
+    """ decodes cur_ls_frame (1, z) -> (1, [z,] y, x, c); a tiled field (1, tiles, z) is decoded as one batch and stitched """
+    if net.tiled is None:
+        return decoder.predict(x=cur_ls_frame, batch_size=1)
+    assert cur_ls_frame.shape[0] == 1, ("Tiled inference decodes a single frame, got {}".format(cur_ls_frame.shape))
+    return net.tiled.stitch(decoder.predict(x=cur_ls_frame[0], batch_size=net.tiled.batch_size))[np.newaxis]
+
 #----------------------------------------------------------------------------------
 # Solver / Manta Wrapper
 #----------------------------------------------------------------------------------
@@ -479,11 +510,11 @@ def encode(v_, d_, net, m, config):
             velo_dim = 3
         else: 
             velo_dim = 2
-        enc_v_part = net.rec_pred.ae_v._encoder.predict(input_arr[...,:velo_dim], batch_size=1)
-        enc_d_part = net.rec_pred.ae_d._encoder.predict(input_arr[...,velo_dim:], batch_size=1)
+        enc_v_part = encoder_predict(net.rec_pred.ae_v._encoder, input_arr[...,:velo_dim], net)
+        enc_d_part = encoder_predict(net.rec_pred.ae_d._encoder, input_arr[...,velo_dim:], net)
         enc = np.concatenate([enc_v_part,enc_d_part],axis=-1)
     else:
-        enc = net.rec_pred.ae._encoder.predict(input_arr, batch_size=1)
+        enc = encoder_predict(net.rec_pred.ae._encoder, input_arr, net)
     return enc
 
 #----------------------------------------------------------------------------------
@@ -503,24 +534,24 @@ def encode_density(v_, d_, net, m):
             velo_dim = 3
         else: 
             velo_dim = 2
-        enc_d = net.rec_pred.ae_d._encoder.predict(input_arr[...,velo_dim:], batch_size=1)
+        enc_d = encoder_predict(net.rec_pred.ae_d._encoder, input_arr[...,velo_dim:], net)
         # Keep supervised param
-        net.prediction_history.simulation_history[0, -1, net.rec_pred.z_num_vel:-net.sup_param_count] = enc_d[0, 0:-net.sup_param_count]
+        net.prediction_history.simulation_history[0, -1, ..., net.rec_pred.z_num_vel:-net.sup_param_count] = enc_d[0, ..., 0:-net.sup_param_count]
     else:
-        enc_d = net.rec_pred.ae._encoder.predict(input_arr, batch_size=1)
+        enc_d = encoder_predict(net.rec_pred.ae._encoder, input_arr, net)
         # 2) replace density part of sim history (maybe overwrite "wrong" vel parts with zero)
-        enc_d[0, :net.rec_pred.ls_split_idx] = 0.0 # overwrite velo components
+        enc_d[0, ..., :net.rec_pred.ls_split_idx] = 0.0 # overwrite velo components
         # Keep supervised param
-        net.prediction_history.simulation_history[0, -1, net.rec_pred.ls_split_idx:-net.sup_param_count] = enc_d[0, net.rec_pred.ls_split_idx:-net.sup_param_count]
+        net.prediction_history.simulation_history[0, -1, ..., net.rec_pred.ls_split_idx:-net.sup_param_count] = enc_d[0, ..., net.rec_pred.ls_split_idx:-net.sup_param_count]
 
 #----------------------------------------------------------------------------------
 def decode(cur_ls_frame, net, m, config, prediction_type):
     if net.classic_ae:
-        np_pred_v = net.rec_pred.ae_v._decoder.predict(x=cur_ls_frame[...,:net.rec_pred.z_num_vel], batch_size=1)
-        np_pred_d = net.rec_pred.ae_d._decoder.predict(x=cur_ls_frame[...,net.rec_pred.z_num_vel:], batch_size=1)
+        np_pred_v = decoder_predict(net.rec_pred.ae_v._decoder, cur_ls_frame[...,:net.rec_pred.z_num_vel], net)
+        np_pred_d = decoder_predict(net.rec_pred.ae_d._decoder, cur_ls_frame[...,net.rec_pred.z_num_vel:], net)
         np_pred = np.concatenate([np_pred_v, np_pred_d],axis=-1)
     else:
-        np_pred = net.rec_pred.ae._decoder.predict(x=cur_ls_frame, batch_size=1)
+        np_pred = decoder_predict(net.rec_pred.ae._decoder, cur_ls_frame, net)
     # velocity
     if net.is_3d:
         np_vel = np_pred[:,:,:,:,:3] * net.norm_factors["normalization_factor_v"]
@@ -559,6 +590,12 @@ def decode(cur_ls_frame, net, m, config, prediction_type):
 def predict_ls(net):
     # predict new field
     X = net.prediction_history.get()
+    if net.tiled is not None:
+        # (1, in_ts, tiles, z) -> one sequence per tile, the result is (1, out_ts, tiles, z)
+        X = X[0].transpose(1, 0, 2)
+        pred_delta_z = net.pred.model.predict(X, batch_size=net.tiled.batch_size)
+        cur_pred = X[:, -1:] + pred_delta_z
+        return cur_pred.transpose(1, 0, 2)[np.newaxis]
     # e.g. X.shape = (1, 16, 1, 1, 1, 2048)
     X = X.reshape(*X.shape[0:2], -1)  # e.g. (1, 16, 2048)
     pred_delta_z = net.pred.model.predict(X, batch_size=X.shape[0])
@@ -572,12 +609,39 @@ def save_npz(arr, arr_range, name, i, t, param, args):
     arr_store = np.squeeze(arr, axis=0) if arr.shape[0] == 1 else arr
     arr_range = [np.minimum(arr_range[0], arr_store.min()),
                 np.maximum(arr_range[1], arr_store.max())]
+    # the range is taken at full precision. float16 rounds to 11 significant bits: relative error <= 2^-11 (4.9e-4).
+    # after normalization: velocity /max|range| -> <= 2^-11 (4.9e-4); density and inflow in [0, 1] *2-1 -> <= 2^-10 (9.8e-4).
+    # |values| < 6.1e-5 are subnormal with absolute error <= 2^-25
+    try:
+        field_dtype = args.field_dtype
+    except AttributeError:
+        field_dtype = 'float32'
+    if field_dtype == 'float16':
+        assert np.abs(arr_store).max() < np.finfo(np.float16).max, ("{} exceeds the float16 range".format(name))
+        arr_store = arr_store.astype(np.float16)
+    try:
+        codec = args.frame_codec
+    except AttributeError:
+        codec = 'zlib'
     arr_file_path = os.path.join(args.log_dir, name, args.path_format % (i, t))
-    np.savez_compressed(arr_file_path,
+    frame_codec.save(arr_file_path, codec,
                         x=arr_store, # yxzd for 3d
-                        y=param)
+                        y=current_params(param))
     return arr_range
 
+#----------------------------------------------------------------------------------
+def current_params(param):
+    """ last entry of the parameter history (or of each history for multiple params); keeps the nesting, so y[-1] and y[i][-1] stay valid """
+    if isinstance(param[0], (list, tuple, np.ndarray)):
+        return np.array([[p[-1]] for p in param], dtype=np.float32)
+    return np.array([param[-1]], dtype=np.float32)
+
+#----------------------------------------------------------------------------------
+def param_table(*param_lists):
+    """ per scene trajectories (scenes, frames) of each control param -> (scenes, frames, params), stored as 'y' in n.npz.
+        y[scene, t] equals the current params stored with frame t """
+    return np.stack([np.asarray(p, dtype=np.float32) for p in param_lists], axis=-1)
+
 #----------------------------------------------------------------------------------
 def save_range(quantity_range, name, args):
     range_file = os.path.join(args.log_dir, '{}_range.txt'.format(name))
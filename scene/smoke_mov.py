@@ -26,6 +26,8 @@ parser.add_argument("--log_dir", type=str, default='data/smoke_mov{}_f{}')
 
 parser.add_argument("--num_param", type=int, default=3)
 parser.add_argument("--path_format", type=str, default='%d_%d.npz')
+parser.add_argument("--field_dtype", type=str, default='float32', choices=['float32', 'float16']) # float16 halves the dataset size, see save_npz
+parser.add_argument("--frame_codec", type=str, default='zlib') # none, zlib[:level], lz4[:level], zstd[:level]; detected when loading
 parser.add_argument("--screenshot_path_format", type=str, default='%d_%d.jpg')
 parser.add_argument("--p0", type=str, default='scenes')
 parser.add_argument("--p1", type=str, default='frames')
@@ -194,7 +196,7 @@ def main():
 
 	# Store controllable parameters
 	n_path = os.path.join(args.log_dir, 'n.npz')
-	np.savez_compressed(n_path, n=n_list)
+	np.savez_compressed(n_path, n=n_list, y=param_table(n_list))
 
 	# Store data range
 	save_range(v_range, "v", args)
@@ -36,6 +36,8 @@ parser.add_argument("--log_dir", type=str, default='data/smoke_rot_cup_mov{}_f{}
 
 parser.add_argument("--num_param", type=int, default=4)
 parser.add_argument("--path_format", type=str, default='%d_%d.npz')
+parser.add_argument("--field_dtype", type=str, default='float32', choices=['float32', 'float16']) # float16 halves the dataset size, see save_npz
+parser.add_argument("--frame_codec", type=str, default='zlib') # none, zlib[:level], lz4[:level], zstd[:level]; detected when loading
 parser.add_argument("--screenshot_path_format", type=str, default='%d_%d.jpg')
 parser.add_argument("--p0", type=str, default='scenes')
 parser.add_argument("--p1", type=str, default='frames')
@@ -350,7 +352,7 @@ def main():
 		convert_sequence( os.path.join(args.log_dir, 'screenshots/phi_obs'), output_name=args.log_dir.rsplit("/",1)[-1], file_format="%06d.jpg" if m.gui else "%06d.ppm", delete_images=not dont_delete_images )
 
 	n_path = os.path.join(args.log_dir, 'n.npz')
-	np.savez_compressed(n_path, nx=n_rot_list, nz=n_pos_list)
+	np.savez_compressed(n_path, nx=n_rot_list, nz=n_pos_list, y=param_table(n_rot_list, n_pos_list))
 
 	# Store data range
 	save_range(v_range, "v", args)
@@ -0,0 +1,76 @@
+import os
+import sys
+
+import numpy as np
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+#------------------------------------------------------------------------------------------------
+def make_dataset(root, num_scenes=4, num_frames=12, res_x=16, res_y=24, types=("v", "d", "i"), codec="zlib", seed=0):
+    """ small 2d dataset in the layout of the generation scenes: <type>/<scene>_<frame>.npz, n.npz, args.txt and the range files """
+    import frame_codec
+    rng = np.random.RandomState(seed)
+    for t in types:
+        os.makedirs(os.path.join(root, t))
+    src_pos = rng.uniform(0.1, 0.9, size=(num_scenes, num_frames))
+    for s in range(num_scenes):
+        for f in range(num_frames):
+            v = rng.randn(res_y, res_x, 2).astype(np.float32)
+            d = rng.rand(res_y, res_x).astype(np.float32)
+            d[:res_y // 2] = 0.0
+            fields = {"v": v, "d": d, "i": (d > 0.9).astype(np.float32)}
+            for t in types:
+                frame_codec.save(os.path.join(root, t, "{}_{}.npz".format(s, f)), codec, x=fields[t], y=np.array([src_pos[s, f]], dtype=np.float32))
+    np.savez_compressed(os.path.join(root, "n.npz"), n=src_pos)
+    args = [("num_param", 3), ("p0", "scenes"), ("p1", "frames"), ("p2", "src_pos"),
+            ("min_scenes", 0), ("max_scenes", num_scenes - 1), ("num_scenes", num_scenes),
+            ("min_frames", 0), ("max_frames", num_frames - 1), ("num_frames", num_frames),
+            ("min_src_pos", 0.1), ("max_src_pos", 0.9), ("num_src_pos", num_frames),
+            ("resolution_x", res_x), ("resolution_y", res_y), ("resolution_z", 1), ("time_step", 0.5),
+            ("path_format", "%d_%d.npz"), ("log_dir", root)]
+    with open(os.path.join(root, "args.txt"), "w") as f:
+        for arg, value in args:
+            f.write("{}: {}\n".format(arg, value))
+    for t, (lo, hi) in (("v", (-3, 3)), ("d", (0, 1)), ("i", (0, 1))):
+        with open(os.path.join(root, t + "_range.txt"), "w") as f:
+            f.write("{:.3f}\n{:.3f}".format(lo, hi))
+    return root
+
+#------------------------------------------------------------------------------------------------
+class Config(object):
+    """ the config.py arguments BatchManager reads """
+    def __init__(self, data_path, **kwargs):
+        self.data_path = data_path
+        self.dataset = os.path.basename(data_path)
+        self.random_seed = 123
+        self.is_3d = False
+        self.batch_size = 4
+        self.data_type = ["velocity", "density", "inflow"]
+        self.res_x = 16
+        self.res_y = 24
+        self.res_z = 1
+        self.z_num = 16
+        self.tiles_per_sample = 4
+        self.tiles_use_global = False
+        self.tile_scale = 1
+        self.tile_multitile_border = 0
+        self.only_last_prediction = False
+        self.frame_cache_mb = 0
+        self.__dict__.update(kwargs)
+
+#------------------------------------------------------------------------------------------------
+@pytest.fixture
+def keras_data():
+    # keras_data imports tensorflow and matplotlib at module level
+    pytest.importorskip("tensorflow")
+    pytest.importorskip("matplotlib")
+    pytest.importorskip("skimage")
+    import keras_data
+    return keras_data
+
+#------------------------------------------------------------------------------------------------
+@pytest.fixture
+def dataset(tmp_path):
+    return make_dataset(os.path.join(str(tmp_path), "ds"))
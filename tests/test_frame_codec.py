@@ -0,0 +1,68 @@
+import os
+
+import numpy as np
+import pytest
+
+import frame_codec
+
+CODECS = ["none", "zlib", "zlib:1", "lz4", "lz4:4", "zstd", "zstd:9"]
+
+#------------------------------------------------------------------------------------------------
+@pytest.mark.parametrize("codec", CODECS)
+@pytest.mark.parametrize("dtype", [np.float32, np.float16])
+def test_round_trip(tmp_path, codec, dtype):
+    file_path = os.path.join(str(tmp_path), "0_0.npz")
+    x = np.random.RandomState(0).randn(6, 8, 2).astype(dtype)
+    y = np.array([[0.1], [0.7]], dtype=np.float32)
+
+    frame_codec.save(file_path, codec, x=x, y=y)
+
+    assert os.listdir(str(tmp_path)) == ["0_0.npz"]
+    with frame_codec.load(file_path) as data:
+        assert sorted(data.files) == ["x", "y"]
+        assert data['x'].dtype == dtype
+        np.testing.assert_array_equal(data['x'], x)
+        np.testing.assert_array_equal(data['y'], y)
+        # the loaders normalize in place
+        data['x'][...] *= 2.0
+
+#------------------------------------------------------------------------------------------------
+def test_container_header(tmp_path):
+    file_path = os.path.join(str(tmp_path), "0_0.npz")
+    frame_codec.save(file_path, "zlib:1", x=np.zeros(4))
+    with open(file_path, 'rb') as f:
+        assert f.read(len(frame_codec.MAGIC)) == frame_codec.MAGIC
+    frame_codec.save(file_path, "zlib", x=np.zeros(4))
+    with open(file_path, 'rb') as f:
+        assert f.read(2) == b'PK'
+
+#------------------------------------------------------------------------------------------------
+def test_load_decompresses_on_access(tmp_path, monkeypatch):
+    file_path = os.path.join(str(tmp_path), "0_0.npz")
+    frame_codec.save(file_path, "zlib:1", x=np.ones((32, 32), dtype=np.float32), y=np.array([0.5], dtype=np.float32))
+    sizes = []
+    decompressor = frame_codec._decompressor
+    def counting_decompressor(name):
+        decompress = decompressor(name)
+        def counted(data):
+            sizes.append(len(data))
+            return decompress(data)
+        return counted
+    monkeypatch.setattr(frame_codec, "_decompressor", counting_decompressor)
+
+    with frame_codec.load(file_path) as data:
+        assert 'x' in data and 'z' not in data
+        assert sizes == []
+        np.testing.assert_array_equal(data['y'], [0.5])
+        assert len(sizes) == 1
+        data['y']
+        assert len(sizes) == 1
+        assert data['x'].shape == (32, 32)
+        assert len(sizes) == 2
+
+#------------------------------------------------------------------------------------------------
+def test_parse_codec():
+    assert frame_codec.parse_codec("zstd:3") == ("zstd", 3)
+    assert frame_codec.parse_codec("lz4") == ("lz4", None)
+    with pytest.raises(AssertionError):
+        frame_codec.parse_codec("gzip")
@@ -0,0 +1,343 @@
+import os
+from argparse import Namespace
+
+import numpy as np
+import pytest
+
+from conftest import Config, make_dataset
+
+#------------------------------------------------------------------------------------------------
+def test_tfdata_backend_falls_back_for_tiles_use_global(keras_data, dataset):
+    config = Config(dataset, data_backend="tfdata", tiles_use_global=True, res_x=8, res_y=8)
+    bm = keras_data.BatchManager(config, 3, 2)
+    assert bm.use_tiles
+
+    x, (x_target, y) = next(bm.generator_ae(4, 0.25))
+
+    # velocity, density and inflow plus the density downscale and the tile flag of the global information
+    assert x.shape == (4, 3, 8, 8, 4 + 2)
+    assert y.shape == (4, 3, 1)
+
+#------------------------------------------------------------------------------------------------
+def test_dataset_index(keras_data, dataset):
+    args_path = os.path.join(dataset, "args.txt")
+    index = keras_data.DatasetIndex.load(dataset, ["velocity", "density"], args_path)
+
+    assert len(index) == 4 * 12
+    assert index[13] == (os.path.join(dataset, "v", "1_1.npz"), os.path.join(dataset, "d", "1_1.npz"))
+    assert sorted(os.listdir(dataset)).count("dataset_index_vd.npz") == 1
+    assert not [f for f in os.listdir(dataset) if f.endswith(".tmp")]
+
+    # other type lists get their own index file, the existing one is read back
+    os.remove(os.path.join(dataset, "i", "3_11.npz"))
+    index_vdi = keras_data.DatasetIndex.load(dataset, ["velocity", "density", "inflow"], args_path)
+    assert len(index_vdi) == 4 * 12 - 1
+    cached = keras_data.DatasetIndex.load(dataset, ["velocity", "density"], args_path)
+    np.testing.assert_array_equal(cached.scene, index.scene)
+    np.testing.assert_array_equal(cached.frame, index.frame)
+
+#------------------------------------------------------------------------------------------------
+def test_dataset_index_read_only(keras_data, dataset, monkeypatch):
+    def replace(src, dst):
+        raise PermissionError(13, "Permission denied", dst)
+    monkeypatch.setattr(os, "replace", replace)
+
+    index = keras_data.DatasetIndex.load(dataset, ["velocity", "density", "inflow"], os.path.join(dataset, "args.txt"))
+
+    assert len(index) == 4 * 12
+    assert not [f for f in os.listdir(dataset) if f.startswith("dataset_index")]
+
+#------------------------------------------------------------------------------------------------
+def test_shared_cache_per_dataset_root(keras_data, tmp_path):
+    cache_dir = os.path.join(str(tmp_path), "cache")
+    fields = []
+    for i, data_dir in enumerate(["a", "b"]):
+        # same dataset name in two data dirs
+        dataset = make_dataset(os.path.join(str(tmp_path), data_dir, "ds"), seed=i)
+        bm = keras_data.BatchManager(Config(dataset, shared_cache_dir=cache_dir), 3, 2)
+        assert bm.packed is not None
+        x, _ = bm.packed.frame(1, 2, 0)
+        expected, _ = keras_data.preprocess(os.path.join(dataset, "v", "1_2.npz"), "velocity", bm.x_range[0], bm.y_range)
+        np.testing.assert_allclose(x, expected)
+        fields.append(x)
+    assert not np.allclose(fields[0], fields[1])
+    assert len([name for name in os.listdir(cache_dir) if name.startswith("ds_") and not name.endswith(".lock")]) == 2
+
+#------------------------------------------------------------------------------------------------
+def test_shared_cache_attach_waits_for_rebuild(keras_data, dataset, tmp_path):
+    import fcntl
+    import threading
+    cache_dir = os.path.join(str(tmp_path), "cache")
+    keras_data.BatchManager(Config(dataset, shared_cache_dir=cache_dir), 3, 2)
+    lock_path = [os.path.join(cache_dir, name) for name in os.listdir(cache_dir) if name.endswith(".lock")][0]
+
+    # a run rebuilding the copy holds the lock exclusively: attaching to the current copy waits until it is released
+    attached = []
+    with open(lock_path, "w") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        thread = threading.Thread(target=lambda: attached.append(keras_data.BatchManager(Config(dataset, shared_cache_dir=cache_dir), 3, 2)))
+        thread.start()
+        thread.join(0.5)
+        assert not attached
+        fcntl.flock(lock, fcntl.LOCK_UN)
+    thread.join()
+    assert attached[0].packed is not None
+
+#------------------------------------------------------------------------------------------------
+def test_batch_buffers_outlive_keras_queue(keras_data, dataset):
+    bm = keras_data.BatchManager(Config(dataset, max_queue_size=2), 3, 2)
+    assert bm.batch_buffer_count == 4
+    gen = bm.generator_ae(4, 0.25)
+
+    # two batches wait in the queue and one is trained on while the generator fills the next one
+    batches = [next(gen) for _ in range(3)]
+    copies = [(x.copy(), y.copy()) for x, (_, y) in batches]
+    next(gen)
+    for (x, (_, y)), (x_copy, y_copy) in zip(batches, copies):
+        np.testing.assert_array_equal(x, x_copy)
+        np.testing.assert_array_equal(y, y_copy)
+
+#------------------------------------------------------------------------------------------------
+def test_frame_cache_budget(keras_data, dataset):
+    assert keras_data.BatchManager(Config(dataset), 3, 2).frame_cache is None
+
+    bm = keras_data.BatchManager(Config(dataset, frame_cache_mb=8, num_worker=3), 3, 2)
+    # three training and one validation loader process
+    assert bm.frame_cache.max_bytes == 2 * 1024 * 1024
+
+    bm = keras_data.BatchManager(Config(dataset, frame_cache_mb=8), 3, 2)
+    x, _ = bm.load_frame(1, 2, 0)
+    assert bm.load_frame(1, 2, 0)[0] is x
+    assert bm.frame_cache.hits == 1 and bm.frame_cache.misses == 1
+
+#------------------------------------------------------------------------------------------------
+def test_sequence_field_mask(keras_data, dataset):
+    bm = keras_data.BatchManager(Config(dataset), 4, 2)
+    # velocity and density of the encoded frames, inflow is only used for the advection
+    np.testing.assert_array_equal(bm.sequence_field_mask(), [[1, 1, 0], [1, 1, 0], [0, 0, 0], [0, 0, 0]])
+    np.testing.assert_array_equal(bm.sequence_field_mask(decode_predictions=True), [[1, 1, 0], [1, 1, 0], [1, 1, 0], [1, 1, 0]])
+    np.testing.assert_array_equal(bm.sequence_field_mask(advection_loss=True), [[1, 1, 0], [1, 1, 0], [0, 0, 1], [0, 1, 1]])
+    np.testing.assert_array_equal(bm.sequence_field_mask(ls_prediction_loss=True), [[1, 1, 0]] * 4)
+
+#------------------------------------------------------------------------------------------------
+@pytest.mark.parametrize("sequence_args", [{}, {"decode_predictions": True}, {"advection_loss": True, "train_prediction_only": True}])
+def test_sequence_reads_only_used_fields(keras_data, dataset, monkeypatch, sequence_args):
+    bm = keras_data.BatchManager(Config(dataset), 4, 2)
+    field_mask = bm.sequence_field_mask(**{k: v for k, v in sequence_args.items() if k != "train_prediction_only"})
+    reads = []
+    load_frame = bm.load_frame
+    def counted_load_frame(scene, frame, i_d):
+        reads.append(i_d)
+        return load_frame(scene, frame, i_d)
+    monkeypatch.setattr(bm, "load_frame", counted_load_frame)
+    x, y = next(bm.generator_ae_sequence(4, 0.25, **sequence_args))
+    assert len(reads) == 4 * field_mask.sum()
+
+    # the same windows read completely give the same encoder inputs and targets
+    full = keras_data.BatchManager(Config(dataset), 4, 2)
+    x_full, (_, p_full) = next(full.generator_ae(4, 0.25))
+    inflow_full = x_full[..., -1:] * full.data_type_normalization["inflow"]
+    x_expected, y_expected = full._sequence_batch(x_full, p_full, full.sequence_output_spec(4, **sequence_args), inflow_full)
+    np.testing.assert_array_equal(x[0][:, :2], x_expected[0][:, :2])
+    np.testing.assert_array_equal(x[1], x_expected[1])
+    if sequence_args.get("advection_loss"):
+        np.testing.assert_array_equal(x[2][:, 2:], x_expected[2][:, 2:])
+    assert len(y) == len(y_expected)
+    for target, expected in zip(y, y_expected):
+        np.testing.assert_array_equal(target, expected)
+
+#------------------------------------------------------------------------------------------------
+def test_sequence_targets_are_views(keras_data, dataset):
+    bm = keras_data.BatchManager(Config(dataset), 4, 2)
+    sequence_args = dict(decode_predictions=True, ls_prediction_loss=True)
+    assert [name for name, _, _ in bm.sequence_output_spec(4, **sequence_args)] == ["ae", "prediction", "sup_param", "ls_prediction_dummy"]
+    gen = bm.generator_ae_sequence(4, 0.25, **sequence_args)
+
+    (x, p, inflow), y = next(gen)
+    assert np.shares_memory(y[0], x) and np.shares_memory(y[1], x) and np.shares_memory(y[2], p)
+    np.testing.assert_array_equal(y[1], x[:, 2:])
+    # the dummy target is allocated once
+    _, y_next = next(gen)
+    assert np.shares_memory(y[3], y_next[3]) and not y_next[3].any()
+
+#------------------------------------------------------------------------------------------------
+def test_prefetch_loader_matches_template(keras_data, dataset):
+    bm = keras_data.BatchManager(Config(dataset, num_worker=2, loader_queue_depth=2), 3, 2)
+    sequence_args = dict(decode_predictions=True, ls_prediction_loss=True)
+    template = bm.sequence_batch_template(4, **sequence_args)
+    x, y = next(bm.generator_ae_sequence(4, 0.25, **sequence_args))
+    assert [a.shape for a in x] == [a.shape for a in template[0]]
+    assert [a.shape for a in y] == [a.shape for a in template[1]]
+
+    train_loader, validation_loader = bm.sequence_loaders(4, 0.25, 2, 2, **sequence_args)
+    try:
+        for loader in [train_loader, train_loader, validation_loader]:
+            x, y = next(loader)
+            assert [(a.shape[1:], a.dtype) for a in x] == [(a.shape[1:], a.dtype) for a in template[0]]
+            assert [(a.shape[1:], a.dtype) for a in y] == [(a.shape[1:], a.dtype) for a in template[1]]
+    finally:
+        train_loader.close()
+        validation_loader.close()
+
+#------------------------------------------------------------------------------------------------
+def test_prefetch_loader_dead_worker(keras_data, dataset):
+    bm = keras_data.BatchManager(Config(dataset), 3, 2)
+    def generator():
+        # killed without reporting, e.g. by the out of memory killer
+        os._exit(1)
+        yield
+    loader = keras_data.PrefetchLoader(bm, generator, bm.sequence_batch_template(4), 1, poll_timeout=0.1)
+    try:
+        with pytest.raises(AssertionError, match="died"):
+            next(loader)
+    finally:
+        loader.close()
+
+#------------------------------------------------------------------------------------------------
+def test_window_sampler_epochs(keras_data):
+    windows = np.arange(100, 130)
+    sampler = keras_data.WindowSampler(windows, 7, windows_per_epoch=24)
+
+    epochs = [sampler.epoch(e) for e in range(3)]
+    for epoch in epochs:
+        assert len(epoch) == 24 and len(set(epoch)) == 24 and set(epoch) <= set(windows)
+    assert not np.array_equal(epochs[0], epochs[1])
+    np.testing.assert_array_equal(keras_data.WindowSampler(windows, 7, windows_per_epoch=24).epoch(1), epochs[1])
+    np.testing.assert_array_equal(keras_data.WindowSampler(windows, 7, shuffle=False).epoch(5), windows)
+
+#------------------------------------------------------------------------------------------------
+def test_window_sampler_stream_shards(keras_data):
+    sampler = keras_data.WindowSampler(np.arange(10), 7)
+    expected = list(sampler.epoch(0)) + list(sampler.epoch(1)) + list(sampler.epoch(2))
+
+    # chunks of 2 windows are dealt round-robin to 3 shards, epochs run on over the shard boundaries
+    streams = [sampler.stream(chunk=2, shard=shard, num_shards=3) for shard in range(3)]
+    merged = []
+    for chunk in range(15):
+        merged.extend(next(streams[chunk % 3]) for _ in range(2))
+    assert merged == expected
+
+    stream = sampler.stream(epoch_end=True)
+    assert [next(stream) for _ in range(22)] == expected[:10] + [None] + expected[10:20] + [None]
+
+#------------------------------------------------------------------------------------------------
+def test_dataset_split_spreads_validation_over_params(keras_data):
+    paths = Namespace(scene=np.repeat(np.arange(10), 3))
+    # scene params in shuffled order, the validation scenes are picked from the sorted params
+    scene_params = np.array([[5.0], [1.0], [9.0], [0.0], [7.0], [3.0], [8.0], [2.0], [6.0], [4.0]])
+    split = keras_data.DatasetSplit(paths, 0.2, scene_params)
+
+    assert sorted(scene_params[split.val_scenes, 0]) == [2.0, 7.0]
+    assert not set(split.val_scenes) & set(split.train_scenes)
+    assert sorted(set(split.val_scenes) | set(split.train_scenes)) == list(range(10))
+    np.testing.assert_array_equal(paths.scene[split.samples(validation=True)], np.repeat(split.val_scenes, 3))
+    np.testing.assert_array_equal(paths.scene[split.samples(validation=False)], np.repeat(split.train_scenes, 3))
+
+    mask = np.arange(30) % 3 != 2
+    assert len(split.samples(validation=True, mask=mask)) == 4
+
+    # without params the last scenes, as before
+    np.testing.assert_array_equal(keras_data.DatasetSplit(paths, 0.2).val_scenes, [8, 9])
+
+#------------------------------------------------------------------------------------------------
+def test_window_samplers_keep_scenes_apart(keras_data, tmp_path):
+    dataset = make_dataset(os.path.join(str(tmp_path), "ds"), num_scenes=10, num_frames=8)
+    bm = keras_data.BatchManager(Config(dataset), 3, 2)
+    split = bm.dataset_split(0.2)
+    assert len(split.val_scenes) == 2
+
+    train = bm.window_sampler(4, 0.2, validation=False)
+    validation = bm.window_sampler(4, 0.2, validation=True)
+    assert set(bm.paths.scene[train.windows]) == set(split.train_scenes)
+    assert set(bm.paths.scene[validation.windows]) == set(split.val_scenes)
+    # every validation window once per epoch in a fixed order
+    np.testing.assert_array_equal(validation.epoch(0), validation.epoch(1))
+    assert bm.steps_per_epoch(4, 0.2, validation=True) == int(np.ceil(len(validation.windows) / 4.0))
+
+#------------------------------------------------------------------------------------------------
+def test_packed_store_matches_files(keras_data, dataset):
+    import pack_dataset
+    bm = keras_data.BatchManager(Config(dataset), 4, 2)
+    pack_dataset.pack_dataset(bm, os.path.join(dataset, "packed"), np.float32)
+    bm_packed = keras_data.BatchManager(Config(dataset, use_packed=True), 4, 2)
+    assert bm_packed.packed is not None and len(bm_packed.paths) == len(bm.paths)
+
+    for i_d in range(3):
+        x, y = bm.load_frame(2, 5, i_d)
+        x_packed, y_packed = bm_packed.load_frame(2, 5, i_d)
+        np.testing.assert_array_equal(x_packed, x)
+        np.testing.assert_array_equal(y_packed, y)
+
+    field_mask = bm.sequence_field_mask(decode_predictions=True, advection_loss=True)
+    assert not field_mask.all()
+    for mask in [None, field_mask]:
+        results = []
+        for manager in [bm, bm_packed]:
+            # fields outside of the mask are left untouched
+            x = np.full([4] + bm.batch_sample_shape()[1:], np.nan, dtype=np.float32)
+            y = np.empty((4, bm.supervised_param_count), dtype=np.float32)
+            manager.fill_sequence(x, y, 1, 3, mask)
+            results.append((x, y))
+        np.testing.assert_array_equal(results[1][0], results[0][0])
+        np.testing.assert_array_equal(results[1][1], results[0][1])
+
+    x, (_, y) = next(bm.generator_ae(4, 0.25))
+    x_packed, (_, y_packed) = next(bm_packed.generator_ae(4, 0.25))
+    np.testing.assert_array_equal(x_packed, x)
+    np.testing.assert_array_equal(y_packed, y)
+
+#------------------------------------------------------------------------------------------------
+def test_tfdata_reads_like_batch_manager(keras_data, dataset):
+    import pack_dataset
+    import keras_data_tf
+    bm = keras_data.BatchManager(Config(dataset, data_backend="tfdata", tfdata_parallel_calls=2, loader_queue_depth=2, tfdata_cache="memory", frame_cache_mb=8), 4, 2)
+    pipeline = keras_data_tf.TFDataPipeline(bm)
+    assert pipeline.frame_cache is bm.frame_cache
+
+    read = np.array([True, False, True])
+    fields = pipeline._load_raw(2, 5, read)
+    assert [f.shape for f in fields] == [(24, 16, 2), (24, 16), (24, 16), (1,)]
+    assert not fields[1].any()
+    x, y = bm.load_frame(2, 5, 0)
+    np.testing.assert_allclose(fields[0][::-1] / bm.x_range[0], x)
+    # raw params are normalized by tf ops like preprocess_params
+    assert not pipeline.params_normalized
+    np.testing.assert_allclose((fields[-1] - 0.1) / 0.8 * 2.0 - 1.0, y, rtol=1e-5)
+
+    pack_dataset.pack_dataset(bm, os.path.join(dataset, "packed"), np.float32)
+    bm_packed = keras_data.BatchManager(Config(dataset, data_backend="tfdata", use_packed=True), 4, 2)
+    pipeline = keras_data_tf.TFDataPipeline(bm_packed)
+    assert pipeline.params_normalized
+    fields = pipeline._load_raw(2, 5, read)
+    for i_d in [0, 2]:
+        np.testing.assert_array_equal(fields[i_d], bm.load_frame(2, 5, i_d)[0])
+    np.testing.assert_allclose(fields[-1], y)
+
+#------------------------------------------------------------------------------------------------
+def test_tfdata_memory_cache_needs_budget(keras_data, dataset):
+    import keras_data_tf
+    bm = keras_data.BatchManager(Config(dataset, data_backend="tfdata", tfdata_parallel_calls=2, loader_queue_depth=2, tfdata_cache="memory"), 4, 2)
+    with pytest.raises(AssertionError, match="frame_cache_mb"):
+        keras_data_tf.TFDataPipeline(bm)
+
+#------------------------------------------------------------------------------------------------
+@pytest.mark.parametrize("drop_remainder", [False, True])
+def test_validation_epoch(keras_data, dataset, drop_remainder):
+    bm = keras_data.BatchManager(Config(dataset), 3, 2)
+    windows = bm.window_sampler(4, 0.25, validation=True).windows
+    assert len(windows) == 10
+    steps = bm.steps_per_epoch(4, 0.25, validation=True, drop_remainder=drop_remainder)
+    assert steps == (2 if drop_remainder else 3)
+
+    generator = bm.generator_ae(4, 0.25, validation=True, drop_remainder=drop_remainder)
+    epochs = []
+    for _ in range(2):
+        # copies, the batch buffers are reused
+        epochs.append([(x.copy(), y.copy()) for x, (_, y) in (next(generator) for _ in range(steps))])
+    # every window once in dataset order, the stateful model only gets full batches
+    assert [len(x) for x, _ in epochs[0]] == ([4, 4] if drop_remainder else [4, 4, 2])
+    expected_y = np.stack([bm.load_frame(int(bm.paths.scene[w]), int(bm.paths.frame[w]) + i, 0)[1] for w in windows for i in range(3)]).reshape(10, 3, -1)
+    np.testing.assert_allclose(np.concatenate([y for _, y in epochs[0]]), expected_y[:4 * steps], rtol=1e-6)
+    for (x0, y0), (x1, y1) in zip(*epochs):
+        np.testing.assert_array_equal(x0, x1)
+        np.testing.assert_array_equal(y0, y1)
@@ -0,0 +1,138 @@
+import numpy as np
+import pytest
+
+#------------------------------------------------------------------------------------------------
+@pytest.fixture(scope="module")
+def models_general():
+    pytest.importorskip("tensorflow")
+    pytest.importorskip("keras")
+    import keras_models_general
+    return keras_models_general
+
+#------------------------------------------------------------------------------------------------
+@pytest.fixture
+def float16_layers():
+    import keras.backend as K
+    K.clear_session()
+    floatx = K.floatx()
+    K.set_floatx("float16")
+    yield K
+    K.set_floatx(floatx)
+    K.clear_session()
+
+#------------------------------------------------------------------------------------------------
+def test_float32_loss(models_general, float16_layers):
+    import keras
+    K = float16_layers
+    x = keras.layers.Input((4,))
+    y = keras.layers.Dense(4, kernel_regularizer=keras.regularizers.l2(1e-3))(x)
+    model = keras.models.Model(x, y)
+    model.set_weights([np.zeros(w.shape) for w in model.get_weights()])
+    models_general.compile_model(model, True, loss="mse", optimizer="sgd")
+    assert K.floatx() == "float16"
+    assert K.dtype(model.total_loss) == "float32"
+
+    # squared errors of 300 and the weighted mean are above the float16 maximum of 65504
+    x_ = np.ones((2, 4), dtype=np.float16)
+    y_ = np.full((2, 4), 300.0, dtype=np.float16)
+    loss = model.evaluate(x_, y_, sample_weight=np.array([1.0, 0.5]), batch_size=2, verbose=0)
+    np.testing.assert_allclose(loss, (90000.0 + 45000.0) / 2, rtol=1e-6)
+
+#------------------------------------------------------------------------------------------------
+def _free_port():
+    import socket
+    s = socket.socket()
+    s.bind(("localhost", 0))
+    port = s.getsockname()[1]
+    s.close()
+    return port
+
+#------------------------------------------------------------------------------------------------
+def test_two_worker_gradients(models_general):
+    """ --worker_hosts with two local CPU processes: the summed replica gradients equal the gradients of the whole batch """
+    import subprocess
+    import sys
+    from argparse import Namespace
+    import keras
+    import keras.backend as K
+    import tensorflow as tf
+    from conftest import ROOT
+
+    hosts = ",".join("localhost:{}".format(_free_port()) for _ in range(2))
+    serve = "from argparse import Namespace; import keras_models_general; keras_models_general.setup_workers(Namespace(worker_hosts='{}', task_index=1))"
+    worker = subprocess.Popen([sys.executable, "-c", serve.format(hosts)], cwd=ROOT)
+    try:
+        K.clear_session()
+        config = Namespace(worker_hosts=hosts, task_index=0, gpu_id="")
+        models_general.setup_workers(config)
+        devices = models_general.replica_devices(config)
+        assert devices == ["/job:worker/task:0/cpu:0", "/job:worker/task:1/cpu:0"]
+
+        with tf.device(models_general.parameter_device(devices)):
+            x = keras.layers.Input((3,))
+            model = keras.models.Model(x, keras.layers.Dense(2)(x))
+        parallel_model = models_general.data_parallel_model(model, devices)
+        y = K.placeholder((None, 2))
+        loss = K.mean(K.square(parallel_model.output - y))
+        grads = models_general.replicated_gradients(loss, model.trainable_weights, parallel_model.replica_outputs, devices)
+        expected = K.gradients(loss, model.trainable_weights)
+
+        rng = np.random.RandomState(0)
+        feed = {model.input: rng.randn(8, 3), y: rng.randn(8, 2)}
+        grads, expected = K.get_session().run([grads, expected], feed)
+        for g, e in zip(grads, expected):
+            np.testing.assert_allclose(g, e, rtol=1e-5, atol=1e-6)
+    finally:
+        worker.kill()
+        worker.wait()
+        K.clear_session()
+
+#------------------------------------------------------------------------------------------------
+def _checkpointed_model(models_general):
+    import keras
+    x = keras.layers.Input((6,))
+    h = x
+    for _ in range(3):
+        h = keras.layers.Dense(6, activation="tanh")(h)
+        h = models_general.checkpoint_layer(h)
+    return keras.models.Model(x, keras.layers.Dense(2)(h))
+
+#------------------------------------------------------------------------------------------------
+def test_checkpointed_gradients(models_general):
+    import keras.backend as K
+    K.clear_session()
+    model = _checkpointed_model(models_general)
+    y = K.placeholder((None, 2))
+    loss = K.mean(K.square(model.output - y))
+    params = model.trainable_weights
+    # the reference gradients are taken before checkpointed_gradients rewrites the graph
+    expected = K.gradients(loss, params)
+    grads = models_general.checkpointed_gradients(loss, params)
+    assert len(K.get_session().graph.get_collection(models_general.CHECKPOINT_COLLECTION)) == 3
+
+    rng = np.random.RandomState(1)
+    feed = {model.input: rng.randn(5, 6), y: rng.randn(5, 2)}
+    grads, expected = K.get_session().run([grads, expected], feed)
+    for g, e in zip(grads, expected):
+        np.testing.assert_allclose(g, e, rtol=1e-5, atol=1e-6)
+    K.clear_session()
+
+#------------------------------------------------------------------------------------------------
+def test_checkpoint_layer_save_load(models_general, tmpdir):
+    import keras
+    import keras.backend as K
+    from keras.utils import CustomObjectScope
+    K.clear_session()
+    model = _checkpointed_model(models_general)
+    path = str(tmpdir.join("model.h5"))
+    keras.models.save_model(model, path)
+    x = np.random.RandomState(2).randn(4, 6)
+    expected = model.predict(x)
+
+    K.clear_session()
+    with CustomObjectScope(models_general.CHECKPOINT_OBJECTS):
+        loaded = keras.models.load_model(path)
+    np.testing.assert_allclose(loaded.predict(x), expected, rtol=1e-6)
+    # the loaded marks register their outputs again
+    assert len(K.get_session().graph.get_collection(models_general.CHECKPOINT_COLLECTION)) == 3
+    K.clear_session()
@@ -0,0 +1,101 @@
+import os
+import sys
+import types
+from argparse import Namespace
+
+import numpy as np
+import pytest
+
+import frame_codec
+from conftest import ROOT
+
+#------------------------------------------------------------------------------------------------
+@pytest.fixture(scope="module")
+def scene_storage():
+    # scene_storage imports keras_data; manta only exists inside the mantaflow executable
+    pytest.importorskip("tensorflow")
+    pytest.importorskip("keras")
+    pytest.importorskip("matplotlib")
+    sys.modules.setdefault("manta", types.ModuleType("manta"))
+    sys.path.insert(0, os.path.join(ROOT, "scene"))
+    import scene_storage
+    return scene_storage
+
+#------------------------------------------------------------------------------------------------
+@pytest.mark.parametrize("codec", [None, "none", "zlib", "zlib:1", "lz4", "zstd:3"])
+def test_save_npz(scene_storage, tmp_path, codec):
+    args = Namespace(log_dir=str(tmp_path), path_format="%d_%d.npz")
+    if codec is not None:
+        args.frame_codec = codec
+    os.makedirs(os.path.join(str(tmp_path), "v"))
+    arr = np.random.RandomState(0).randn(1, 8, 6, 2).astype(np.float32)
+
+    arr_range = scene_storage.save_npz(arr, [np.inf, -np.inf], "v", 3, 5, [0.25, 0.5], args)
+
+    assert arr_range[0] == arr.min() and arr_range[1] == arr.max()
+    with frame_codec.load(os.path.join(str(tmp_path), "v", "3_5.npz")) as data:
+        np.testing.assert_array_equal(data['x'], arr[0])
+        np.testing.assert_array_equal(data['y'], np.float32([0.5]))
+
+#------------------------------------------------------------------------------------------------
+def test_save_npz_float16(scene_storage, tmp_path):
+    args = Namespace(log_dir=str(tmp_path), path_format="%d_%d.npz", field_dtype="float16", frame_codec="zlib")
+    os.makedirs(os.path.join(str(tmp_path), "d"))
+    arr = np.random.RandomState(1).rand(1, 8, 6).astype(np.float32)
+
+    scene_storage.save_npz(arr, [np.inf, -np.inf], "d", 0, 0, [[0.1, 0.2], [0.3, 0.4]], args)
+
+    with frame_codec.load(os.path.join(str(tmp_path), "d", "0_0.npz")) as data:
+        assert data['x'].dtype == np.float16
+        np.testing.assert_allclose(data['x'], arr[0], rtol=2.0**-11)
+        np.testing.assert_array_equal(data['y'], np.float32([[0.2], [0.4]]))
+
+#------------------------------------------------------------------------------------------------
+@pytest.mark.parametrize("name, data_type, bound", [("v", "velocity", 2.0**-11), ("d", "density", 2.0**-10), ("i", "inflow", 2.0**-10)])
+def test_float16_normalization_error(scene_storage, tmp_path, name, data_type, bound):
+    import keras_data
+    rng = np.random.RandomState(2)
+    arr = (rng.randn(1, 16, 12, 2) * 3.0 if name == "v" else rng.rand(1, 16, 12)).astype(np.float32)
+    paths = []
+    for field_dtype in ["float32", "float16"]:
+        args = Namespace(log_dir=os.path.join(str(tmp_path), field_dtype), path_format="%d_%d.npz", field_dtype=field_dtype)
+        os.makedirs(os.path.join(args.log_dir, name))
+        arr_range = scene_storage.save_npz(arr, [np.inf, -np.inf], name, 0, 0, [0.5], args)
+        paths.append(os.path.join(args.log_dir, name, "0_0.npz"))
+
+    x_range = max(abs(arr_range[0]), abs(arr_range[1]))
+    x32, _ = keras_data.preprocess(paths[0], data_type, x_range, [[0, 1], [0, 1], [0, 1]], den_inflow=True)
+    x16, _ = keras_data.preprocess(paths[1], data_type, x_range, [[0, 1], [0, 1], [0, 1]], den_inflow=True)
+    assert np.abs(x16 - x32).max() <= bound
+
+#------------------------------------------------------------------------------------------------
+class _Model(object):
+    def __init__(self, fn):
+        self.predict = fn
+
+#------------------------------------------------------------------------------------------------
+def test_tiled_prediction(scene_storage):
+    import keras_data
+    net = Namespace(tiled=keras_data.TiledInference(None, [8, 6, 1], False, batch_size=4))
+    field = np.random.RandomState(3).randn(1, 12, 16, 3).astype(np.float32)
+    net.tiled.tiles(field[0])
+    num_tiles = len(net.tiled.positions)
+    assert num_tiles == 4
+
+    # the latent code of a tile is the tile itself, the decoder reshapes it back
+    encoder = lambda x, batch_size: x.reshape(len(x), -1)
+    decoder = lambda x, batch_size: x.reshape(len(x), 6, 8, 3)
+    enc = scene_storage.encoder_predict(_Model(encoder), field, net)
+    assert enc.shape == (1, num_tiles, 6 * 8 * 3)
+    np.testing.assert_allclose(scene_storage.decoder_predict(_Model(decoder), enc, net), field, rtol=1e-6)
+
+    net.prediction_history = scene_storage.PredictionHistory(in_ts=2, data_shape=enc.shape[1:])
+    net.prediction_history.add_simulation(enc[0] - 1.0)
+    net.prediction_history.add_simulation(enc[0])
+    net.pred = Namespace(model=_Model(lambda x, batch_size: np.ones((len(x), 1, x.shape[-1]), dtype=np.float32)))
+    cur_pred = scene_storage.predict_ls(net)
+    # one sequence per tile continued from its last code
+    assert cur_pred.shape == (1, 1, num_tiles, 6 * 8 * 3)
+    np.testing.assert_allclose(cur_pred[0, 0], enc[0] + 1.0)
+    net.prediction_history.add_prediction(cur_pred[0])
+    np.testing.assert_array_equal(net.prediction_history.get()[0, -1], cur_pred[0, 0])
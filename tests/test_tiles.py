@@ -0,0 +1,116 @@
+import numpy as np
+import pytest
+
+#------------------------------------------------------------------------------------------------
+def random_fields(shape, seed=0):
+    # velocity channels first, the passive quantity last like the dataset fields
+    return np.random.RandomState(seed).normal(size=shape).astype(np.float32)
+
+#------------------------------------------------------------------------------------------------
+@pytest.mark.parametrize("is_3d", [False, True])
+def test_cut_tiles_matches_cut_tile(keras_data, is_3d):
+    if is_3d:
+        tile_generator = keras_data.TileConfig([4, 6, 5], [8, 12, 10])
+        data = random_fields((3, 10, 12, 8, 5))
+        cut_tile = tile_generator.cut_tile
+    else:
+        tile_generator = keras_data.TileConfig([8, 6, 1], [16, 12, 1])
+        data = random_fields((3, 12, 16, 4))
+        cut_tile = tile_generator.cut_tile_2d
+    padded, interior = tile_generator.padded_buffer(data.shape, is_3d, out_of_bounds_fac=3)
+    interior[...] = data
+
+    starts = tile_generator.random_tile_starts(200, np.random.RandomState(1), out_of_bounds_fac=3)
+    for start, tile in zip(starts, tile_generator.cut_tiles(padded, starts, is_3d, out_of_bounds_fac=3)):
+        tile_generator.set_tile(start)
+        if is_3d and (start[2] < 0 or tile_generator.z_end > 10) and 0 <= start[0] <= 8 - 4 and 0 <= start[1] <= 12 - 6:
+            # cut_tile only pads tiles that leave the domain in x or y, cut_tiles also pads in z
+            z = np.arange(start[2], start[2] + 5)
+            inside = (z >= 0) & (z < 10)
+            np.testing.assert_array_equal(tile[:, inside], data[:, z[inside], start[1]:start[1]+6, start[0]:start[0]+4])
+            assert (tile[:, ~inside, ..., :3] == 0.0).all() and (tile[:, ~inside, ..., 3:] == -1.0).all()
+            continue
+        np.testing.assert_array_equal(tile, cut_tile(data))
+
+#------------------------------------------------------------------------------------------------
+def test_random_tile_starts_range(keras_data):
+    tile_generator = keras_data.TileConfig([8, 6, 4], [16, 12, 10])
+    starts = tile_generator.random_tile_starts(20000, np.random.RandomState(0), out_of_bounds_fac=3)
+
+    # same bounds as generateRandomTile
+    low, high = [], []
+    for _ in range(20000):
+        tile_generator.generateRandomTile(out_of_bounds_fac=3)
+        low.append([tile_generator.x_start, tile_generator.y_start, tile_generator.z_start])
+    low = np.array(low)
+    np.testing.assert_array_equal(starts.min(axis=0), low.min(axis=0))
+    np.testing.assert_array_equal(starts.max(axis=0), low.max(axis=0))
+
+#------------------------------------------------------------------------------------------------
+@pytest.mark.parametrize("is_3d", [False, True])
+def test_tile_flag_downscale_matches_block_reduce(keras_data, is_3d):
+    from skimage import measure
+    # 18 / 4 leaves a partial last block in x
+    tile_generator = keras_data.TileConfig([4, 6, 5] if is_3d else [4, 6, 1], [18, 12, 10] if is_3d else [18, 12, 1])
+    spatial = 3 if is_3d else 2
+    shape = [10, 12, 18][-spatial:]
+    mult = tuple(int(d / t) for d, t in zip(tile_generator.data_dim, tile_generator.tile_size))[:spatial][::-1]
+
+    for start in tile_generator.random_tile_starts(100, np.random.RandomState(2), out_of_bounds_fac=3):
+        tile_generator.set_tile(start)
+        # the flag of the old per tile computation: 1 on the part of the tile inside the domain
+        flag = np.zeros(shape + [1])
+        flag[tuple(slice(max(s, 0), s + t) for s, t in zip(start[:spatial][::-1], tile_generator.tile_size[:spatial][::-1]))] = 1.0
+        expected = measure.block_reduce(flag, mult + (1,), np.mean)
+        np.testing.assert_allclose(tile_generator.tile_flag_downscale(list(start), is_3d), expected)
+    # the density downscale of a whole sequence equals the downscale of every frame
+    data = random_fields((3,) + tuple(shape) + (1,))
+    np.testing.assert_allclose(tile_generator.downscale(data, is_3d)[1], tile_generator.downscale(data[1], is_3d))
+
+#------------------------------------------------------------------------------------------------
+def test_valid_tile_starts_matches_rejection(keras_data):
+    tile_generator = keras_data.TileConfig([8, 6, 1], [16, 12, 1])
+    data = random_fields((3, 12, 16, 4))
+    # empty passive quantity except a few cells: a tile is valid if it covers one of them
+    data[..., -1] = -1.0
+    data[1, 2, 3, -1] = 1.0
+    data[1, 9, 14, -1] = 1.0
+    padded, interior = tile_generator.padded_buffer(data.shape, False, out_of_bounds_fac=3)
+    interior[...] = data
+
+    valid = tile_generator.valid_tile_starts(padded[1, ..., -1], -0.99, out_of_bounds_fac=3)
+
+    # the check of the old rejection loop for every start generateRandomTile can draw
+    expected = []
+    for x in range(-int(8/3), 16 - int(8/3) + 1):
+        for y in range(-int(6/3), 12 - int(6/3) + 1):
+            tile_generator.set_tile([x, y, 0])
+            if np.mean(tile_generator.cut_tile_2d(data)[1, ..., -1]) >= -0.99:
+                expected.append((x, y, 0))
+    assert 0 < len(expected) < (16 + 1) * (12 + 1)
+    assert sorted(map(tuple, valid.tolist())) == sorted(expected)
+
+#------------------------------------------------------------------------------------------------
+def test_split_grid_matches_tile_loop(keras_data):
+    tile_generator = keras_data.TileConfig([24, 24, 1], [24, 24, 1])
+    # (b, s, y, x, c) with a remainder in x and y
+    data = random_fields((2, 3, 13, 11, 4))
+
+    tiles = tile_generator.split_grid(data, [3, 3, 3], False)
+
+    # the old 3x3 loop of generator_ae_tile_sequence
+    tile_dim_x, tile_dim_y = 11 // 3, 13 // 3
+    expected = np.stack([data[:, :, y_i*tile_dim_y:(y_i+1)*tile_dim_y, x_i*tile_dim_x:(x_i+1)*tile_dim_x] for y_i in range(3) for x_i in range(3)], axis=2)
+    np.testing.assert_array_equal(tiles, expected)
+    np.testing.assert_array_equal(tile_generator.merge_grid(tiles, [3, 3, 3], False), data[:, :, :12, :9])
+
+#------------------------------------------------------------------------------------------------
+def test_split_grid_3d(keras_data):
+    tile_generator = keras_data.TileConfig([24, 24, 24], [24, 24, 24])
+    data = random_fields((2, 6, 9, 12, 5))
+
+    tiles = tile_generator.split_grid(data, [4, 3, 2], True)
+
+    expected = np.stack([data[:, z*3:(z+1)*3, y*3:(y+1)*3, x*3:(x+1)*3] for z in range(2) for y in range(3) for x in range(4)], axis=1)
+    np.testing.assert_array_equal(tiles, expected)
+    np.testing.assert_array_equal(tile_generator.merge_grid(tiles, [4, 3, 2], True), data)